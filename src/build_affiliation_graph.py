@@ -1,44 +1,534 @@
+import os
+import json
+import shutil
+import tempfile
+import argparse
 import logging
+import multiprocessing
+import numpy as np
+from joblib import Parallel, delayed
 import graph_manager
 import data_parser
+from graph_manager import Checkpoint, NODE_TYPES
+from data_parser import Pis12BatchInterpreter, StateFilter, RejectionLog
+from config_manager import Config, DEFAULT_STATE_CODE
+from spell_cache import SpellCache
+from graph_storage import replace_file
 
-def process_files(source_folder, data_parser, interpreter_class, graph_manager, save_path=None):
+# a compact edge list, one entry per line that passes the filter.
+# invalid timestamps are -1, as valid ones always fall on midnight.
+EDGE_DTYPE = np.dtype([('worker_id', np.int64), ('employer_id', np.int64),
+                       ('year', np.int32), ('admission_timestamp', np.int64),
+                       ('demission_timestamp', np.int64)])
+
+def process_files(source_folder, data_parser, interpreter_class, graph_manager,
+                  save_path=None, batch_size=100000, checkpoint=None,
+                  resume=False, state_code=DEFAULT_STATE_CODE,
+                  rejections=None, cache=None):
+    """
+    :param batch_size: see process_file. None reads files line by line,
+        which is a lot slower.
+    :param state_code: only lines of municipalities starting with this
+        code are read. None reads every state.
+    :param rejections: a RejectionLog for the lines the interpreters reject,
+        which is summed up in the log at the end.
+    :param cache: a SpellCache, see process_file.
+    :param checkpoint: a Checkpoint, which gets a tick after every file.
+        It is cleared once the graph is saved.
+    :param resume: start from the last checkpoint, if there is one,
+        skipping the files it already has.
+    """
 
     # get a graph from manager
+    manager = None
+    done_paths = []
+    if resume and checkpoint is not None:
+        manager, cursor = checkpoint.load(graph_manager)
+        if cursor is not None:
+            done_paths = cursor["files"]
+    if manager is None:
+        manager = graph_manager()
+    if rejections is None:
+        rejections = RejectionLog()
+
+    file_paths = list(data_parser.find_files(source_folder, 0))
+    for file_path in file_paths:
+        if file_path in done_paths:
+            continue
+
+        process_file(file_path, data_parser, interpreter_class, manager,
+                     batch_size, state_code, rejections, cache)
+
+        if checkpoint is not None:
+            done_paths.append(file_path)
+            checkpoint.tick(manager, {"files": done_paths})
+
+    # graph should be complete at this point
+    if save_path is not None:
+        manager.save_graph(save_path)
+        save_manifest(save_path, file_paths)
+        if checkpoint is not None:
+            checkpoint.clear()
+
+    rejections.close()
+    logging.warn(rejections.summary())
+    return manager
+
+def update_graph(source_folder, data_parser, interpreter_class, graph_manager,
+                 save_path, batch_size=100000, state_code=DEFAULT_STATE_CODE,
+                 rejections=None):
+    """
+    Same as process_files, but if save_path already has a graph, we load it
+    and only read the files of source_folder that it doesn't have yet.
+    The files each graph was built from are kept in a manifest, next to it.
+    We assume files only get added: if a file we read before has changed,
+    or is no longer in source_folder, we build the whole graph again.
+    :param batch_size: new files are read in batches of this size.
+    :param rejections: same as in process_files.
+    :return: (graph manager, list of files we read, array with the ids of
+        the employers those files have). The employers are None if we
+        built the whole graph again.
+    """
+    manifest = load_manifest(save_path)
+    file_paths = list(data_parser.find_files(source_folder, 0))
+
+    changed_paths = [file_path for file_path in file_paths
+                     if _manifest_key(file_path) in manifest and
+                     manifest[_manifest_key(file_path)] != file_signature(file_path)]
+    found_keys = set(_manifest_key(file_path) for file_path in file_paths)
+    missing_paths = sorted(key for key in manifest if key not in found_keys)
+    if changed_paths or missing_paths or not os.path.isfile(save_path):
+        if changed_paths:
+            logging.warn("Files changed since the last build, starting over: "
+                         + ", ".join(changed_paths))
+        if missing_paths:
+            logging.warn("Files are gone since the last build, starting over: "
+                         + ", ".join(missing_paths))
+        manager = process_files(source_folder, data_parser, interpreter_class,
+                                graph_manager, save_path, batch_size,
+                                state_code=state_code, rejections=rejections)
+        return manager, file_paths, None
+
+    if rejections is None:
+        rejections = RejectionLog()
     manager = graph_manager()
+    manager.load_graph(save_path)
+    new_paths = [file_path for file_path in file_paths
+                 if _manifest_key(file_path) not in manifest]
+    employer_lists = [np.empty(0, dtype=np.int64)]
+    for file_path in new_paths:
+        edges = extract_edges(file_path, data_parser, interpreter_class,
+                              batch_size, state_code=state_code,
+                              rejections=rejections)
+        merge_edges(edges, manager)
+        employer_lists.append(np.unique(edges['employer_id']))
+
+    if new_paths:
+        manager.save_graph(save_path)
+        save_manifest(save_path, file_paths)
+
+    rejections.close()
+    logging.warn(rejections.summary())
+    return manager, new_paths, np.unique(np.concatenate(employer_lists))
+
+def file_signature(file_path):
+    """ :return: what tells us a file has changed: its size and mtime """
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+def manifest_path(save_path):
+    return save_path.replace(".graph", "_manifest.json")
+
+def load_manifest(save_path):
+    """
+    :return: dictionary of file path - file signature, for the files the
+        graph in save_path was built from. Empty if there is no manifest.
+    """
+    path = manifest_path(save_path)
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)["files"]
+
+def save_manifest(save_path, file_paths):
+    files = dict((_manifest_key(file_path), file_signature(file_path))
+                 for file_path in file_paths)
+    path = manifest_path(save_path)
+    with open(path + ".tmp", 'w') as manifest_file:
+        json.dump({"version": 1, "files": files}, manifest_file, indent=1,
+                  sort_keys=True)
+    replace_file(path + ".tmp", path)
+
+def _manifest_key(file_path):
+    return os.path.abspath(file_path)
+
+def process_files_in_parallel(source_folder, data_parser, interpreter_class,
+                              graph_manager, save_path=None, n_jobs=None,
+                              batch_size=100000, parts_per_file=1,
+                              state_code=DEFAULT_STATE_CODE, rejections=None):
+    """
+    Same as process_files, but each file is read by a different process.
+    Processes hand back compact edge lists, which are then merged into
+    a single graph, in the same order process_files would have read them.
+    :param n_jobs: number of processes, defaults to the number of cores.
+    :param parts_per_file: split each file in this many byte ranges,
+        so that big files can be read by several processes.
+    :param rejections: same as in process_files. Each process has a
+        RejectionLog of its own, which is merged into this one.
+    """
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    if rejections is None:
+        rejections = RejectionLog()
 
+    tasks = []
     for file_path in data_parser.find_files(source_folder, 0):
-        process_file(file_path, data_parser, interpreter_class, manager)
+        for byte_range in data_parser.split_file(file_path, parts_per_file):
+            tasks.append((file_path, byte_range))
+
+    results = Parallel(n_jobs=n_jobs)(
+        delayed(_extract_edges_and_rejections)(
+            file_path, data_parser, interpreter_class, batch_size, byte_range,
+            state_code, _task_quarantine_path(rejections, i))
+        for i, (file_path, byte_range) in enumerate(tasks))
+
+    manager = graph_manager()
+    for edges, task_rejections in results:
+        merge_edges(edges, manager)
+        rejections.merge(task_rejections)
+        task_quarantine = task_rejections.quarantine_path
+        if task_quarantine is not None and \
+                task_quarantine != rejections.quarantine_path and \
+                os.path.isfile(task_quarantine):
+            os.remove(task_quarantine)
 
-    # graph should be complete at this point
     if save_path is not None:
         manager.save_graph(save_path)
+        save_manifest(save_path, [file_path for file_path, _ in tasks])
 
+    rejections.close()
+    logging.warn(rejections.summary())
     return manager
 
-def process_file(file_path, data_parser, interpreter_class, graph):
+def _extract_edges_and_rejections(file_path, data_parser, interpreter_class,
+                                  batch_size, byte_range, state_code,
+                                  quarantine_path):
+    """ What each process of process_files_in_parallel does. """
+    rejections = RejectionLog(quarantine_path=quarantine_path)
+    edges = extract_edges(file_path, data_parser, interpreter_class,
+                          batch_size, byte_range, state_code, rejections)
+    rejections.close()
+    return edges, rejections
+
+def _task_quarantine_path(rejections, task_index):
+    if rejections.quarantine_path is None:
+        return None
+    return rejections.quarantine_path + "." + str(task_index)
+
+def process_files_by_state(source_folder, data_parser, interpreter_class,
+                           graph_manager, save_path, state_codes,
+                           batch_size=100000, max_buffered=1000000,
+                           spill_folder=None, rejections=None):
+    """
+    Builds one graph per state, reading each file only once. Lines are
+    routed by the beginning of their municipality to the partition of
+    their state, and each graph is only built after all files are read.
+    Graphs are built, saved and released one state at a time, so only one
+    of them is ever in memory.
+    :param save_path: path with a {}, replaced by each state code.
+    :param state_codes: such as ['43', '35'].
+    :param max_buffered: how many edges all partitions may keep in memory.
+        Past that, partitions are spilled to disk (see StatePartitions).
+    :param rejections: same as in process_files.
+    :return: dictionary of state code - path the graph was saved to
+    """
+    file_paths = list(data_parser.find_files(source_folder, 0))
+    partitions = StatePartitions(state_codes, max_buffered, spill_folder)
+    if rejections is None:
+        rejections = RejectionLog()
+    interpreter = Pis12BatchInterpreter(interpreter_class, rejections)
+    try:
+        for file_path in file_paths:
+            logging.warn("Started partitioning file " + file_path)
+            for batch in data_parser.batch_reader(
+                    file_path, 0, batch_size,
+                    line_filter=StateFilter(tuple(state_codes))):
+                interpreter.feed_batch(batch)
+                passing = batch_passes_filter(interpreter, None)
+                interpreter.select(passing)
+                partitions.add(dict(
+                    (state_code, select_edges(interpreter, passing &
+                        np.char.startswith(interpreter.municipality,
+                                           state_code)))
+                    for state_code in state_codes))
+
+        saved_paths = {}
+        for state_code in state_codes:
+            manager = graph_manager()
+            for edges in partitions.edges(state_code):
+                merge_edges(edges, manager)
+            state_path = save_path.format(state_code)
+            manager.save_graph(state_path)
+            save_manifest(state_path, file_paths)
+            saved_paths[state_code] = state_path
+            del manager
+            partitions.discard(state_code)
+        return saved_paths
+    finally:
+        partitions.close()
+        rejections.close()
+        logging.warn(rejections.summary())
+
+class StatePartitions(object):
+    """
+    Edge lists of several states, kept in the order they were added.
+    When there are too many edges in memory, the partitions that got no
+    edges lately are appended to their file on disk. If that is not
+    enough, every partition is.
+    """
+
+    def __init__(self, state_codes, max_buffered=1000000, folder=None):
+        self.max_buffered = max_buffered
+        self.folder = tempfile.mkdtemp(prefix="partitions_", dir=folder)
+        self.buffers = dict((state_code, []) for state_code in state_codes)
+        self.buffered = dict((state_code, 0) for state_code in state_codes)
+        self.spilled = dict((state_code, 0) for state_code in state_codes)
+
+    def add(self, edges_by_state):
+        """ :param edges_by_state: dictionary of state code - edges """
+        for state_code, edges in edges_by_state.iteritems():
+            if len(edges) > 0:
+                self.buffers[state_code].append(edges)
+                self.buffered[state_code] += len(edges)
+
+        if sum(self.buffered.itervalues()) > self.max_buffered:
+            for state_code in self.buffers:
+                if len(edges_by_state.get(state_code, ())) == 0:
+                    self.spill(state_code)
+        if sum(self.buffered.itervalues()) > self.max_buffered:
+            for state_code in self.buffers:
+                self.spill(state_code)
+
+    def spill(self, state_code):
+        if self.buffered[state_code] == 0:
+            return
+        with open(self._path(state_code), "ab") as spill_file:
+            for edges in self.buffers[state_code]:
+                edges.tofile(spill_file)
+        self.spilled[state_code] += self.buffered[state_code]
+        self.buffers[state_code] = []
+        self.buffered[state_code] = 0
+
+    def edges(self, state_code, chunk_size=1000000):
+        """ :return: a generator of the edge lists of a state, in order """
+        if self.spilled[state_code] > 0:
+            with open(self._path(state_code), "rb") as spill_file:
+                while True:
+                    edges = np.fromfile(spill_file, EDGE_DTYPE, chunk_size)
+                    if len(edges) == 0:
+                        break
+                    yield edges
+        for edges in self.buffers[state_code]:
+            yield edges
+
+    def discard(self, state_code):
+        """ Frees the edges of a state, once its graph is built."""
+        self.buffers[state_code] = []
+        self.buffered[state_code] = 0
+        if self.spilled[state_code] > 0:
+            os.remove(self._path(state_code))
+            self.spilled[state_code] = 0
+
+    def close(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def _path(self, state_code):
+        return os.path.join(self.folder, state_code + ".edges")
+
+def extract_edges(file_path, data_parser, interpreter_class, batch_size=100000,
+                  byte_range=None, state_code=DEFAULT_STATE_CODE,
+                  rejections=None):
+    """
+    Reads a file (or a byte range of it) into an edge list, without
+    building any graph.
+    :param rejections: same as in process_file.
+    :return: a numpy array of EDGE_DTYPE
+    """
+    logging.warn("Started extracting edges from " + file_path)
+    interpreter = Pis12BatchInterpreter(interpreter_class, rejections)
+    edge_lists = [np.empty(0, dtype=EDGE_DTYPE)]
+    for batch in data_parser.batch_reader(file_path, 0, batch_size,
+                                          byte_range,
+                                          state_filter(state_code)):
+        interpreter.feed_batch(batch)
+        edge_lists.append(batch_edges(interpreter, state_code))
+    return np.concatenate(edge_lists)
+
+def process_file(file_path, data_parser, interpreter_class, graph, batch_size=None,
+                 state_code=DEFAULT_STATE_CODE, rejections=None, cache=None):
     """
     :param graph: a graph/graph manager object, which will be changed
+    :param batch_size: if given, read the file in column batches of
+        this size (see Pis12DataParser.batch_reader) instead of line by line.
+    :param state_code: lines of other states are dropped while still raw,
+        before any parsing or interpretation. None keeps every state.
+    :param rejections: a RejectionLog for the interpreter, or None to have
+        one just for this file.
+    :param cache: a SpellCache. If given, the interpreted lines of the whole
+        file come from it, or are put in it, and are only filtered then.
+        Lines are not interpreted again on a hit, so they are not counted
+        as rejections either.
     """
-    interpreter = interpreter_class()
+    line_filter = state_filter(state_code)
     logging.warn("Started processing file " + file_path)
-    for line in data_parser.lines_reader(file_path, 0):
+    if cache is not None:
+        spells = cached_spells(file_path, data_parser, interpreter_class,
+                               cache, batch_size or 100000, rejections)
+        merge_edges(select_edges(spells, batch_passes_filter(spells,
+                                                             state_code)),
+                    graph)
+        return
+
+    if batch_size is not None:
+        # the row interpreter only handles unusual lines in this case
+        interpreter = Pis12BatchInterpreter(interpreter_class, rejections)
+        for batch in data_parser.batch_reader(file_path, 0, batch_size,
+                                              line_filter=line_filter):
+            process_batch(batch, interpreter, graph, state_code)
+        return
+
+    interpreter = interpreter_class(rejections)
+
+    for line in data_parser.lines_reader(file_path, 0,
+                                         line_filter=line_filter):
             parsed_line = data_parser.parse_line(line)
 
             # line is parsed as a dictionary, but needs interpretation.
             # This is because our data is wacky wacky!
             interpreter.feed_line(parsed_line)
-            process_line(interpreter, graph)
+            process_line(interpreter, graph, state_code)
+
+class InterpretedSpells(object):
+    """
+    The interpreted lines of a whole file, as columns. They read just like
+    a batch interpreter, so they can go through the same filters.
+    """
+    COLUMNS = ('worker_id', 'employer_id', 'year', 'municipality',
+               'admission_timestamp', 'demission_timestamp')
+
+    def __init__(self, columns):
+        """ :param columns: dictionary with an array for each of COLUMNS """
+        for name in self.COLUMNS:
+            setattr(self, name, columns[name])
+
+    def to_columns(self):
+        return dict((name, getattr(self, name)) for name in self.COLUMNS)
+
+def read_spells(file_path, data_parser, interpreter_class, batch_size=100000,
+                rejections=None):
+    """
+    Interprets every line of a file, without filtering any.
+    :return: InterpretedSpells
+    """
+    interpreter = Pis12BatchInterpreter(interpreter_class, rejections)
+    edge_lists = [np.empty(0, dtype=EDGE_DTYPE)]
+    municipalities = [np.empty(0, dtype='S1')]
+    for batch in data_parser.batch_reader(file_path, 0, batch_size):
+        interpreter.feed_batch(batch)
+        edge_lists.append(select_edges(interpreter,
+                                       np.ones(interpreter.size, dtype=bool)))
+        municipalities.append(interpreter.municipality)
+
+    edges = np.concatenate(edge_lists)
+    columns = dict((name, edges[name]) for name in EDGE_DTYPE.names)
+    columns['municipality'] = np.concatenate(municipalities)
+    return InterpretedSpells(columns)
+
+def spell_version(interpreter_class):
+    """
+    :return: what tells us cached spells were interpreted by the same rules
+    """
+    return [interpreter_class.__name__, getattr(interpreter_class, "VERSION", 0),
+            Pis12BatchInterpreter.VERSION]
+
+def cached_spells(file_path, data_parser, interpreter_class, cache,
+                  batch_size=100000, rejections=None):
+    """
+    Same as read_spells, but only reads the file if cache does not have it.
+    """
+    version = spell_version(interpreter_class)
+    columns = cache.get(file_path, version)
+    if columns is not None:
+        return InterpretedSpells(columns)
 
-def process_line(interpreter, graph):
+    spells = read_spells(file_path, data_parser, interpreter_class,
+                         batch_size, rejections)
+    cache.put(file_path, version, spells.to_columns())
+    return spells
 
-    if passes_filter(interpreter):
+def process_batch(batch, interpreter, graph, state_code=DEFAULT_STATE_CODE):
+    """
+    :param batch: a dictionary of column arrays, as yielded by
+        Pis12DataParser.batch_reader
+    :param interpreter: a batch interpreter, such as Pis12BatchInterpreter
+    """
+    interpreter.feed_batch(batch)
+    merge_edges(batch_edges(interpreter, state_code), graph)
+
+def batch_edges(interpreter, state_code=DEFAULT_STATE_CODE):
+    """
+    :param interpreter: a batch interpreter, already fed with a batch.
+    :return: the lines that pass the filter, as an array of EDGE_DTYPE
+    """
+    passing = batch_passes_filter(interpreter, state_code)
+    interpreter.select(passing)
+    return select_edges(interpreter, passing)
+
+def select_edges(interpreter, passing):
+    """
+    :param passing: boolean array, the lines of the batch we want
+    :return: those lines, as an array of EDGE_DTYPE
+    """
+    edges = np.empty(np.count_nonzero(passing), dtype=EDGE_DTYPE)
+    edges['worker_id'] = interpreter.worker_id[passing]
+    edges['employer_id'] = interpreter.employer_id[passing]
+    edges['year'] = interpreter.year[passing]
+    edges['admission_timestamp'] = interpreter.admission_timestamp[passing]
+    edges['demission_timestamp'] = interpreter.demission_timestamp[passing]
+    return edges
+
+def merge_edges(edges, graph):
+    """
+    Adds an edge list (see batch_edges) to a graph, in order: nodes, edges
+    and spells end up just like insert_nodes and insert_edge would have
+    left them, line by line. The graph has to take bulk additions, such
+    as SnapManager.
+    """
+    # each line adds its worker, then its employer
+    node_ids = np.column_stack((edges['worker_id'],
+                                edges['employer_id'])).ravel()
+    type_codes = np.tile([NODE_TYPES.index("worker"),
+                          NODE_TYPES.index("employer")], len(edges))
+    graph.add_nodes(node_ids, type_codes)
+
+    EIds = graph.add_edges(edges['worker_id'], edges['employer_id'])
+    graph.add_edge_spells(EIds, edges['year'], edges['admission_timestamp'],
+                          edges['demission_timestamp'])
+
+def process_line(interpreter, graph, state_code=DEFAULT_STATE_CODE):
+
+    if passes_filter(interpreter, state_code):
         create_nodes(interpreter, graph)
         create_edges(interpreter, graph)
 
-def passes_filter(interpreter):
+def state_filter(state_code):
+    """ :return: a raw line filter for a state, or None for every state """
+    return None if state_code is None else StateFilter(state_code)
+
+def passes_filter(interpreter, state_code=DEFAULT_STATE_CODE):
     """
     Checks if the interpreted data is good enough to be considered
+    :param state_code: prefix of the municipalities we keep, None for all.
     :return: true or false
     """
     # contains worker_id rule
@@ -58,40 +548,58 @@ def passes_filter(interpreter):
 
     # single state rule
     # just process a single state, derived from municipality
-    # TODO: one of these days, don't hard code it...
-    # 43 is Rio Grande do Sul...
-    if len(interpreter.municipality) < 2 or \
-        interpreter.municipality[:2] <> '43':
+    if state_code is not None and \
+        not interpreter.municipality.startswith(state_code):
             return False
 
     # finally...
     return True
 
+def batch_passes_filter(interpreter, state_code=DEFAULT_STATE_CODE):
+    """
+    Same as passes_filter, for a batch interpreter.
+    :return: a boolean array
+    """
+    passing = (interpreter.worker_id != -1) & \
+        (interpreter.employer_id != -1) & \
+        (interpreter.year != -1)
+    if state_code is not None:
+        passing &= np.char.startswith(interpreter.municipality, state_code)
+    return passing
+
 def create_nodes(interpreter, graph):
+    insert_nodes(graph, interpreter.worker_id, interpreter.employer_id)
+
+def create_edges(interpreter, graph):
+    insert_edge(graph, interpreter.worker_id, interpreter.employer_id,
+                interpreter.year, interpreter.admission_timestamp,
+                interpreter.demission_timestamp)
+
+def insert_nodes(graph, worker_id, employer_id):
 
     # add worker node and a 'worker' property
-    node_id = graph.add_node(interpreter.worker_id)
+    node_id = graph.add_node(worker_id)
     graph.add_node_attr(node_id, "type", "worker")
 
     # add employer node and a 'employer' property
-    node_id = graph.add_node(interpreter.employer_id)
+    node_id = graph.add_node(employer_id)
     graph.add_node_attr(node_id, "type", "employer")
 
-def create_edges(interpreter, graph):
+def insert_edge(graph, worker_id, employer_id, year,
+                admission_timestamp, demission_timestamp):
     # add values as edge attributes
-    src_node_id = interpreter.worker_id
-    dest_node_id = interpreter.employer_id
+    src_node_id = worker_id
+    dest_node_id = employer_id
 
     # here we guarantee that there will be only 1 edge per pair of nodes.
     edge_id = graph.get_edge_between(src_node_id, dest_node_id)
     if edge_id is None:
         edge_id = graph.add_edge(src_node_id, dest_node_id)
 
-    year = interpreter.year
     graph.add_edge_attr(edge_id, str(year) + "_admission_date",
-                        interpreter.admission_timestamp)
+                        admission_timestamp)
     graph.add_edge_attr(edge_id, str(year) + "_demission_date",
-                        interpreter.demission_timestamp)
+                        demission_timestamp)
 
     # We should add more edge attributes here as they are needed.
 
@@ -101,15 +609,43 @@ def enable_logging(log_level):
     level=log_level)
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--resume", action="store_true",
+                            help="continue from the last checkpoint")
+    arg_parser.add_argument("--cache",
+                            help="folder to keep interpreted files in, so "
+                                 "that unchanged files are not read again")
+    arg_parser.add_argument("--states", nargs="+",
+                            help="build one graph per state, in a single "
+                                 "pass over the files")
+    args = arg_parser.parse_args()
+
     enable_logging(logging.WARNING)
     source_folder = "c:/csv_data/"
     output_file_path = "../output_graphs/rs_affiliation.graph"
+    checkpoint = Checkpoint(output_file_path.replace(".graph", "_checkpoint"),
+                            every=1)
+    rejections = RejectionLog(quarantine_path=output_file_path.replace(
+        ".graph", "_quarantine.tsv"))
 
-
-    process_files(source_folder,
-                  data_parser.Pis12DataParser(),
-                  data_parser.Pis12DataInterpreter,
-                  graph_manager.SnapManager,
-                  output_file_path)
+    if args.states:
+        process_files_by_state(source_folder,
+                               data_parser.Pis12DataParser(),
+                               data_parser.Pis12DataInterpreter,
+                               graph_manager.SnapManager,
+                               "../output_graphs/{}_affiliation.graph",
+                               args.states,
+                               rejections=rejections)
+    else:
+        process_files(source_folder,
+                      data_parser.Pis12DataParser(),
+                      data_parser.Pis12DataInterpreter,
+                      graph_manager.SnapManager,
+                      output_file_path,
+                      checkpoint=checkpoint,
+                      resume=args.resume,
+                      state_code=Config().get_state_code(),
+                      rejections=rejections,
+                      cache=SpellCache(args.cache) if args.cache else None)
 
     logging.warn("Finished!")
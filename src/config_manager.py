@@ -1,3 +1,8 @@
+import os
+
+# 43 is Rio Grande do Sul
+DEFAULT_STATE_CODE = "43"
+
 #TODO: upgrade to some configuration/environment helper library
 class Config(object):
 
@@ -7,6 +12,7 @@ class Config(object):
 
         self.data_path = None
         self.image_output_path = None
+        self.state_code = DEFAULT_STATE_CODE
         self.__setup_environment()
 
     def get_data_path(self):
@@ -15,7 +21,15 @@ class Config(object):
     def get_image_output_path(self):
         return self.image_output_path
 
+    def get_state_code(self):
+        """ :return: prefix of the municipality codes we keep """
+        return self.state_code
+
     def __setup_environment(self):
+        # without an environment file, we stick to the defaults
+        if not os.path.isfile(self.config_file_path + "/environment.txt"):
+            return
+
         f = open(self.config_file_path + "/environment.txt")
         for line in f:
             split_line = line.split("=")
@@ -23,5 +37,7 @@ class Config(object):
                 self.data_path =  split_line[1].rstrip()
             if split_line[0] == "image_output_path":
                 self.image_output_path = split_line[1].rstrip()
+            if split_line[0] == "state_code":
+                self.state_code = split_line[1].rstrip()
 
 
@@ -1,13 +1,267 @@
+import os
+import argparse
 import datetime
 import logging
-from graph_manager import SnapManager
+import gzip
+import heapq
+import itertools
+import multiprocessing
+import numpy as np
+from collections import defaultdict
+from joblib import Parallel, delayed
+from graph_manager import SnapManager, GraphView, NODE_TYPES, Checkpoint
+from graph_storage import ExternalSorter, write_snapshot, read_snapshot
+
+# we only look at spells in these years
+FIRST_YEAR = 1981
+LAST_YEAR = 2016
+
+# get_overlapping_days rounds, so spells that are up to half a day
+# apart still give us 1 day together.
+OVERLAP_SLACK = 12 * 60 * 60
+
+# roughly what a pair of coworkers takes while we find its days together:
+# sweep_overlaps keeps a tuple, two integers and a float in a dictionary.
+PAIR_BYTES = 200
 
 def get_worker_iterator(affiliation_graph):
-    node_iterator = affiliation_graph.get_node_iterator()
-    for node in node_iterator:
-        node_type = affiliation_graph.get_node_attr(node, "type")
-        if node_type == "worker":
-            yield node
+    # node types are kept in an array, no need to ask SNAP about each node
+    return affiliation_graph.iter_workers()
+
+
+def get_employer_iterator(affiliation_graph):
+    return affiliation_graph.iter_employers()
+
+
+def get_employer_spells(affiliation_graph, employer):
+    """
+    :return: (workers, spells), the workers of employer and their
+        (years, admissions, demissions) spells there.
+    """
+    workers = affiliation_graph.get_neighboring_nodes(employer)
+    spells = []
+    for worker in workers:
+        edge = affiliation_graph.get_edge_between(worker, employer)
+        spells.append(affiliation_graph.get_edge_spells(edge))
+    return workers, spells
+
+
+def sweep_overlaps(workers, spells):
+    """
+    Days each pair of coworkers spent together at an employer, the same
+    as get_spell_time_together gives us, but without looking at every pair.
+    For each year, spells are sorted by admission and we sweep over them,
+    keeping the spells that have not ended yet. Only those can overlap
+    the spells that come next.
+    :param workers: list of worker ids
+    :param spells: (years, admissions, demissions) of each worker
+    :return: dictionary of (worker, coworker) - days together, where
+        worker < coworker. Pairs with no days together are left out.
+    """
+    if len(workers) < 2:
+        return {}
+
+    owners = np.repeat(np.arange(len(workers)),
+                       [len(years) for years, _, _ in spells])
+    years = np.concatenate([years for years, _, _ in spells])
+    starts = np.concatenate([starts for _, starts, _ in spells])
+    ends = np.concatenate([ends for _, _, ends in spells])
+
+    # spells with no dates, or that end before they start,
+    # never give us any days together
+    keep = (years >= FIRST_YEAR) & (years <= LAST_YEAR) & \
+        ~np.isnan(starts) & ~np.isnan(ends) & (ends - starts >= -OVERLAP_SLACK)
+    order = np.lexsort((starts[keep], years[keep]))
+    owners = owners[keep][order].tolist()
+    years = years[keep][order].tolist()
+    starts = starts[keep][order].tolist()
+    ends = ends[keep][order].tolist()
+
+    pair_days = defaultdict(float)
+    active = []  # heap of (demission, admission, owner)
+    current_year = None
+    for owner, year, start, end in itertools.izip(owners, years, starts, ends):
+        if year != current_year:
+            active = []
+            current_year = year
+
+        # whatever ended before this spell started is done for good
+        while active and active[0][0] < start - OVERLAP_SLACK:
+            heapq.heappop(active)
+
+        worker = workers[owner]
+        for other_end, other_start, other in active:
+            days = get_overlapping_days(start, end, other_start, other_end)
+            if days > 0:
+                coworker = workers[other]
+                pair = (worker, coworker) if worker < coworker \
+                    else (coworker, worker)
+                pair_days[pair] += days
+
+        heapq.heappush(active, (end, start, owner))
+
+    return pair_days
+
+
+def iter_overlaps(workers, spells, chunk_size=1000000):
+    """
+    Same as sweep_overlaps, around chunk_size pairs at a time, so that big
+    employers never need all of their pairs in memory.
+    Employers with up to chunk_size pairs are swept. Bigger ones are done
+    a block of rows of the upper triangle of their sorted workers at a
+    time: the days together of each year are added up in a dense block,
+    with numpy.
+    :param workers: list of worker NIds, see pack_pairs
+    :param spells: (years, admissions, demissions) of each worker
+    :return: a generator of (packed pairs, days together) arrays. Pairs
+        with no days together are left out.
+    """
+    num_workers = len(workers)
+    if num_workers * (num_workers - 1) // 2 <= chunk_size:
+        pair_days = sweep_overlaps(workers, spells)
+        if pair_days:
+            yield (pack_pairs(pair_days.iterkeys()),
+                   np.fromiter(pair_days.itervalues(), dtype=np.float64,
+                               count=len(pair_days)))
+        return
+
+    NIds = np.asarray(workers, dtype=np.int64)
+    order = np.argsort(NIds, kind='mergesort')
+    sorted_NIds = NIds[order]
+    positions = np.empty(num_workers, dtype=np.int64)
+    positions[order] = np.arange(num_workers)
+
+    owners = np.repeat(positions, [len(years) for years, _, _ in spells])
+    years = np.concatenate([years for years, _, _ in spells])
+    starts = np.concatenate([starts for _, starts, _ in spells])
+    ends = np.concatenate([ends for _, _, ends in spells])
+
+    # the same spells sweep_overlaps keeps, grouped by year
+    keep = (years >= FIRST_YEAR) & (years <= LAST_YEAR) & \
+        ~np.isnan(starts) & ~np.isnan(ends) & (ends - starts >= -OVERLAP_SLACK)
+    by_year = np.argsort(years[keep], kind='mergesort')
+    years = years[keep][by_year]
+    owners = owners[keep][by_year]
+    starts = starts[keep][by_year]
+    ends = ends[keep][by_year]
+    new_years = np.flatnonzero(np.diff(years)) + 1
+    year_groups = zip(np.split(owners, new_years),
+                      np.split(starts, new_years),
+                      np.split(ends, new_years))
+
+    block_rows = max(chunk_size // num_workers, 1)
+    for first_row in xrange(0, num_workers - 1, block_rows):
+        last_row = min(first_row + block_rows, num_workers)
+        block = np.zeros((last_row - first_row) * num_workers)
+        for year_owners, year_starts, year_ends in year_groups:
+            rows = (year_owners >= first_row) & (year_owners < last_row)
+            if not rows.any():
+                continue
+            row_owners = year_owners[rows]
+            days = overlapping_days(year_starts[rows][:, np.newaxis],
+                                    year_ends[rows][:, np.newaxis],
+                                    year_starts, year_ends)
+            # each pair once, from the worker that comes first
+            days[year_owners <= row_owners[:, np.newaxis]] = 0
+            cells = (row_owners[:, np.newaxis] - first_row) * num_workers + \
+                year_owners
+            block += np.bincount(cells.ravel(), days.ravel(), len(block))
+
+        cells = np.flatnonzero(block)
+        yield ((sorted_NIds[first_row + cells // num_workers] << 32) |
+               sorted_NIds[cells % num_workers], block[cells])
+
+
+def partition_employers(sizes, num_parts, strategy="size"):
+    """
+    Splits employers among num_parts processes.
+    :param sizes: number of workers of each employer
+    :param strategy: "size" gives the biggest employers out first, each one
+        to the least loaded part, as the number of pairs grows with the
+        square of the size. "round_robin" just deals them out in order.
+    :return: list of num_parts arrays of indexes into sizes
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    if strategy == "round_robin":
+        return [np.arange(part, len(sizes), num_parts)
+                for part in xrange(num_parts)]
+
+    if strategy != "size":
+        raise ValueError("Unknown partitioning strategy " + str(strategy))
+
+    parts = [[] for _ in xrange(num_parts)]
+    loads = [(0, part) for part in xrange(num_parts)]
+    costs = sizes * sizes
+    for index in np.argsort(-costs, kind='mergesort').tolist():
+        load, part = heapq.heappop(loads)
+        parts[part].append(index)
+        heapq.heappush(loads, (load + costs[index], part))
+    return [np.array(sorted(part), dtype=np.int64) for part in parts]
+
+
+def connect_partition(graph_path, employer_NIds, min_days_together):
+    """
+    Runs in a separate process: finds the coworker pairs of some employers.
+    The affiliation graph is opened as a GraphView, so all processes
+    share the same pages.
+    :return: int64 array of pairs of worker NIds, packed as
+        (smaller NId << 32) | bigger NId
+    """
+    view = GraphView().load_graph(graph_path)
+    connector = WorkerConnector()
+    connector.min_days_together = min_days_together
+
+    pair_lists = [np.empty(0, dtype=np.int64)]
+    for NId in employer_NIds.tolist():
+        start, end = view.offsets[NId], view.offsets[NId + 1]
+        workers = view.neighbors[start:end].tolist()
+        spells = [view.get_edge_spells(EId)
+                  for EId in view.edges[start:end].tolist()]
+        pair_lists.extend(connector.get_coworker_pair_chunks(workers, spells))
+
+    # a pair may work together at several employers
+    return np.unique(np.concatenate(pair_lists))
+
+
+def pack_pairs(pairs):
+    """
+    :param pairs: (NId, NId) tuples
+    :return: int64 array with (smaller NId << 32) | bigger NId for each pair
+    """
+    pairs = np.array(list(pairs), dtype=np.int64).reshape(-1, 2)
+    return (pairs.min(axis=1) << 32) | pairs.max(axis=1)
+
+
+def unpack_pairs(packed):
+    """ :return: (NIds, NIds) arrays, the inverse of pack_pairs"""
+    return packed >> 32, packed & 0xFFFFFFFF
+
+
+def iter_packed_pairs(NIds, chunk_size=1000000):
+    """
+    Every pair of NIds, packed as pack_pairs does, like
+    itertools.combinations(sorted(NIds), 2) but built with numpy, around
+    chunk_size pairs at a time, so big employers never need all of their
+    pairs in memory.
+    :return: a generator of int64 arrays, in increasing order
+    """
+    NIds = np.sort(np.asarray(NIds, dtype=np.int64))
+    num_ids = len(NIds)
+    # row i of the upper triangle pairs NIds[i] with every NId after it
+    row_sizes = num_ids - 1 - np.arange(num_ids)
+    row_ends = np.cumsum(row_sizes)
+    start = 0
+    done = 0
+    while start < num_ids - 1:
+        stop = max(start + 1,
+                   int(np.searchsorted(row_ends, done + chunk_size, 'right')))
+        sizes = row_sizes[start:stop]
+        rows = np.repeat(np.arange(start, stop), sizes)
+        firsts = np.repeat(np.cumsum(sizes) - sizes, sizes)
+        columns = rows + 1 + np.arange(len(rows)) - firsts
+        yield (NIds[rows] << 32) | NIds[columns]
+        done = int(row_ends[stop - 1])
+        start = stop
 
 
 def get_overlapping_days(start_1, end_1, start_2, end_2):
@@ -34,6 +288,13 @@ def from_timestamp(timestamp):
     return converted
 
 
+def get_sink(new_graph):
+    """ :return: new_graph as an EdgeSink"""
+    if isinstance(new_graph, EdgeSink):
+        return new_graph
+    return SnapManagerSink(new_graph)
+
+
 def should_skip(worker, coworker, new_graph):
     # no need to connect someone with oneself...
     if worker == coworker:
@@ -47,6 +308,191 @@ def should_skip(worker, coworker, new_graph):
     return  False
 
 
+class EdgeSink(object):
+    """
+    Where WorkerConnector puts the connected graph. Edges come in as
+    two lists of worker ids, for speed.
+    """
+
+    def add_worker(self, affiliation_graph, worker):
+        """ Called once for every worker, connected or not."""
+        pass
+
+    def add_edges(self, workers, coworkers):
+        raise NotImplementedError()
+
+    def close(self):
+        """ :return: whatever the connector should return."""
+        return self
+
+
+class SnapManagerSink(EdgeSink):
+    """ Builds a SnapManager, which is what we do by default. """
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def add_worker(self, affiliation_graph, worker):
+        affiliation_graph.copy_node(worker, self.graph)
+
+    def add_edges(self, workers, coworkers):
+        graph = self.graph
+        for worker, coworker in itertools.izip(workers, coworkers):
+            graph.add_node(worker)
+            graph.add_node(coworker)
+            graph.add_edge(worker, coworker)
+
+    def close(self):
+        return self.graph
+
+
+class EdgeListWriter(EdgeSink):
+    """
+    Writes edges to a file, in blocks, so memory use does not depend on
+    the number of edges. Edges are written as they come: only the parallel
+    and out of core connectors guarantee each pair shows up once.
+    Workers with no edges are not in the file.
+    """
+
+    def __init__(self, file_path, binary=False, compress=False,
+                 block_size=1000000, append=False):
+        """
+        :param binary: write pairs of little endian int64 instead of
+            "worker<tab>coworker" lines.
+        :param compress: gzip the file.
+        :param block_size: number of edges we buffer before writing.
+        :param append: add to the edges already in the file, instead of
+            starting over, as connect_workers_incrementally needs.
+            A compressed file gets a new gzip member, which readers
+            take as more of the same file.
+        """
+        self.file_path = file_path
+        self.binary = binary
+        self.block_size = block_size
+        self.append = append
+        mode = 'ab' if append else 'wb'
+        if compress:
+            self.out = gzip.open(file_path, mode)
+        else:
+            self.out = open(file_path, mode)
+        self.buffer = []
+        self.buffered = 0
+        self.edge_count = 0
+
+    def add_edges(self, workers, coworkers):
+        self.buffer.append(np.column_stack([np.asarray(workers, dtype='<i8'),
+                                            np.asarray(coworkers, dtype='<i8')]))
+        self.buffered += len(workers)
+        if self.buffered >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+
+        block = np.concatenate(self.buffer)
+        if self.binary:
+            self.out.write(block.tobytes())
+        else:
+            np.savetxt(self.out, block, fmt='%d', delimiter='\t')
+        self.edge_count += len(block)
+        self.buffer = []
+        self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.out.close()
+        return self
+
+
+def read_edge_list(file_path, binary=False, compress=False):
+    """
+    Reads what an EdgeListWriter wrote.
+    :return: (workers, coworkers) int64 arrays
+    """
+    src = gzip.open(file_path, 'rb') if compress else open(file_path, 'rb')
+    with src:
+        if binary:
+            edges = np.frombuffer(src.read(), dtype='<i8')
+        else:
+            edges = np.loadtxt(src, dtype=np.int64, ndmin=2)
+    edges = edges.reshape(-1, 2)
+    return edges[:, 0].copy(), edges[:, 1].copy()
+
+
+class WeightedEdges(object):
+    """
+    Every pair of workers who shared an employer, with the most days they
+    spent together at a single employer. A pair gets connected for a given
+    min_days_together exactly when its weight reaches it, so one of these
+    gives us the connected graph for any threshold.
+    """
+
+    def __init__(self, workers, coworkers, weights, all_workers):
+        """
+        :param workers, coworkers: int64 arrays of worker ids
+        :param weights: int32 array of days together
+        :param all_workers: int64 array with every worker id, connected or not
+        """
+        self.workers = workers
+        self.coworkers = coworkers
+        self.weights = weights
+        self.all_workers = all_workers
+
+    def __len__(self):
+        return len(self.weights)
+
+    def threshold(self, min_days):
+        """ :return: (workers, coworkers) connected for min_days"""
+        reached = self.weights >= min_days
+        return self.workers[reached], self.coworkers[reached]
+
+    def connect(self, min_days, new_graph, affiliation_graph=None):
+        """
+        Fills new_graph as connect_workers would with that min_days.
+        :param new_graph: a SnapManager, or any EdgeSink.
+        :param affiliation_graph: we copy worker attributes from it.
+            Without it, workers only get a node.
+        """
+        sink = get_sink(new_graph)
+        for worker in self.all_workers.tolist():
+            if affiliation_graph is not None:
+                sink.add_worker(affiliation_graph, worker)
+            elif isinstance(sink, SnapManagerSink):
+                sink.graph.add_node(worker)
+
+        workers, coworkers = self.threshold(min_days)
+        sink.add_edges(workers.tolist(), coworkers.tolist())
+        return sink.close()
+
+    def save(self, file_path):
+        write_snapshot(file_path, {'workers': self.workers,
+                                   'coworkers': self.coworkers,
+                                   'weights': self.weights,
+                                   'all_workers': self.all_workers})
+
+    @classmethod
+    def load(cls, file_path):
+        _, sections = read_snapshot(file_path)
+        return cls(sections['workers'], sections['coworkers'],
+                   sections['weights'], sections['all_workers'])
+
+
+def max_per_pair(pairs, weights):
+    """
+    :param pairs: packed pairs, which may repeat
+    :return: (unique pairs, the biggest weight of each)
+    """
+    order = np.lexsort((weights, pairs))
+    pairs = pairs[order]
+    weights = weights[order]
+
+    # sorted by weight within each pair, so we keep the last one
+    last = np.ones(len(pairs), dtype=bool)
+    last[:-1] = pairs[1:] != pairs[:-1]
+    return pairs[last], weights[last]
+
+
 class WorkerConnector(object):
     def __init__(self):
         # defaults allows workers with 0 days in common to be connected.
@@ -83,7 +529,7 @@ class WorkerConnector(object):
 
             for employer in employer_nodes:
                 worker_edge = affiliation_graph.get_edge_between(worker, employer)
-                worker_edge_attrs = affiliation_graph.get_edge_attrs(worker_edge)
+                worker_spells = affiliation_graph.get_edge_spells(worker_edge)
 
                 for coworker in affiliation_graph.get_neighboring_nodes(employer):
 
@@ -92,36 +538,296 @@ class WorkerConnector(object):
                         continue
 
                     coworker_edge = affiliation_graph.get_edge_between(coworker, employer)
-                    coworker_edge_attrs = affiliation_graph.get_edge_attrs(coworker_edge)
+                    coworker_spells = affiliation_graph.get_edge_spells(coworker_edge)
 
-                    if self.should_connect(worker_edge_attrs, coworker_edge_attrs):
+                    if self.should_connect(worker_spells, coworker_spells):
                         new_graph.add_node(coworker)
                         new_graph.add_edge(worker, coworker)
                         # TODO: maybe put time together in the attr?
                         # TODO: maybe put in some other attrs?
 
-                # this worker-employer edge will never be examined again
-                # and we are running out of memory, so we might as well
-                # nuke the worker_edge_attr from memory. We just set it to None..
-                affiliation_graph.attrs_from_edge[worker_edge] = None
-
         return new_graph
 
-    def should_connect(self, worker_edge_attrs, coworker_edge_attrs):
-        # although less general, receiving attributes as parameters
-        # allows us to call get_edge_attrs almost half the number of times...
-        # TODO, make worker_edge attrs a class property or something...
+    def connect_workers_by_employer(self, affiliation_graph, new_graph,
+                                    checkpoint=None, resume=False):
+        """
+        Gives us the same edges as connect_workers, but goes over each
+        employer once instead of once per worker, and sweeps over its
+        spells instead of checking every pair of coworkers.
+        :param new_graph: a SnapManager, or any EdgeSink.
+        :param checkpoint: a Checkpoint, which gets a tick after every
+            employer. new_graph must be a SnapManager then.
+        :param resume: start from the last checkpoint, if there is one,
+            instead of new_graph, skipping the employers it already has.
+        :return: the connected graph, which is not new_graph if we resumed.
+        """
+        sink = get_sink(new_graph)
+        if checkpoint is not None and not isinstance(sink, SnapManagerSink):
+            raise ValueError("Only SnapManager graphs can be checkpointed")
+
+        done_employers = 0
+        if resume and checkpoint is not None:
+            graph, cursor = checkpoint.load()
+            if graph is not None:
+                sink = SnapManagerSink(graph)
+                done_employers = cursor["employers"]
+
+        # every worker is in the new graph, connected or not
+        if done_employers == 0:
+            for worker in get_worker_iterator(affiliation_graph):
+                sink.add_worker(affiliation_graph, worker)
+
+        progress_counter = done_employers - 1
+        employers = itertools.islice(get_employer_iterator(affiliation_graph),
+                                     done_employers, None)
+        for employer in employers:
 
-        time_together = self.get_time_together(worker_edge_attrs,
-                                               coworker_edge_attrs,
-                                               self.min_days_together)
+            # log every once in a while
+            progress_counter += 1
+            if progress_counter % 1000 == 0:
+                logging.warn("Processed " + str(progress_counter) + " employers.")
+
+            workers, spells = get_employer_spells(affiliation_graph, employer)
+            pairs = list(self.get_coworker_pairs(workers, spells))
+            sink.add_edges([pair[0] for pair in pairs],
+                           [pair[1] for pair in pairs])
+
+            if checkpoint is not None:
+                checkpoint.tick(sink.graph,
+                                {"employers": progress_counter + 1})
+
+        return sink.close()
+
+    def connect_workers_incrementally(self, affiliation_graph, new_graph,
+                                      employers):
+        """
+        Patches new_graph, which we connected before affiliation_graph
+        got new data (see build_affiliation_graph.update_graph).
+        Only the employers with new edges or spells are swept again. As data
+        only gets added, days together only grow, so we just add the pairs
+        that now reach min_days_together. Pairs already connected stay so.
+        :param employers: ids of the employers that got new data
+        :param new_graph: a SnapManager, or any EdgeSink. An EdgeListWriter
+            must be opened with append=True, or we would lose the edges
+            already in its file. Pairs that were already connected may be
+            written again.
+        """
+        sink = get_sink(new_graph)
+        if isinstance(sink, EdgeListWriter) and not sink.append:
+            raise ValueError("Open " + sink.file_path + " with append=True, "
+                             "or its edges would be lost")
+        for employer in employers:
+            workers, spells = get_employer_spells(affiliation_graph, employer)
+
+            # new workers show up at some employer that got new data
+            for worker in workers:
+                sink.add_worker(affiliation_graph, worker)
+
+            pairs = list(self.get_coworker_pairs(workers, spells))
+            sink.add_edges([pair[0] for pair in pairs],
+                           [pair[1] for pair in pairs])
+
+        return sink.close()
+
+    def connect_workers_in_parallel(self, graph_path, new_graph, n_jobs=None,
+                                    partitioning="size"):
+        """
+        Same as connect_workers_by_employer, but employers are split
+        among processes, which hand back their pairs of coworkers.
+        :param graph_path: where the affiliation graph was saved
+            (see SnapManager.save_graph).
+        :param n_jobs: number of processes, defaults to the number of cores.
+        :param partitioning: how to split employers, see partition_employers.
+        :param new_graph: a SnapManager, or any EdgeSink.
+        """
+        sink = get_sink(new_graph)
+        if n_jobs is None:
+            n_jobs = multiprocessing.cpu_count()
+
+        view = GraphView().load_graph(graph_path)
+        employer_NIds = np.flatnonzero(
+            view.node_types == NODE_TYPES.index("employer"))
+        sizes = view.offsets[employer_NIds + 1] - view.offsets[employer_NIds]
+        parts = partition_employers(sizes, n_jobs, partitioning)
+
+        pair_lists = Parallel(n_jobs=n_jobs)(
+            delayed(connect_partition)(graph_path, employer_NIds[part],
+                                       self.min_days_together)
+            for part in parts)
+        pairs = np.unique(np.concatenate(pair_lists))
+        logging.warn("Found " + str(len(pairs)) + " pairs of coworkers.")
+
+        # every worker is in the new graph, connected or not
+        for worker in get_worker_iterator(view):
+            sink.add_worker(view, worker)
+
+        self.add_pairs(view, pairs, sink)
+        return sink.close()
+
+    def connect_workers_out_of_core(self, affiliation_graph, new_graph,
+                                    memory_budget=2 ** 28, run_folder=None):
+        """
+        Same as connect_workers_by_employer, for when the pairs of coworkers
+        don't fit in memory. Pairs are spilled to sorted run files, which
+        are merged, without duplicates, into new_graph at the end.
+        :param memory_budget: bytes we may use for pairs of coworkers: half
+            of it buffers pairs for the run files, the other half goes to
+            the pairs of the employer at hand (see PAIR_BYTES).
+        :param run_folder: where run files go, defaults to the system
+            temporary folder.
+        :param new_graph: a SnapManager, or any EdgeSink.
+        """
+        sink = get_sink(new_graph)
+        sorter = ExternalSorter(memory_budget // 2, run_folder)
+        chunk_size = max(memory_budget // 2 // PAIR_BYTES, 1)
+        try:
+            progress_counter = -1
+            for employer in get_employer_iterator(affiliation_graph):
+
+                # log every once in a while
+                progress_counter += 1
+                if progress_counter % 1000 == 0:
+                    logging.warn("Processed " + str(progress_counter) +
+                                 " employers, " + str(len(sorter.runs)) +
+                                 " runs so far.")
+
+                workers, spells = get_employer_spells(affiliation_graph,
+                                                      employer)
+                NIds = affiliation_graph.node_ids.NIds(workers).tolist()
+
+                # big employers have more pairs than our budget
+                for pairs in self.get_coworker_pair_chunks(NIds, spells,
+                                                           chunk_size):
+                    sorter.add(pairs)
+
+            # every worker is in the new graph, connected or not
+            for worker in get_worker_iterator(affiliation_graph):
+                sink.add_worker(affiliation_graph, worker)
+
+            for pairs in sorter.merged():
+                self.add_pairs(affiliation_graph, pairs, sink)
+        finally:
+            sorter.close()
+
+        return sink.close()
+
+    @staticmethod
+    def add_pairs(affiliation_graph, pairs, sink):
+        """
+        :param pairs: packed pairs of NIds of affiliation_graph,
+            see pack_pairs.
+        """
+        NIds, other_NIds = unpack_pairs(pairs)
+        sink.add_edges(affiliation_graph.node_ids.ids(NIds).tolist(),
+                       affiliation_graph.node_ids.ids(other_NIds).tolist())
+
+    def get_weighted_edges(self, affiliation_graph, max_buffered=10000000,
+                           chunk_size=1000000):
+        """
+        Goes over every employer once, and finds the days together of all
+        pairs of coworkers, whatever min_days_together is.
+        :param max_buffered: number of pairs we keep around before we
+            drop repeated ones.
+        :param chunk_size: pairs of an employer are made this many at a time
+        :return: WeightedEdges
+        """
+        pair_lists = [np.empty(0, dtype=np.int64)]
+        weight_lists = [np.empty(0, dtype=np.int32)]
+        buffered = 0
+
+        progress_counter = -1
+        for employer in get_employer_iterator(affiliation_graph):
+
+            # log every once in a while
+            progress_counter += 1
+            if progress_counter % 1000 == 0:
+                logging.warn("Processed " + str(progress_counter) + " employers.")
+
+            workers, spells = get_employer_spells(affiliation_graph, employer)
+            NIds = affiliation_graph.node_ids.NIds(workers).tolist()
+            pair_days = sweep_overlaps(NIds, spells)
+            overlapping = pack_pairs(pair_days.iterkeys())
+            overlap_days = np.fromiter(pair_days.itervalues(), dtype=np.float64,
+                                       count=len(pair_days))
+            order = np.argsort(overlapping)
+            overlapping = overlapping[order]
+            overlap_days = overlap_days[order].astype(np.int32)
+
+            # pairs with no days together count too, with a weight of 0
+            for pairs in iter_packed_pairs(NIds, chunk_size):
+                weights = np.zeros(len(pairs), dtype=np.int32)
+                if len(overlapping) > 0:
+                    indexes = np.searchsorted(overlapping, pairs)
+                    indexes[indexes == len(overlapping)] = 0
+                    found = overlapping[indexes] == pairs
+                    weights[found] = overlap_days[indexes[found]]
+                pair_lists.append(pairs)
+                weight_lists.append(weights)
+                buffered += len(pairs)
+
+                if buffered >= max_buffered:
+                    pairs, weights = max_per_pair(np.concatenate(pair_lists),
+                                                  np.concatenate(weight_lists))
+                    pair_lists = [pairs]
+                    weight_lists = [weights]
+                    buffered = len(pairs)
+
+        pairs, weights = max_per_pair(np.concatenate(pair_lists),
+                                      np.concatenate(weight_lists))
+        NIds, other_NIds = unpack_pairs(pairs)
+        all_workers = np.array(list(get_worker_iterator(affiliation_graph)),
+                               dtype=np.int64)
+        return WeightedEdges(affiliation_graph.node_ids.ids(NIds),
+                             affiliation_graph.node_ids.ids(other_NIds),
+                             weights, all_workers)
+
+    def get_coworker_pairs(self, workers, spells):
+        """
+        :param workers: the workers of one employer
+        :param spells: their (years, admissions, demissions) spells there
+        :return: the pairs of workers should_connect would connect.
+        """
+        # days together are never negative, so anyone goes.
+        if self.min_days_together <= 0:
+            return itertools.combinations(workers, 2)
+
+        pair_days = sweep_overlaps(workers, spells)
+        return [pair for pair, days in pair_days.iteritems()
+                if days >= self.min_days_together]
+
+    def get_coworker_pair_chunks(self, NIds, spells, chunk_size=1000000):
+        """
+        Same as get_coworker_pairs, packed (see pack_pairs) around
+        chunk_size pairs at a time, without any tuples.
+        :param NIds: the worker NIds of one employer
+        :return: a generator of int64 arrays
+        """
+        if self.min_days_together <= 0:
+            for pairs in iter_packed_pairs(NIds, chunk_size):
+                yield pairs
+            return
+
+        for pairs, days in iter_overlaps(NIds, spells, chunk_size):
+            yield pairs[days >= self.min_days_together]
+
+    def should_connect(self, worker_spells, coworker_spells):
+        # although less general, receiving spells as parameters
+        # allows us to call get_edge_spells almost half the number of times...
+        # TODO, make worker_spells a class property or something...
+
+        time_together = self.get_spell_time_together(worker_spells,
+                                                     coworker_spells,
+                                                     self.min_days_together)
 
         # add more checks here, as needed.
         return time_together >= self.min_days_together
 
-    def get_time_together(self, worker_edge_attrs, coworker_edge_attrs, min_days = None):
+    def get_time_together(self, worker_edge_attrs, coworker_edge_attrs, min_days = None,
+                          early_exit=True):
         # although less general, receiving attributes as parameters
         # allows us to call get_edge_attrs almost half the number of times...
+        # With early_exit, we stop counting once we are past min_days,
+        # otherwise we always give the whole time together.
         time_together = 0
 
         # we did some string concatenation in the class init method
@@ -129,7 +835,7 @@ class WorkerConnector(object):
         admission_strings = self.admission_strings
         demission_strings = self.demission_strings
 
-        for year in xrange(2016, 1980, -1):
+        for year in xrange(LAST_YEAR, FIRST_YEAR - 1, -1):
             admission_string = admission_strings[year]
             demission_string = demission_strings[year]
             worker_start = worker_edge_attrs[admission_string]
@@ -144,37 +850,144 @@ class WorkerConnector(object):
 
                 # we can stop if we were given a min_days, and
                 # if that min time has been reached
-                if min_days is not None and time_together > min_days:
+                if early_exit and min_days is not None \
+                        and time_together > min_days:
                     return time_together
 
         return time_together
 
+    def get_spell_time_together(self, worker_spells, coworker_spells, min_days=None,
+                                early_exit=True):
+        """
+        Same as get_time_together, but reads (years, admissions, demissions)
+        arrays, as given by SnapManager.get_edge_spells.
+        """
+        worker_years, worker_starts, worker_ends = worker_spells
+        coworker_years, coworker_starts, coworker_ends = coworker_spells
+
+        # years in which both were there
+        _, worker_index, coworker_index = np.intersect1d(
+            worker_years, coworker_years, assume_unique=True,
+            return_indices=True)
+        years = worker_years[worker_index]
+        in_range = (years >= FIRST_YEAR) & (years <= LAST_YEAR)
+        worker_index = worker_index[in_range]
+        coworker_index = coworker_index[in_range]
+        if len(worker_index) == 0:
+            return 0
+
+        days = overlapping_days(worker_starts[worker_index],
+                                worker_ends[worker_index],
+                                coworker_starts[coworker_index],
+                                coworker_ends[coworker_index])
+
+        # spells with no dates at all don't count
+        days[np.isnan(days)] = 0
+
+        # same early stop as get_time_together, which goes from the
+        # latest year to the earliest
+        time_together = np.cumsum(days[::-1])
+        if early_exit and min_days is not None:
+            reached = np.flatnonzero(time_together > min_days)
+            if len(reached) > 0:
+                return float(time_together[reached[0]])
+        return float(time_together[-1])
+
+def overlapping_days(start_1, end_1, start_2, end_2):
+    """
+    Vectorized get_overlapping_days, for timestamp arrays.
+    """
+    latest_start = np.maximum(start_1, start_2)
+    earliest_end = np.minimum(end_1, end_2)
+    days = np.maximum(((earliest_end - latest_start)/60/60/24) + 1, 0)
+
+    # python 2 rounds halves away from zero, numpy rounds them to even.
+    return np.floor(days + 0.5)
+
 def enable_logging(log_level):
     logging.basicConfig(format='%(asctime)s %(message)s',
     datefmt='%d %b - %H:%M:%S -',
     level=log_level)
 
-def run_script(load_path, save_path, min_days):
-    # load affiliation
-    affiliation_graph = SnapManager()
+def run_script(load_path, save_path, min_days, by_employer=True, n_jobs=1,
+               output="graph", checkpoint=None, resume=False):
+    """
+    :param output: "graph" saves a SnapManager graph, "tsv" and "binary"
+        write an edge list instead (see EdgeListWriter), gzipped if
+        save_path ends with ".gz".
+    :param checkpoint, resume: see connect_workers_by_employer, which is
+        the only connector that takes checkpoints.
+    """
+    # load affiliation, we only read it, so a memory mapped view does it.
+    affiliation_graph = GraphView()
     logging.warn("Beggining to load graph...")
     affiliation_graph.load_graph(load_path)
     logging.warn("Loaded!")
 
     # connect workers
-    connected_graph = SnapManager()
+    if output == "graph":
+        connected_graph = SnapManager()
+    else:
+        connected_graph = EdgeListWriter(save_path,
+                                         binary=(output == "binary"),
+                                         compress=save_path.endswith(".gz"))
     connector = WorkerConnector()
     connector.min_days_together = min_days
-    connector.connect_workers(affiliation_graph, connected_graph)
+    if n_jobs != 1:
+        connector.connect_workers_in_parallel(load_path, connected_graph, n_jobs)
+    elif output != "graph":
+        # edge lists don't remove repeated edges, this does.
+        connector.connect_workers_out_of_core(affiliation_graph, connected_graph)
+    elif by_employer:
+        connected_graph = connector.connect_workers_by_employer(
+            affiliation_graph, connected_graph, checkpoint, resume)
+    else:
+        connector.connect_workers(affiliation_graph, connected_graph)
 
     # save it
-    connected_graph.save_graph(save_path)
+    if output == "graph":
+        connected_graph.save_graph(save_path)
+    if checkpoint is not None:
+        checkpoint.clear()
+
+def run_thresholds_script(load_path, save_path, thresholds, weights_path=None):
+    """
+    Same as calling run_script for each threshold, but we only go over
+    the affiliation graph once.
+    :param save_path: where to save graphs, with a {} for the threshold.
+    :param weights_path: if given, we keep the weighted edges there,
+        and reuse them next time.
+    """
+    affiliation_graph = GraphView()
+    logging.warn("Beggining to load graph...")
+    affiliation_graph.load_graph(load_path)
+    logging.warn("Loaded!")
+
+    if weights_path is not None and os.path.isfile(weights_path):
+        weighted_edges = WeightedEdges.load(weights_path)
+    else:
+        weighted_edges = WorkerConnector().get_weighted_edges(affiliation_graph)
+        if weights_path is not None:
+            weighted_edges.save(weights_path)
+
+    for min_days in thresholds:
+        connected_graph = weighted_edges.connect(min_days, SnapManager(),
+                                                 affiliation_graph)
+        connected_graph.save_graph(save_path.format(min_days))
 
 if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument("--resume", action="store_true",
+                            help="continue from the last checkpoint")
+    args = arg_parser.parse_args()
+
     enable_logging(logging.WARNING)
     min_days = 182
     load_path = "../output_graphs/rs_affiliation.graph"
     save_path = "../output_graphs/rs_connected" + str(min_days) + "_days.graph"
+    checkpoint = Checkpoint(save_path.replace(".graph", "_checkpoint"),
+                            every=100000)
     logging.warn("Started!")
-    run_script(load_path, save_path, min_days)
+    run_script(load_path, save_path, min_days, checkpoint=checkpoint,
+               resume=args.resume)
     logging.warn("Finished!")
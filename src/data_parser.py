@@ -1,12 +1,155 @@
 import os
 import csv
+import itertools
+import operator
 from datetime import datetime
 from time import mktime
+import numpy as np
+
+# Columns we actually use from PIS12 files. Everything else in the file is
+# ignored. Their positions come from the header of each file, or from the
+# schema if a file has no header we can use.
+PARSED_NAMES = ('ANO', 'ANO_ADM', 'ANO_NASCIMENT', 'DIADESL', 'DT_ADMISSAO',
+                'EMP_EM_31_12', 'IDENTIFICAD', 'MES_ADM', 'MES_DESLIG',
+                'MUNICIPIO', 'PIS')
+_RECORD_INDEX = dict((name, i) for i, name in enumerate(PARSED_NAMES))
+
+# one column name per line, in the order they appear in a PIS12 file
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "..", "headers", "pis12.txt")
+# where MUNICIPIO is in files that follow the schema. StateFilter is given
+# the position in the header of each file it reads (see with_columns).
+MUNICIPIO_INDEX = 38
+
+def load_schema(schema_path=SCHEMA_PATH):
+    """ :return: list of the column names of a PIS12 file """
+    with open(schema_path) as schema_file:
+        return [name.strip() for name in schema_file if name.strip()]
+
+class Pis12Record(object):
+    """
+    A parsed line: the values of PARSED_NAMES, in a tuple. It can be read
+    just like the dictionary parse_line used to give us.
+    Parsers reuse a single record for every line, so keep values around,
+    never records.
+    """
+    __slots__ = ('values',)
+
+    def __init__(self, values=()):
+        self.values = values
+
+    def __getitem__(self, name):
+        return self.values[_RECORD_INDEX[name]]
+
+    def get(self, name, default=None):
+        if name in _RECORD_INDEX:
+            return self[name]
+        return default
+
+    def __contains__(self, name):
+        return name in _RECORD_INDEX
+
+    def __iter__(self):
+        return iter(PARSED_NAMES)
+
+    def __len__(self):
+        return len(PARSED_NAMES)
+
+    def keys(self):
+        return list(PARSED_NAMES)
+
+    def items(self):
+        return zip(PARSED_NAMES, self.values)
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def copy(self):
+        """ :return: a record that keeps these values when this one is reused """
+        return Pis12Record(self.values)
+
+EPOCH = datetime(1970, 1, 1)
+
+class _FieldsKey(object):
+    """
+    The values of a few fields of a line, as a tuple. Records are read
+    straight from their tuple of values. Missing fields are None.
+    """
+
+    def __init__(self, names):
+        self.names = names
+        self._from_record = operator.itemgetter(*[_RECORD_INDEX[name]
+                                                  for name in names])
+        self._from_dict = operator.itemgetter(*names)
+
+    def __call__(self, values):
+        if type(values) is Pis12Record:
+            return self._from_record(values.values)
+        try:
+            return self._from_dict(values)
+        except KeyError:
+            return tuple(values.get(name) for name in self.names)
+
+class StateFilter(object):
+    """
+    Tells if a raw PIS12 line belongs to a state, looking only at the first
+    digits of its MUNICIPIO field. This is cheap enough to drop lines before
+    they are ever parsed as csv (see Pis12DataParser.lines_reader).
+    """
+
+    def __init__(self, state_code, municipio_index=MUNICIPIO_INDEX):
+        """
+        :param state_code: such as '43', for Rio Grande do Sul. May also
+            be a tuple of codes, to keep lines of any of those states.
+        :param municipio_index: position of MUNICIPIO in a line.
+        """
+        self.state_code = state_code
+        self.municipio_index = municipio_index
+
+    def with_columns(self, columns):
+        """
+        :param columns: names of the columns of a file, from its header.
+        :return: a filter of the same states, for lines of that file.
+        """
+        return StateFilter(self.state_code, columns.index('MUNICIPIO'))
+
+    def __call__(self, raw_line):
+        index = self.municipio_index
+        fields = raw_line.split(',', index + 1)
+        if len(fields) <= index:
+            # too short, let the parser complain about it
+            return True
+
+        # quoted fields may hold commas, csv knows where the field really is
+        rest = fields[-1] if len(fields) > index + 1 else ''
+        if raw_line.find('"', 0, len(raw_line) - len(rest)) != -1:
+            fields = csv.reader([raw_line]).next()
+            if len(fields) <= index:
+                return True
+        return fields[index].startswith(self.state_code)
 
 # noinspection PyMethodMayBeStatic
 class Pis12DataParser():
     ''' Reads "PIS12" data from disk and parse it.'''
 
+    def __init__(self, schema_path=SCHEMA_PATH):
+        self.schema = load_schema(schema_path)
+        self._set_columns(self.schema)
+
+    def __getstate__(self):
+        # item getters can't be pickled, but joblib pickles parsers
+        return {'schema': self.schema, 'columns': self.columns}
+
+    def __setstate__(self, state):
+        self.schema = state['schema']
+        self._set_columns(state['columns'])
+
     def find_files(self, folder_path, fetch_num = 0, file_type="csv"):
         """
         A generator...
@@ -31,11 +174,53 @@ class Pis12DataParser():
                     if 0 < fetch_num <= paths_read:
                         break
 
-    def lines_reader(self, file_path, fetch_num = None):
+    def split_file(self, file_path, num_parts):
+        """
+        Splits a file in (at most) num_parts byte ranges, so that several
+        workers can read a single file. Ranges always begin at the start
+        of a line, so that no line is split between two ranges.
+        :return: a list of (start, end) byte offsets, end not included.
+        """
+        size = os.path.getsize(file_path)
+        boundaries = [0]
+        with open(file_path, "rb") as src:
+            for i in xrange(1, num_parts):
+                # move on to the beginning of the next line
+                src.seek(max(size * i // num_parts - 1, 0))
+                src.readline()
+                boundary = min(src.tell(), size)
+                if boundary > boundaries[-1]:
+                    boundaries.append(boundary)
+
+        ranges = zip(boundaries, boundaries[1:] + [size])
+        return [(start, end) for start, end in ranges if start < end] or \
+            [(0, size)]
+
+    def validate_split(self, file_path, byte_ranges):
+        """
+        Checks that reading all byte ranges gives us as many lines as
+        reading the whole file at once.
+        :return: true or false
+        """
+        expected = sum(1 for _ in self.lines_reader(file_path))
+        found = sum(sum(1 for _ in self.lines_reader(file_path, 0, byte_range))
+                    for byte_range in byte_ranges)
+        return expected == found
+
+    def lines_reader(self, file_path, fetch_num = None, byte_range=None,
+                     line_filter=None):
         """
         Reads and yields a line, but does not process it.
         :param file_path:
         :param fetch_num:
+        :param byte_range: if given, only read lines in this (start, end)
+            byte range, as given by split_file. fetch_num then applies
+            to the range.
+        :param line_filter: if given, a function of a raw line (such as
+            StateFilter). Lines it rejects are dropped before csv parsing,
+            and don't count towards fetch_num. If it has a with_columns
+            method, that gives us the filter to use once we know the
+            columns of the file.
         :return: an iterator. The iterator yields lists of values.
         """
 
@@ -45,8 +230,7 @@ class Pis12DataParser():
             fetch_num = None
 
         with open(file_path, "rb") as src:
-            reader = csv.reader(src)
-            _ = reader.next()  # throws header away
+            reader = self._csv_reader(src, byte_range, line_filter)
 
             lines_read = 0
             while True:
@@ -55,6 +239,101 @@ class Pis12DataParser():
                 if 0 < fetch_num <= lines_read:
                     break
 
+    def batch_reader(self, file_path, fetch_num=None, batch_size=100000,
+                     byte_range=None, line_filter=None):
+        """
+        Reads the file in fixed-size batches of columns, instead of one
+        list per line. Only the columns in PARSED_NAMES are kept, so
+        we never build a dictionary per line.
+        :param file_path:
+        :param fetch_num: same as in lines_reader.
+        :param byte_range: same as in lines_reader.
+        :param line_filter: same as in lines_reader.
+        :param batch_size: how many lines go in each batch. The last batch
+            may be shorter.
+        :return: an iterator. The iterator yields dictionaries, mapping
+            column names to numpy arrays of (string) values.
+        """
+        if fetch_num == 0:
+            fetch_num = None
+
+        with open(file_path, "rb") as src:
+            reader = self._csv_reader(src, byte_range, line_filter)
+            select = self._select
+
+            rows = []
+            lines_read = 0
+            for line in reader:
+                if len(line) < self.line_length:
+                    raise ValueError("Unexpected format. Line is too short: \n" +
+                    str(line))
+                rows.append(select(line))
+                lines_read += 1
+
+                if len(rows) == batch_size:
+                    yield self._to_columns(PARSED_NAMES, rows)
+                    rows = []
+                if 0 < fetch_num <= lines_read:
+                    break
+
+            if len(rows) > 0:
+                yield self._to_columns(PARSED_NAMES, rows)
+
+    def _csv_reader(self, src, byte_range, line_filter=None):
+        """
+        :return: a csv reader over the whole file or just a byte range of it.
+        The header is never part of it, but it tells us where the columns
+        we use are.
+        """
+        header = src.readline()
+        self._set_columns(csv.reader([header]).next() if header else [])
+
+        if byte_range is None:
+            lines = src
+        else:
+            start, end = byte_range
+            lines = self._range_lines(src, max(start, len(header)), end)
+
+        if line_filter is not None:
+            if hasattr(line_filter, 'with_columns'):
+                line_filter = line_filter.with_columns(self.columns)
+            lines = itertools.ifilter(line_filter, lines)
+        return csv.reader(lines)
+
+    def _set_columns(self, columns):
+        """
+        Finds where PARSED_NAMES are in a line, given the names of its
+        columns. Columns that don't have them all (such as an empty header)
+        are ignored, and we keep to the schema.
+        """
+        columns = [name.strip() for name in columns]
+        if not all(name in columns for name in PARSED_NAMES):
+            columns = self.schema
+        if columns == getattr(self, 'columns', None):
+            return
+
+        self.columns = columns
+        self.line_length = len(columns)
+        self._select = operator.itemgetter(*[columns.index(name)
+                                             for name in PARSED_NAMES])
+        self._record = Pis12Record()
+
+    def _range_lines(self, src, start, end):
+        """ Yields raw lines that begin in the [start, end) byte range."""
+        src.seek(start)
+        position = start
+        while position < end:
+            line = src.readline()
+            if line == '':
+                break
+            position += len(line)
+            yield line
+
+    def _to_columns(self, names, rows):
+        """ Transposes a list of rows into a dictionary of column arrays."""
+        columns = zip(*rows)
+        return dict((names[i], np.array(columns[i]))
+                    for i in xrange(len(names)))
 
     # TODO: maybe put this in the interpreter instead...
     def parse_line(self, line):
@@ -62,25 +341,181 @@ class Pis12DataParser():
         Since this class deals with PIS12 data only, we can be very
             specific. Particularly, we know data read from this source will
             always have the same format. We will take advantage of that.
-        :return: a dictionary with key-value pairs.
+        Columns are found from the header of the last file we read (see
+            _set_columns), so no dictionary is built per line.
+        :return: a Pis12Record, which is reused by the next call.
         """
 
-        if len(line) < 67:
+        if len(line) < self.line_length:
             raise ValueError("Unexpected format. Line is too short: \n" +
             str(line))
 
-        #TODO: don't hardcode this, c'mon, that's hacky!
-        # also, here is where we parse fields. Add as needed.
-        answer = {'ANO': line[0], 'ANO_ADM': line[1], 'ANO_NASCIMENT': line[2],
-                  'DIADESL': line[11], 'DT_ADMISSAO': line[18],
-                  'EMP_EM_31_12': line[20], 'IDENTIFICAD': line[25],
-                  'MES_ADM': line[35], 'MES_DESLIG': line[36],
-                  'PIS': line[45], 'MUNICIPIO': line[38]}
-
-        return answer
+        # here is where we parse fields. Add them to PARSED_NAMES as needed.
+        record = self._record
+        record.values = self._select(line)
+        return record
 
 
+import json
+import random
 import logging
+import shutil
+from collections import defaultdict
+
+class RejectionLog(object):
+    """
+    Keeps track of the lines an interpreter could not make sense of (or had
+    to adjust), by reason. Instead of logging every line, we count them,
+    keep a few of each reason (a reservoir sample, so any line is as likely
+    to be kept) and only log the first one.
+    Lines may also be written to a quarantine file, a block at a time,
+    as the reason and the line in json, separated by a tab.
+    """
+
+    def __init__(self, sample_size=5, quarantine_path=None, block_size=10000,
+                 seed=None):
+        self.sample_size = sample_size
+        self.quarantine_path = quarantine_path
+        self.block_size = block_size
+        self.counts = defaultdict(int)
+        self.samples = defaultdict(list)
+        self._random = random.Random(seed)
+        self._pending = []
+
+    def reject(self, reason, values, level=logging.WARNING):
+        """
+        :param reason: such as "PIS is invalid in". Should not depend on the
+            line, so that lines can be counted by reason.
+        :param values: the line, as a dictionary or a Pis12Record. It is
+            kept, so it should not be changed afterwards.
+        :param level: logging level for the first line with this reason.
+        """
+        count = self.counts[reason] + 1
+        self.counts[reason] = count
+
+        samples = self.samples[reason]
+        if count <= self.sample_size:
+            samples.append(values)
+            if count == 1:
+                logging.log(level, reason + ": " + str(values) +
+                            " (more lines like this are only counted)")
+        else:
+            kept = self._random.randrange(count)
+            if kept < self.sample_size:
+                samples[kept] = values
+
+        if self.quarantine_path is not None:
+            self._pending.append((reason, values))
+            if len(self._pending) >= self.block_size:
+                self.flush()
+
+    def total(self):
+        return sum(self.counts.itervalues())
+
+    def flush(self):
+        """ Writes the lines waiting to go to the quarantine file. """
+        if not self._pending:
+            return
+        with open(self.quarantine_path, "a") as quarantine:
+            quarantine.write("".join(
+                reason + "\t" + json.dumps(dict(values), sort_keys=True) + "\n"
+                for reason, values in self._pending))
+        self._pending = []
+
+    def close(self):
+        if self.quarantine_path is not None:
+            self.flush()
+
+    def merge(self, other):
+        """
+        Adds the lines another log rejected (in another process, say) to
+        this one. Samples are drawn from both, so they are not as evenly
+        spread as a single reservoir's. Lines other quarantined are copied
+        to our quarantine file. If we have none, its file becomes ours.
+        Its file is left where it is, for the caller to remove.
+        """
+        for reason, count in other.counts.iteritems():
+            samples = self.samples[reason] + other.samples[reason]
+            if len(samples) > self.sample_size:
+                samples = self._random.sample(samples, self.sample_size)
+            self.samples[reason] = samples
+            self.counts[reason] += count
+
+        other.close()
+        if other.quarantine_path is None or \
+                not os.path.isfile(other.quarantine_path):
+            return
+        if self.quarantine_path is None:
+            self.quarantine_path = other.quarantine_path
+            return
+        if self.quarantine_path == other.quarantine_path:
+            return
+        self.flush()
+        with open(self.quarantine_path, "a") as quarantine:
+            with open(other.quarantine_path) as other_quarantine:
+                shutil.copyfileobj(other_quarantine, quarantine)
+
+    def summary(self):
+        """ :return: a text with how many lines each reason got """
+        if not self.counts:
+            return "No lines were rejected"
+        lines = [str(self.total()) + " lines were rejected or adjusted:"]
+        for reason, count in sorted(self.counts.iteritems(),
+                                    key=lambda item: (-item[1], item[0])):
+            lines.append("  " + reason + " " + str(count) + " lines, such as " +
+                         str(self.samples[reason][0]))
+        return "\n".join(lines)
+
+class LruMemo(object):
+    """
+    A bounded dictionary, which forgets the least recently used keys first.
+    It counts hits and misses, so that we can tell if it pays off.
+    Keys are kept in two generations instead of being reordered on every
+    hit: once the current one has max_size keys, it becomes the old one,
+    and keys of the old one are only kept if they are used again before
+    the next turn. So a hit is just a dictionary lookup.
+    If keys hardly ever repeat, remembering them costs more than it saves:
+    after max_size misses with fewer hits than that, the memo is no longer
+    enabled, which callers should check.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.enabled = max_size > 0
+        self.hits = 0
+        self.misses = 0
+        self._recent = {}
+        self._old = {}
+
+    def get(self, key):
+        """ :return: the value of key, or None if we don't have it """
+        value = self._recent.get(key)
+        if value is None:
+            value = self._old.pop(key, None)
+            if value is None:
+                self.misses += 1
+                if self.misses == self.max_size and self.hits < self.misses:
+                    self.enabled = False
+                return None
+            self.put(key, value)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """ :param value: anything but None """
+        if not self.enabled:
+            return
+        self._recent[key] = value
+        if len(self._recent) >= self.max_size:
+            self._old = self._recent
+            self._recent = {}
+
+    def __len__(self):
+        return len(self._recent) + len(self._old)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self)}
+
 class Pis12DataInterpreter():
     # TODO: make this faster. Don't create a new object all the time
     # TODO: don't recalculate a value if it has been calculated already
@@ -89,11 +524,33 @@ class Pis12DataInterpreter():
     """ We need now a way to calculate several attributes, such as time working together...
      the problem is that there may be several different ways to calculate this,
         depending on when the data was generated.
-     but we do know that a parsed line returns a dictionary, as seen on 'parse_line'
+     but we do know that a parsed line reads like a dictionary, as seen on 'parse_line'
      technically, this shouldn't be resonsability of a parser, but...
      It SHOULD be responsability of a class that deals with PIS12.
      This is what this class is all about."""
-    def __init__(self):
+
+    # bump whenever the rules change, so that cached results are not used
+    VERSION = 1
+
+    # every field the dates may look at
+    _ADMISSION_KEY = _FieldsKey(('DT_ADMISSAO', 'ANO_ADM', 'MES_ADM', 'ANO'))
+    _DEMISSION_KEY = _FieldsKey(('DIADESL', 'MES_DESLIG', 'ANO'))
+
+    def __init__(self, rejections=None, memo_size=10000):
+        """
+        :param rejections: a RejectionLog, which may be shared by several
+            interpreters. Each interpreter has its own otherwise.
+        :param memo_size: how many distinct combinations of date fields we
+            remember the dates of (see _memoized_date). 0 turns memos off.
+        """
+        self.rejections = rejections if rejections is not None \
+            else RejectionLog()
+        self._rejection = None
+        self.admission_memo = LruMemo(memo_size)
+        self.demission_memo = LruMemo(memo_size)
+        # rejections of the date being interpreted, see _memoized_date
+        self._date_rejections = None
+        self._used_year = False
         self._reset_private_variables()
 
     def _reset_private_variables(self):
@@ -114,7 +571,6 @@ class Pis12DataInterpreter():
         :return: nothing
         """
         self.dict = values
-        self.log_message = "Read values"
 
         # reset private variables
         # private variables save state so we only have to calculate
@@ -122,6 +578,73 @@ class Pis12DataInterpreter():
         # then again, we don't calculate it if we don't request it
         self._reset_private_variables()
 
+    @property
+    def log_message(self):
+        """ :return: what was wrong with the last line we rejected """
+        if self._rejection is None:
+            return None
+        reason, values = self._rejection
+        return reason + ": " + str(values)
+
+    def _reject(self, reason, level=logging.WARNING):
+        # lines may be reused by the parser, so we keep a copy
+        values = self.dict
+        values = values.copy() if type(values) is Pis12Record \
+            else dict(values)
+        self._rejection = (reason, values)
+        if self._date_rejections is not None:
+            self._date_rejections.append((reason, level))
+        self.rejections.reject(reason, values, level)
+
+    def memo_stats(self):
+        """ :return: hits, misses and size of the date memos """
+        return {'admission': self.admission_memo.stats(),
+                'demission': self.demission_memo.stats()}
+
+    def _memoized_date(self, memo, key, interpret):
+        """
+        Dates only depend on a few fields, which repeat a lot. So we
+        remember what interpret() gave us for each combination of them.
+        Rejections, and the use of ANO (which may be rejected too), are
+        repeated on every hit, so that each line is accounted for just
+        like it would be without the memo.
+        :param key: the values of every field interpret() may look at.
+        :return: (date, timestamp). Both are -1 for invalid dates.
+        """
+        found = memo.get(key)
+        if found is not None:
+            if found[3]:
+                _ = self.year
+            for reason, level in found[2]:
+                self._reject(reason, level)
+            return found[0], found[1]
+
+        self._date_rejections = []
+        self._used_year = False
+        try:
+            date = interpret()
+        finally:
+            rejections = tuple(self._date_rejections)
+            self._date_rejections = None
+        timestamp = -1 if date == -1 else self._to_timestamp(date)
+        memo.put(key, (date, timestamp, rejections, self._used_year))
+        return date, timestamp
+
+    def _to_timestamp(self, date):
+        # Windows cant handle mktime for dates before 1970...
+        difference = date - EPOCH
+        return difference.total_seconds()
+
+    def _date_year(self):
+        """ Same as year, for dates. See _memoized_date. """
+        self._used_year = True
+        # rejections of ANO are not rejections of the date
+        date_rejections = self._date_rejections
+        self._date_rejections = None
+        year = self.year
+        self._date_rejections = date_rejections
+        return year
+
     @property
     def year(self):
         """ :return: the year the entry relates to """
@@ -138,10 +661,18 @@ class Pis12DataInterpreter():
 
     @property
     def admission_date(self):
-        # TODO: check if tipo_adm change anything?
+        if self._admission_date is None:
+            if self.admission_memo.enabled:
+                self._admission_date, self._admission_timestamp = \
+                    self._memoized_date(self.admission_memo,
+                                        self._ADMISSION_KEY(self.dict),
+                                        self._interpret_admission_date)
+            else:
+                self._admission_date = self._interpret_admission_date()
+        return self._admission_date
 
-        if self._admission_date is not None:
-            return self._admission_date
+    def _interpret_admission_date(self):
+        # TODO: check if tipo_adm change anything?
 
         dt_admissao = self.dict['DT_ADMISSAO']
         ano_adm = self.dict['ANO_ADM']
@@ -158,8 +689,7 @@ class Pis12DataInterpreter():
                 self._admission_date = datetime.strptime(date_string,'%d%m%Y')
                 return self._admission_date
             except ValueError:
-                self.log_message = "Could not parse DT_ADMISSAO for: " + str(self.dict)
-                logging.warning(self.log_message)
+                self._reject("Could not parse DT_ADMISSAO for")
                 self._admission_date = -1
                 return self._admission_date
 
@@ -174,7 +704,7 @@ class Pis12DataInterpreter():
                 # I am assuming that in these cases, the worker was hired in the
                 # current year.
                 adm_month = int(mes_adm)
-                self._admission_date = datetime(self.year, adm_month, 1)
+                self._admission_date = datetime(self._date_year(), adm_month, 1)
                 return self._admission_date
 
         elif ano_adm == '' and mes_adm == '0':
@@ -191,17 +721,24 @@ class Pis12DataInterpreter():
             self._admission_date = datetime(adm_year, adm_month, adm_day)
             return self._admission_date
         else:
-            self.log_message = "could not get admission date for: " + str(self.dict)
-            logging.warning(self.log_message)
+            self._reject("could not get admission date for")
             self._admission_date = -1
             return self._admission_date
 
     @property
     def demission_date(self):
-        # TODO: explain the whole unix timestamp idea
+        if self._demission_date is None:
+            if self.demission_memo.enabled:
+                self._demission_date, self._demission_timestamp = \
+                    self._memoized_date(self.demission_memo,
+                                        self._DEMISSION_KEY(self.dict),
+                                        self._interpret_demission_date)
+            else:
+                self._demission_date = self._interpret_demission_date()
+        return self._demission_date
 
-        if self._demission_date is not None:
-            return self._demission_date
+    def _interpret_demission_date(self):
+        # TODO: explain the whole unix timestamp idea
 
         dia_desl = self.dict['DIADESL']
         mes_deslig = self.dict['MES_DESLIG']
@@ -213,7 +750,7 @@ class Pis12DataInterpreter():
                 (dia_desl == '0' and mes_deslig == '0') or \
                 (dia_desl == 'LVA' and mes_deslig == '0') or \
                 (dia_desl == 'NAO DESL ANO'):
-                    self._demission_date =  datetime(self.year, 12, 31)
+                    self._demission_date =  datetime(self._date_year(), 12, 31)
                     return self._demission_date
 
             # MES_DESLIG (different from 0), but no DIADESL, let's assume that
@@ -221,14 +758,14 @@ class Pis12DataInterpreter():
             elif dia_desl == '' and mes_deslig.isdigit():
                 dem_month = int(mes_deslig)
                 dem_day = 1
-                dem_year = self.year
+                dem_year = self._date_year()
                 self._demission_date = datetime(dem_year, dem_month, dem_day)
                 return self._demission_date
 
             else:
                 dem_month = int(mes_deslig)
                 dem_day = int(dia_desl)
-                dem_year = self.year
+                dem_year = self._date_year()
 
                 # We have weird instances where MES_DESLIG is 2 and
                 # the day is 29,30,31... This is pretty common
@@ -238,15 +775,13 @@ class Pis12DataInterpreter():
                 if dem_month == 2 and dem_day > 28:
                     dem_month = 3
                     dem_day = 1
-                    self.log_message = "Weird february date in: " + str(self.dict)
-                    logging.info(self.log_message)
+                    self._reject("Weird february date in", logging.INFO)
 
                 # TODO: inconsistency in EMP_EM_31_12??
                 # check inconsistent data:
                 if (dem_month > 0 >= dem_day) or \
                 (dem_month <= 0 < dem_day) :
-                    self.log_message = "Inconsistent MES_DESLIG or DIADESL in: " + str(self.dict)
-                    logging.warning(self.log_message)
+                    self._reject("Inconsistent MES_DESLIG or DIADESL in")
                     self._demission_date = -1
                     return self._demission_date
                 else:
@@ -255,8 +790,7 @@ class Pis12DataInterpreter():
                     return self._demission_date
 
         except ValueError:
-            self.log_message = "MES_DESLIG or DIADESL is invalid in: " + str(self.dict)
-            logging.warning(self.log_message)
+            self._reject("MES_DESLIG or DIADESL is invalid in")
             self._demission_date = -1
             return self._demission_date
 
@@ -267,15 +801,11 @@ class Pis12DataInterpreter():
         That is, seconds from Jan 1st 1970.
         """
         if self._admission_timestamp is None:
-            admission_date = self.admission_date
-            if admission_date == -1 :
-                return -1
-            else:
-                # Windows cant handle mktime for dates before 1970...
-                epoch = datetime(1970, 1, 1)
-                difference = admission_date - epoch
-                self._admission_timestamp = difference.total_seconds()
-
+            # comes along with the date, if memoized
+            date = self.admission_date
+            if self._admission_timestamp is None:
+                self._admission_timestamp = \
+                    -1 if date == -1 else self._to_timestamp(date)
         return self._admission_timestamp
 
     @property
@@ -285,15 +815,11 @@ class Pis12DataInterpreter():
         That is, seconds from Jan 1st 1970.
         """
         if self._demission_timestamp is None:
-            demission_date = self.demission_date
-            if demission_date == -1:
-                return  -1
-            else:
-                # Windows cant handle mktime for dates before 1970...
-                epoch = datetime(1970, 1, 1)
-                difference = demission_date - epoch
-                self._demission_timestamp = difference.total_seconds()
-
+            # comes along with the date, if memoized
+            date = self.demission_date
+            if self._demission_timestamp is None:
+                self._demission_timestamp = \
+                    -1 if date == -1 else self._to_timestamp(date)
         return self._demission_timestamp
 
     @property
@@ -328,8 +854,7 @@ class Pis12DataInterpreter():
             self._time_at_employer = min(365, total_days)
             return self._time_at_employer
         except TypeError:
-            self.log_message = "Unable to calculate time_at_employer for:" + str(self.dict)
-            logging.warning(self.log_message)
+            self._reject("Unable to calculate time_at_employer for")
             self._time_at_employer = -1
             return self._time_at_employer
 
@@ -362,12 +887,366 @@ class Pis12DataInterpreter():
             # In any case, we want this only for new unexpected errors.
             # For example, if we know a field could fail, we should not 'warn'.
             #    we should instead 'info' it in its own property method.
-            self.log_message = field_name + " is invalid in: " + str(self.dict)
-
             if alert_level == 'warn':
-                logging.warning(self.log_message)
+                self._reject(field_name + " is invalid in")
             else:
-                logging.info(self.log_message)
+                self._reject(field_name + " is invalid in", logging.INFO)
             return -1
 
-#TODO: put logging inside a method to save lines!
+
+SECONDS_PER_DAY = 86400
+DAYS_IN_MONTH = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])
+
+def days_from_civil(year, month, day):
+    """
+    Vectorized version of (datetime(year, month, day) - epoch).days
+    Works on integer numpy arrays, proleptic gregorian calendar.
+    From http://howardhinnant.github.io/date_algorithms.html
+    """
+    year = year - (month <= 2)
+    era = np.floor_divide(year, 400)
+    year_of_era = year - era * 400
+    shifted_month = (month + 9) % 12  # march is month 0
+    day_of_year = (153 * shifted_month + 2) // 5 + day - 1
+    day_of_era = year_of_era * 365 + year_of_era // 4 - \
+        year_of_era // 100 + day_of_year
+    return era * 146097 + day_of_era - 719468
+
+def is_valid_date(year, month, day):
+    """
+    Vectorized check of whether datetime(year, month, day) would
+    raise a ValueError or not.
+    :return: a boolean array
+    """
+    valid_month = (month >= 1) & (month <= 12)
+    month_length = DAYS_IN_MONTH[np.clip(month, 1, 12) - 1]
+    is_leap = ((year % 4 == 0) & (year % 100 != 0)) | (year % 400 == 0)
+    month_length = month_length + ((month == 2) & is_leap)
+    return valid_month & (year >= 1) & (year <= 9999) & \
+        (day >= 1) & (day <= month_length)
+
+
+class Pis12BatchInterpreter(object):
+    """
+    Same as Pis12DataInterpreter, but interprets whole batches at once,
+    as yielded by Pis12DataParser.batch_reader. Values come back as numpy
+    arrays, one entry per line of the batch.
+
+    Dates are given in days since Jan 1st 1970 and timestamps in seconds
+    since then. Since those can be negative, invalid dates are flagged
+    in a separate mask (invalid timestamps are still -1, just like
+    in Pis12DataInterpreter).
+
+    The common formats are interpreted with numpy. Lines in unusual
+    formats (such as a 6 digit DT_ADMISSAO) are handed over to a row
+    interpreter, so that the rules stay exactly the same.
+
+    Lines are rejected just like the row interpreter would, as if it were
+    fed the batch line by line and stopped at the first invalid PIS,
+    IDENTIFICAD or ANO (as passes_filter does): the employer id is only
+    looked at when the worker id is valid, and so on. Dates are only
+    looked at for the lines with all three valid, or for the lines
+    given to select, once the caller knows which lines it keeps.
+    """
+    # bump whenever the rules change, so that cached results are not used
+    VERSION = 1
+
+    def __init__(self, row_interpreter_class=Pis12DataInterpreter,
+                 rejections=None):
+        """
+        :param rejections: a RejectionLog, shared with the row interpreter.
+        """
+        self.row_interpreter = row_interpreter_class(rejections)
+        self.rejections = self.row_interpreter.rejections
+        self.batch = {}
+        self.size = 0
+        self._cache = {}
+
+    def feed_batch(self, batch):
+        """
+        :param batch: a dictionary of column arrays.
+        :return: nothing
+        """
+        self.batch = batch
+        self.size = len(batch.itervalues().next()) if len(batch) > 0 else 0
+        self._cache = {}
+        self._selected = None
+
+    def select(self, mask):
+        """
+        Tells the interpreter that only the lines in mask are going to be
+        used, such as the ones that pass batch_passes_filter. The dates of
+        other lines are not rejected, nor handed over to the row
+        interpreter, so they may be left invalid.
+        Call it before asking for any date.
+        """
+        self._selected = mask & self._identified()
+        for name in ['admission_days', 'admission_valid',
+                     'demission_days', 'demission_valid']:
+            self._cache.pop(name, None)
+
+    @property
+    def year(self):
+        if 'year' not in self._cache:
+            self._cache['year'] = self._parse_int_column(
+                'ANO', (self.worker_id != -1) & (self.employer_id != -1))
+        return self._cache['year']
+
+    @property
+    def worker_id(self):
+        if 'worker_id' not in self._cache:
+            self._cache['worker_id'] = self._parse_int_column(
+                'PIS', np.ones(self.size, dtype=bool))
+        return self._cache['worker_id']
+
+    @property
+    def employer_id(self):
+        if 'employer_id' not in self._cache:
+            self._cache['employer_id'] = self._parse_int_column(
+                'IDENTIFICAD', self.worker_id != -1)
+        return self._cache['employer_id']
+
+    @property
+    def municipality(self):
+        return self.batch['MUNICIPIO']
+
+    @property
+    def admission_days(self):
+        if 'admission_days' not in self._cache:
+            self._interpret_admission()
+        return self._cache['admission_days']
+
+    @property
+    def admission_valid(self):
+        if 'admission_valid' not in self._cache:
+            self._interpret_admission()
+        return self._cache['admission_valid']
+
+    @property
+    def demission_days(self):
+        if 'demission_days' not in self._cache:
+            self._interpret_demission()
+        return self._cache['demission_days']
+
+    @property
+    def demission_valid(self):
+        if 'demission_valid' not in self._cache:
+            self._interpret_demission()
+        return self._cache['demission_valid']
+
+    @property
+    def valid(self):
+        """ :return: mask of lines with both dates valid """
+        return self.admission_valid & self.demission_valid
+
+    @property
+    def admission_timestamp(self):
+        """ :return: int64 seconds from Jan 1st 1970, -1 if invalid """
+        return np.where(self.admission_valid,
+                        self.admission_days * SECONDS_PER_DAY, -1)
+
+    @property
+    def demission_timestamp(self):
+        """ :return: int64 seconds from Jan 1st 1970, -1 if invalid """
+        return np.where(self.demission_valid,
+                        self.demission_days * SECONDS_PER_DAY, -1)
+
+    @property
+    def time_at_employer(self):
+        """ :return: days at employer within 'year', capped at 365.
+         -1 if invalid. """
+        year = self.year
+        valid = self.valid & (year >= 1) & (year <= 9999)
+        first_day = days_from_civil(year, np.ones_like(year), np.ones_like(year))
+        admission_days = np.maximum(self.admission_days, first_day)
+        total_days = np.minimum(365, self.demission_days - admission_days)
+        return np.where(valid, total_days, -1)
+
+    def _interpret_admission(self):
+        dt_admissao = self.batch['DT_ADMISSAO']
+        ano_adm = self.batch['ANO_ADM']
+        mes_adm = self.batch['MES_ADM']
+        year = self.year
+
+        days = np.zeros(self.size, dtype=np.int64)
+        valid = np.zeros(self.size, dtype=bool)
+        fallback = np.zeros(self.size, dtype=bool)
+
+        # DT_ADMISSAO as ddmmyyyy, or dmmyyyy which gets padded.
+        has_dt = dt_admissao != ''
+        dt_length = np.char.str_len(dt_admissao)
+        usual_dt = has_dt & np.char.isdigit(dt_admissao) & \
+            ((dt_length == 7) | (dt_length == 8))
+        fallback |= has_dt & ~usual_dt
+        value = self._to_int64(dt_admissao, usual_dt)
+        self._set_dates(days, valid, usual_dt, value % 10000,
+                        value // 10000 % 100, value // 1000000)
+
+        # only MES_ADM, so hired in the current year (or long ago)
+        only_month = ~has_dt & (ano_adm == '') & np.char.isdigit(mes_adm)
+        long_ago = only_month & (mes_adm == '0')
+        days[long_ago] = days_from_civil(1900, 1, 1)
+        valid[long_ago] = True
+        this_year = only_month & ~long_ago
+        self._set_dates(days, valid, this_year, year,
+                        self._to_int64(mes_adm, this_year), 1)
+
+        # ANO_ADM and MES_ADM, day defaults to 01
+        month_and_year = ~has_dt & (ano_adm != '') & (mes_adm != '')
+        usual_month_and_year = month_and_year & np.char.isdigit(ano_adm) & \
+            np.char.isdigit(mes_adm)
+        fallback |= month_and_year & ~usual_month_and_year
+        self._set_dates(days, valid, usual_month_and_year,
+                        self._to_int64(ano_adm, usual_month_and_year),
+                        self._to_int64(mes_adm, usual_month_and_year), 1)
+
+        # what the row interpreter would reject. Fallbacks do it themselves.
+        live = self._live()
+        self._reject_rows("Could not parse DT_ADMISSAO for",
+                          live & usual_dt & ~valid)
+        self._reject_rows("could not get admission date for",
+                          live & ~has_dt & ~only_month & ~month_and_year)
+
+        for i in np.flatnonzero(live & fallback):
+            self._fallback(i, 'admission_date', days, valid)
+
+        self._cache['admission_days'] = days
+        self._cache['admission_valid'] = valid
+
+    def _interpret_demission(self):
+        dia_desl = self.batch['DIADESL']
+        mes_deslig = self.batch['MES_DESLIG']
+        year = self.year
+
+        days = np.zeros(self.size, dtype=np.int64)
+        valid = np.zeros(self.size, dtype=bool)
+        fallback = np.zeros(self.size, dtype=bool)
+
+        # Many ways of saying "not let go by the company"
+        not_dismissed = ((dia_desl == '') & (mes_deslig == '')) | \
+            ((dia_desl == '') & (mes_deslig == '0')) | \
+            ((dia_desl == '0') & (mes_deslig == '0')) | \
+            ((dia_desl == 'LVA') & (mes_deslig == '0')) | \
+            (dia_desl == 'NAO DESL ANO')
+        self._set_dates(days, valid, not_dismissed, year, 12, 31)
+
+        # no DIADESL, let go at the first day of MES_DESLIG
+        only_month = ~not_dismissed & (dia_desl == '') & \
+            np.char.isdigit(mes_deslig)
+        self._set_dates(days, valid, only_month, year,
+                        self._to_int64(mes_deslig, only_month), 1)
+
+        # both DIADESL and MES_DESLIG
+        day_and_month = ~not_dismissed & ~only_month
+        usual_day_and_month = day_and_month & np.char.isdigit(dia_desl) & \
+            np.char.isdigit(mes_deslig)
+        fallback |= day_and_month & ~usual_day_and_month
+
+        month = self._to_int64(mes_deslig, usual_day_and_month)
+        day = self._to_int64(dia_desl, usual_day_and_month)
+
+        # Weird february dates go to march 1st, as in Pis12DataInterpreter
+        weird_february = (month == 2) & (day > 28)
+        month[weird_february] = 3
+        day[weird_february] = 1
+        live = self._live()
+        self._reject_rows("Weird february date in", live & weird_february,
+                          logging.INFO)
+
+        # inconsistent ones are left as invalid.
+        consistent = ~(((month > 0) & (day <= 0)) | ((month <= 0) & (day > 0)))
+        self._set_dates(days, valid, usual_day_and_month & consistent,
+                        year, month, day)
+        self._reject_rows("Inconsistent MES_DESLIG or DIADESL in",
+                          live & usual_day_and_month & ~consistent)
+        self._reject_rows("MES_DESLIG or DIADESL is invalid in",
+                          live & (not_dismissed | only_month |
+                                  (usual_day_and_month & consistent)) & ~valid)
+
+        for i in np.flatnonzero(live & fallback):
+            self._fallback(i, 'demission_date', days, valid)
+
+        self._cache['demission_days'] = days
+        self._cache['demission_valid'] = valid
+
+    def _set_dates(self, days, valid, mask, year, month, day):
+        """
+        Fills days and valid where mask is set, for dates that datetime
+        would accept.
+        """
+        year = np.broadcast_to(year, mask.shape)[mask]
+        month = np.broadcast_to(month, mask.shape)[mask]
+        day = np.broadcast_to(day, mask.shape)[mask]
+        accepted = is_valid_date(year, month, day)
+
+        indexes = np.flatnonzero(mask)[accepted]
+        days[indexes] = days_from_civil(year[accepted], month[accepted],
+                                        day[accepted])
+        valid[indexes] = True
+
+    def _fallback(self, index, property_name, days, valid):
+        """
+        Interprets line 'index' with the row interpreter.
+        """
+        self.row_interpreter.feed_line(self._row(index))
+        # ANO was already parsed (and rejected, if need be) for the batch
+        self.row_interpreter._year = int(self.year[index])
+        try:
+            date = getattr(self.row_interpreter, property_name)
+        except ValueError:
+            # the row interpreter would have stopped here.
+            date = -1
+
+        if date != -1:
+            days[index] = (date - datetime(1970, 1, 1)).days
+            valid[index] = True
+
+    def _identified(self):
+        """ :return: mask of lines with a valid PIS, IDENTIFICAD and ANO """
+        return (self.worker_id != -1) & (self.employer_id != -1) & \
+            (self.year != -1)
+
+    def _live(self):
+        """ :return: mask of lines whose dates we may reject """
+        if self._selected is not None:
+            return self._selected
+        return self._identified()
+
+    def _parse_int_column(self, field_name, live):
+        """
+        Same as Pis12DataInterpreter._simple_retrieval, for a whole column
+        :param live: mask of lines that may be rejected, the others are
+            invalid for some other reason already.
+        :return: an int64 array, -1 for invalid values
+        """
+        column = self.batch[field_name]
+        digits = np.char.isdigit(column)
+        values = np.full(self.size, -1, dtype=np.int64)
+        values[digits] = column[digits].astype(np.int64)
+
+        # int() takes a few more formats, such as ' 12' or '-3'
+        for i in np.flatnonzero(~digits):
+            try:
+                values[i] = int(column[i])
+            except ValueError:
+                values[i] = -1
+                if live[i]:
+                    self.rejections.reject(field_name + " is invalid in",
+                                           self._row(i), logging.INFO)
+        return values
+
+    def _reject_rows(self, reason, mask, level=logging.WARNING):
+        """ Rejects the lines where mask is set, for the same reason. """
+        for i in np.flatnonzero(mask):
+            self.rejections.reject(reason, self._row(i), level)
+
+    def _row(self, index):
+        """ :return: line 'index' of the batch, as a dictionary """
+        return dict((name, column[index])
+                    for name, column in self.batch.iteritems())
+
+    def _to_int64(self, column, mask):
+        """ :return: int64 array, with column values where mask is set """
+        values = np.zeros(self.size, dtype=np.int64)
+        values[mask] = column[mask].astype(np.int64)
+        return values
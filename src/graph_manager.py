@@ -1,7 +1,24 @@
+import os
+import json
+import shutil
 import cPickle as pickle
 import snap
 import logging
+import numpy as np
+from itertools import izip
 from collections import defaultdict
+from graph_storage import NodeIdMap, EdgeIndex, EdgeSpellStore, \
+    build_adjacency, write_snapshot, read_snapshot, SnapshotError
+
+# edge attributes with these names are employment spells, which we keep
+# in an EdgeSpellStore instead of in SNAP.
+ADMISSION_SUFFIX = "_admission_date"
+DEMISSION_SUFFIX = "_demission_date"
+
+# the "type" attribute of nodes, coded as its index in node type arrays
+# and snapshots. -1 means there is no node with that NId.
+NODE_TYPES = ["", "worker", "employer"]
+NODE_TYPE_CODES = dict((name, code) for code, name in enumerate(NODE_TYPES))
 
 class SnapManager(object):
     """ This implementation deals with SNAP networks. """
@@ -11,12 +28,16 @@ class SnapManager(object):
         values that fit a C++ integers. We want CEI and CNPJ to be
         our IDs, but their values do not fit SNAP integers which are
         used as node ids :(
-        This is the reason you can see the use of the following dictionaries:"""
+        This is the reason you can see the use of the following dictionaries:
+        (they are array based, see graph_storage.NodeIdMap)
+        Edges are found by the NIds of their ends in an EdgeIndex.
+        node_types has the NODE_TYPES code of each NId, so that we can tell
+        workers from employers without asking SNAP."""
         self.network = snap.TNEANet().New()
-        self.NId_from_id = {}
-        self.id_from_NId = {}
-        self.edge_from_tuple = defaultdict(_get_defaults_dict)
-        self.attrs_from_edge = defaultdict(_get_defaults_dict)
+        self._set_node_ids(NodeIdMap())
+        self.node_types = np.full(1024, -1, dtype=np.int8)
+        self.edge_index = EdgeIndex()
+        self.edge_spells = EdgeSpellStore()
 
     def add_node(self, node_id):
         """
@@ -27,11 +48,47 @@ class SnapManager(object):
         """
         if not self.is_node(node_id):
             new_NId = self.network.AddNode(-1)
-            self.NId_from_id[node_id] = new_NId
-            self.id_from_NId[new_NId] = node_id
+            self.node_ids.add(node_id, new_NId)
+            self._set_node_type(new_NId, 0)
 
         return node_id
 
+    def add_nodes(self, node_ids, type_codes=None):
+        """
+        Bulk version of add_node, which also sets the "type" attribute.
+        Ids may repeat: nodes are added in the order they first show up,
+        just like calling add_node for each id would.
+        :param node_ids: an array of ids
+        :param type_codes: a code (index in NODE_TYPES) or an array of codes,
+            one per id. Where an id repeats, its last code wins, just like
+            calling add_node_attr for each id would. None sets no type.
+        :return: array of the ids that were not nodes yet
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        unique_ids, first = np.unique(node_ids, return_index=True)
+
+        NIds = self.node_ids.NIds(unique_ids)
+        in_order = np.argsort(first, kind='mergesort')
+        new = in_order[NIds[in_order] == -1]
+        new_ids = unique_ids[new]
+        NIds[new] = [self.network.AddNode(-1) for _ in xrange(len(new))]
+        self.node_ids.add_many(new_ids, NIds[new])
+        self._set_node_types(NIds[new], 0)
+
+        if type_codes is not None:
+            # position of the last occurrence of each id
+            _, last = np.unique(node_ids[::-1], return_index=True)
+            last = len(node_ids) - 1 - last
+            codes = np.broadcast_to(type_codes, node_ids.shape)[last]
+            # SNAP only hears about new nodes, or nodes that change type
+            changed = self.node_types[NIds] != codes
+            self._set_node_types(NIds, codes)
+            for NId, code in izip(NIds[changed].tolist(),
+                                  codes[changed].tolist()):
+                self.network.AddStrAttrDatN(NId, NODE_TYPES[code], "type")
+
+        return new_ids
+
     def delete_node(self, node_id):
         """
         Deletes a node, but only if it exists.
@@ -42,6 +99,7 @@ class SnapManager(object):
 
         if self.network.IsNode(NId):
             self.network.DelNode(NId)
+            self.node_types[NId] = -1
         else:
             logging.debug("Could not delete node with id = "
                             + str(NId) + " because it doesn't exist" )
@@ -66,14 +124,50 @@ class SnapManager(object):
             NId1 = NId2
             NId2 = temp
 
-        found_edge = self.edge_from_tuple[(NId1, NId2)]
+        found_edge = self.edge_index.get(NId1, NId2)
         if found_edge is not None:
             return found_edge
         else:
             new_edge = self.network.AddEdge(NId1, NId2, EId)
-            self.edge_from_tuple[(NId1, NId2)] = new_edge
+            self.edge_index.add(NId1, NId2, new_edge)
             return new_edge
 
+    def add_edges(self, src_ids, dst_ids):
+        """
+        Bulk version of add_edge. Pairs may repeat, in either direction:
+        edges are added in the order they first show up.
+        :param src_ids: an array of node ids
+        :param dst_ids: an array of node ids, the same size
+        :return: an array with the EId of each pair, -1 where one of the
+            nodes does not exist.
+        """
+        src_NIds = self.node_ids.NIds(np.asarray(src_ids, dtype=np.int64))
+        dst_NIds = self.node_ids.NIds(np.asarray(dst_ids, dtype=np.int64))
+        EIds = np.full(len(src_NIds), -1, dtype=np.int64)
+        present = (src_NIds != -1) & (dst_NIds != -1)
+        if not present.all():
+            logging.info("Couldn't add " + str(np.count_nonzero(~present)) +
+                         " edges because their nodes don't exist")
+
+        # we only add (x, y) edges where x <= y
+        pairs = EdgeIndex.pack_many(src_NIds[present], dst_NIds[present])
+        unique_pairs, first, inverse = np.unique(pairs, return_index=True,
+                                                 return_inverse=True)
+        unique_EIds = self.edge_index.edge_map.lookup(unique_pairs)
+
+        # the new ones go to SNAP in the order they first show up
+        missing = np.flatnonzero(unique_EIds == -1)
+        missing = missing[np.argsort(first[missing], kind='mergesort')]
+        low, high = EdgeIndex.unpack_many(unique_pairs[missing])
+        for index, NId1, NId2 in izip(missing.tolist(), low.tolist(),
+                                      high.tolist()):
+            unique_EIds[index] = self.network.AddEdge(NId1, NId2, -1)
+        if len(missing) > 0:
+            self.edge_index.add_many(low, high, unique_EIds[missing])
+
+        EIds[present] = unique_EIds[inverse]
+        return EIds
+
     def get_edges(self, node_id):
         """
         Note that this only returns the first edge ever added between
@@ -101,11 +195,7 @@ class SnapManager(object):
         node 1 and node 2"""
         NId1 = self.NId_from_id[node1]
         NId2 = self.NId_from_id[node2]
-
-        if NId1 < NId2:
-            return self.edge_from_tuple[NId1, NId2]
-        else:
-            return self.edge_from_tuple[NId2, NId1]
+        return self.edge_index.get(NId1, NId2)
 
     def get_nodes(self):
         return list(self.get_node_iterator())
@@ -186,28 +276,88 @@ class SnapManager(object):
     def get_edge_attrs(self, EId):
         """
         :param EId: the edge to retrieve attributes from
-        :return: a dictionary with 'attr name' - 'attr value' pairs
+        :return: a dictionary with 'attr name' - 'attr value' pairs.
+            Employment spells show up as "<year>_admission_date" and
+            "<year>_demission_date". Missing names give us None.
         """
-        if self.attrs_from_edge[EId] is None:
-            names = snap.TStrV()
-            values = snap.TStrV()
-            converted_values = []
-            self.network.AttrNameEI(EId, names)
-            self.network.AttrValueEI(EId, values)
+        names = snap.TStrV()
+        values = snap.TStrV()
+        converted_values = []
+        self.network.AttrNameEI(EId, names)
+        self.network.AttrValueEI(EId, values)
+
+        for value in values:
+            # Due to a SNAP bug we are forced to convert attributes
+            #   back to their original type ourselves ;(
+            converted_values.append(self.__convert(value))
+
+        attrs = defaultdict(_get_defaults_dict, zip(names, converted_values))
+        years, admissions, demissions = self.edge_spells.get(EId)
+        for year, admission, demission in zip(years, admissions, demissions):
+            if admission == admission:  # not NaN
+                attrs[str(year) + ADMISSION_SUFFIX] = float(admission)
+            if demission == demission:
+                attrs[str(year) + DEMISSION_SUFFIX] = float(demission)
+        return attrs
 
-            for value in values:
-                # Due to a SNAP bug we are forced to convert attributes
-                #   back to their original type ourselves ;(
-                converted_values.append(self.__convert(value))
+    def get_edge_spells(self, EId):
+        """
+        :param EId: the edge to retrieve employment spells from
+        :return: (years, admissions, demissions) numpy arrays, sorted by year
+        """
+        return self.edge_spells.get(EId)
 
-            self.attrs_from_edge[EId] = defaultdict(_get_defaults_dict,
-                                                    (zip(names, converted_values)))
+    def add_edge_spell(self, EId, year, admission, demission):
+        """
+        Same as adding "<year>_admission_date" and "<year>_demission_date"
+        attributes, but faster.
+        """
+        self.edge_spells.add(EId, year, admission, demission)
 
-        return self.attrs_from_edge[EId]
+    def add_edge_spells(self, EIds, years, admissions, demissions):
+        """ Bulk version of add_edge_spell, for arrays of the same size."""
+        self.edge_spells.add_many(EIds, years, admissions, demissions)
 
+    def add_edge_attr_column(self, EIds, name, values):
+        """
+        Bulk version of add_edge_attr: sets attribute 'name' of each edge
+        to its value. Where an edge repeats, its last value wins.
+        :param values: a numpy array (of ints, floats or strings), one value
+            per edge.
+        """
+        EIds = np.asarray(EIds, dtype=np.int64)
+        values = np.asarray(values)
+        spell = _parse_spell_name(name)
+        if spell is not None:
+            year, is_admission = spell
+            missing = np.full(len(EIds), np.nan)
+            if is_admission:
+                self.edge_spells.add_many(EIds, np.full(len(EIds), year),
+                                          values, missing)
+            else:
+                self.edge_spells.add_many(EIds, np.full(len(EIds), year),
+                                          missing, values)
+            return
+
+        if values.dtype.kind in 'iu':
+            add_attr = self.network.AddIntAttrDatE
+        elif values.dtype.kind == 'f':
+            add_attr = self.network.AddFltAttrDatE
+        elif values.dtype.kind == 'S':
+            add_attr = self.network.AddStrAttrDatE
+        else:
+            raise Exception('Invalid data type')
+        for EId, value in izip(EIds.tolist(), values.tolist()):
+            add_attr(EId, value, name)
 
     def get_edge_attr(self, EId, attr_name):
 
+        if _parse_spell_name(attr_name) is not None:
+            value = self.get_edge_attrs(EId)[attr_name]
+            if value is None:
+                raise RuntimeError("Edge does not have attribute" + attr_name)
+            return value
+
         names = snap.TStrV()
         values = snap.TStrV()
         self.network.AttrNameEI(EId, names)
@@ -241,12 +391,10 @@ class SnapManager(object):
         nodeI = self.network.GetNI(NId)
         num_neighbours = nodeI.GetOutDeg() + nodeI.GetInDeg()
 
-        neighboring_nodes = set()
-        for i in xrange(num_neighbours):
-            neighboring_nodes.add(self.id_from_NId[nodeI.GetNbrNId(i)])
-
-
-        return list(neighboring_nodes)
+        neighbor_NIds = np.fromiter((nodeI.GetNbrNId(i)
+                                     for i in xrange(num_neighbours)),
+                                    dtype=np.int64, count=num_neighbours)
+        return np.unique(self.node_ids.ids(neighbor_NIds)).tolist()
 
     def add_node_attr(self, node_id, name, value):
         NId = self.NId_from_id[node_id]
@@ -261,12 +409,22 @@ class SnapManager(object):
         else:
             raise Exception('Invalid data type')
 
-    def add_edge_attr(self, EId, name, value):
+        if name == "type":
+            self._set_node_type(NId, NODE_TYPE_CODES.get(value, 0))
 
-        # reset anything we knew about edge attrs
-        self.attrs_from_edge[EId] = None
+    def add_edge_attr(self, EId, name, value):
 
         edge = self.network.GetEI(EId)
+
+        spell = _parse_spell_name(name)
+        if spell is not None:
+            year, is_admission = spell
+            if is_admission:
+                self.edge_spells.add(EId, year, admission=value)
+            else:
+                self.edge_spells.add(EId, year, demission=value)
+            return
+
         if isinstance(value, int):
             self.network.AddIntAttrDatE(edge, value, name)
         elif isinstance(value, float):
@@ -293,49 +451,152 @@ class SnapManager(object):
     def is_edge_between(self, src_id, dest_id):
         src_NId = self.NId_from_id[src_id]
         dest_NId = self.NId_from_id[dest_id]
+        # the index does not care about direction
+        return (src_NId, dest_NId) in self.edge_index
 
-        # direction 1
-        edge1 = self.edge_from_tuple[src_NId, dest_NId]
-
-        # direction 2
-        edge2 = self.edge_from_tuple[dest_NId, src_NId]
-
-        return (edge1 is not None) or (edge2 is not None)
+    def are_edges_between(self, src_ids, dst_ids):
+        """
+        Bulk version of is_edge_between.
+        :return: a boolean array, false where either node doesn't exist
+        """
+        src_NIds = self.node_ids.NIds(np.asarray(src_ids, dtype=np.int64))
+        dst_NIds = self.node_ids.NIds(np.asarray(dst_ids, dtype=np.int64))
+        present = (src_NIds != -1) & (dst_NIds != -1)
+        found = np.zeros(len(src_NIds), dtype=bool)
+        found[present] = self.edge_index.contains(src_NIds[present],
+                                                  dst_NIds[present])
+        return found
 
     def save_graph(self, file_path):
         FOut = snap.TFOut(file_path)
         self.network.Save(FOut)
         FOut.Flush()
 
-        # save dictionaries too!
-        pickle.dump(self.NId_from_id,
-                    open(file_path.replace(".graph", "_nid_from_id.p"), 'wb'))
-        pickle.dump(self.id_from_NId,
-                    open(file_path.replace(".graph", "_id_from_nid.p"), 'wb'))
-        pickle.dump(self.edge_from_tuple,
-                    open(file_path.replace(".graph", "_edge_from_tuple.p"), 'wb'))
-        pickle.dump(self.attrs_from_edge,
-                    open(file_path.replace(".graph", "_attrs_from_edge.p"), 'wb'))
+        # we may be overwriting the snapshot we were loaded from
+        self.node_ids.copy_to_memory()
+        self.edge_index.copy_to_memory()
+        self.edge_spells.copy_to_memory()
+
+        # ids, the edge index and the spells go in a single snapshot
+        sections = {}
+        sections.update(self.node_ids.to_sections())
+        sections.update(self.edge_index.to_sections())
+        sections.update(self.edge_spells.to_sections())
+        sections.update(self._adjacency_sections())
+        write_snapshot(_snapshot_path(file_path), sections)
 
     def load_graph(self, file_path, graph_type=snap.TNEANet):
         FIn = snap.TFIn(file_path)
 
         self.network = graph_type.Load(FIn)
 
-        # grab dictionaries too!
-        self.NId_from_id =\
+        snapshot_path = _snapshot_path(file_path)
+        if os.path.isfile(snapshot_path):
+            # copy on write, so we can still add nodes and edges
+            _, sections = read_snapshot(snapshot_path, mode='c')
+            self._set_node_ids(NodeIdMap.from_sections(sections))
+            if 'nodes.type' in sections:
+                self.node_types = np.array(sections['nodes.type'])
+            else:
+                self.node_types = self._node_types_from_snap_attrs()
+            self.edge_index = EdgeIndex.from_sections(sections)
+            self.edge_spells = EdgeSpellStore.from_sections(sections)
+        else:
+            self._load_legacy_pickles(file_path)
+
+        return self
+
+    def _load_legacy_pickles(self, file_path):
+        """ Graphs saved before snapshots have their dictionaries pickled."""
+        NId_from_id =\
             pickle.load(open(file_path.replace(".graph", "_nid_from_id.p"), 'rb'))
 
-        self.id_from_NId =\
+        id_from_NId =\
             pickle.load(open(file_path.replace(".graph", "_id_from_nid.p"), 'rb'))
 
-        self.edge_from_tuple = \
-            pickle.load(open(file_path.replace(".graph", "_edge_from_tuple.p"), 'rb'))
+        if isinstance(NId_from_id, dict):
+            # graphs saved before we had NodeIdMap
+            node_ids = NodeIdMap.from_dicts(NId_from_id, id_from_NId)
+        else:
+            node_ids = NodeIdMap()
+            node_ids.NId_from_id = NId_from_id
+            node_ids.id_from_NId = id_from_NId
+        self._set_node_ids(node_ids)
+        self.node_types = self._node_types_from_snap_attrs()
 
-        self.attrs_from_edge = \
-            pickle.load(open(file_path.replace(".graph", "_attrs_from_edge.p"), 'rb'))
+        edge_from_tuple = \
+            pickle.load(open(file_path.replace(".graph", "_edge_from_tuple.p"), 'rb'))
+        self.edge_index = EdgeIndex.from_dict(edge_from_tuple)
+
+        # spells were SNAP attributes back then
+        self.edge_spells = self._spells_from_snap_attrs()
+
+    def _adjacency_sections(self):
+        """ What GraphView needs: node types and adjacency lists."""
+        node_types = np.full(len(self.id_from_NId.used), -1, dtype=np.int8)
+        size = min(len(node_types), len(self.node_types))
+        node_types[:size] = self.node_types[:size]
+
+        # the edge index still has the edges of deleted nodes
+        src, dst, EIds = self.edge_index.edges()
+        present = (node_types[src] >= 0) & (node_types[dst] >= 0)
+        offsets, neighbors, edges = build_adjacency(
+            len(node_types), src[present], dst[present], EIds[present])
+        return {'nodes.type': node_types,
+                'adjacency.offsets': offsets,
+                'adjacency.neighbors': neighbors,
+                'adjacency.edges': edges}
+
+    def _node_types_from_snap_attrs(self):
+        node_types = np.full(len(self.id_from_NId.used), -1, dtype=np.int8)
+        for NId in np.flatnonzero(self.id_from_NId.used).tolist():
+            if self.network.IsNode(NId):
+                try:
+                    node_type = self.network.GetStrAttrDatN(NId, "type")
+                except RuntimeError:
+                    # no node has a "type" at all
+                    node_type = ""
+                node_types[NId] = NODE_TYPE_CODES.get(node_type, 0)
+        return node_types
+
+    def _set_node_type(self, NId, code):
+        if NId >= len(self.node_types):
+            self._grow_node_types(NId + 1)
+        self.node_types[NId] = code
+
+    def _set_node_types(self, NIds, codes):
+        """ Bulk version of _set_node_type"""
+        if len(NIds) == 0:
+            return
+        self._grow_node_types(int(np.max(NIds)) + 1)
+        self.node_types[NIds] = codes
 
-        return self
+    def _grow_node_types(self, min_size):
+        if min_size <= len(self.node_types):
+            return
+        node_types = np.full(max(min_size, 2 * len(self.node_types)), -1,
+                             dtype=np.int8)
+        node_types[:len(self.node_types)] = self.node_types
+        self.node_types = node_types
+
+    def _spells_from_snap_attrs(self):
+        edge_spells = EdgeSpellStore()
+        for edge in self.network.Edges():
+            EId = edge.GetId()
+            names = snap.TStrV()
+            values = snap.TStrV()
+            self.network.AttrNameEI(EId, names)
+            self.network.AttrValueEI(EId, values)
+            for name, value in zip(names, values):
+                spell = _parse_spell_name(name)
+                if spell is None:
+                    continue
+                year, is_admission = spell
+                if is_admission:
+                    edge_spells.add(EId, year, admission=float(value))
+                else:
+                    edge_spells.add(EId, year, demission=float(value))
+        return edge_spells
 
     def copy_node(self, node_id, dst_graph):
         """
@@ -364,6 +625,21 @@ class SnapManager(object):
         NId = self.network.GetRndNId()
         return self.id_from_NId[NId]
 
+    def iter_workers(self):
+        """ :return: a generator of the ids of nodes of "worker" type """
+        return _iter_nodes_of_type(self.node_types, self.node_ids, "worker")
+
+    def iter_employers(self):
+        """ :return: a generator of the ids of nodes of "employer" type """
+        return _iter_nodes_of_type(self.node_types, self.node_ids, "employer")
+
+    def count_by_type(self):
+        """
+        :return: a dictionary of node type - number of nodes of that type.
+            Nodes without a type count as "".
+        """
+        return _count_by_type(self.node_types)
+
     def generate_random_graph(self, node_num, node_out_deg, rewire_prob):
         # this substitutes the old graph, so beware
         # from: https://snap.stanford.edu/snappy/doc/reference/GenSmallWorld.html?highlight=generate%20random%20network
@@ -436,22 +712,31 @@ class SnapManager(object):
         # TODO: apologize for having to do this.
 
         node_num = self.get_node_count()
-        self.id_from_NId = {}
-        self.NId_from_id = {}
+        identity = np.arange(node_num, dtype=np.int64)
+        node_ids = NodeIdMap()
+        # the new network has no "type" attributes
+        self.node_types = np.full(node_num, -1, dtype=np.int8)
+        self._set_node_types(identity, 0)
 
         #=====NID from ID====
         if NId_from_id is not None:
-            self.NId_from_id = NId_from_id
+            node_ids.NId_from_id.update(NId_from_id.keys(), NId_from_id.values())
         else:
-            for x in xrange(node_num):
-                self.NId_from_id[x] = x
+            node_ids.NId_from_id.update(identity, identity)
 
         #=====ID from NID====
         if id_from_NId is not None:
-            self.id_from_NId = id_from_NId
+            node_ids.id_from_NId.update(id_from_NId.keys(), id_from_NId.values())
         else:
-            for x in xrange(node_num):
-                self.id_from_NId[x] = x
+            node_ids.id_from_NId.update(identity, identity)
+
+        self._set_node_ids(node_ids)
+
+    def _set_node_ids(self, node_ids):
+        """ NId_from_id and id_from_NId are kept as shortcuts into node_ids"""
+        self.node_ids = node_ids
+        self.NId_from_id = node_ids.NId_from_id
+        self.id_from_NId = node_ids.id_from_NId
 
     # noinspection PyMethodMayBeStatic
     def __convert(self, value):
@@ -463,6 +748,266 @@ class SnapManager(object):
         except ValueError:
             return value
 
+class GraphView(object):
+    """
+    A read only view of a graph saved by SnapManager.save_graph.
+    Everything is memory mapped from the snapshot, so loading is instant,
+    and processes looking at the same graph share a single copy of it
+    through the page cache.
+    It has the part of the SnapManager API our analysis scripts use.
+    Nodes only have their "type" attribute, and edges only have spells.
+    """
+
+    def load_graph(self, file_path, verify=False):
+        """
+        :param verify: check the snapshot checksum. This reads the whole file.
+        """
+        snapshot_path = _snapshot_path(file_path)
+        _, sections = read_snapshot(snapshot_path, mode='r', verify=verify)
+        if 'adjacency.offsets' not in sections:
+            raise SnapshotError(snapshot_path + " has no adjacency lists, "
+                                "load and save it again with SnapManager")
+
+        # no dictionaries, so that the ids stay memory mapped
+        self.node_ids = NodeIdMap.from_sections(sections, dict_lookups=False)
+        self.NId_from_id = self.node_ids.NId_from_id
+        self.node_types = sections['nodes.type']
+        self.offsets = sections['adjacency.offsets']
+        self.neighbors = sections['adjacency.neighbors']
+        self.edges = sections['adjacency.edges']
+        self.edge_spells = EdgeSpellStore.from_sections(sections)
+        self.node_count = int(np.count_nonzero(self.node_types >= 0))
+        return self
+
+    def is_node(self, node_id):
+        NId = self.NId_from_id.get(node_id)
+        return NId is not None and self.node_types[NId] >= 0
+
+    def get_node_count(self):
+        return self.node_count
+
+    def get_edge_count(self):
+        # every edge is in the lists of both its ends
+        return len(self.edges) // 2
+
+    def get_nodes(self):
+        return list(self.get_node_iterator())
+
+    def get_node_iterator(self):
+        NIds = np.flatnonzero(self.node_types >= 0)
+        for node_id in self.node_ids.ids(NIds).tolist():
+            yield node_id
+
+    def get_random_node(self):
+        NIds = np.flatnonzero(self.node_types >= 0)
+        return int(self.node_ids.ids([np.random.choice(NIds)])[0])
+
+    def iter_workers(self):
+        return _iter_nodes_of_type(self.node_types, self.node_ids, "worker")
+
+    def iter_employers(self):
+        return _iter_nodes_of_type(self.node_types, self.node_ids, "employer")
+
+    def count_by_type(self):
+        return _count_by_type(self.node_types)
+
+    def get_node_attrs(self, node_id):
+        code = self.node_types[self.NId_from_id[node_id]]
+        # -1 for deleted nodes, which NODE_TYPES[-1] would take as employers
+        if code <= 0:
+            return {}
+        return {"type": NODE_TYPES[code]}
+
+    def get_node_attr(self, node_id, attr_name):
+        attrs = self.get_node_attrs(node_id)
+        if attr_name not in attrs:
+            raise RuntimeError("Node does not have attribute" + attr_name)
+        return attrs[attr_name]
+
+    def copy_node(self, node_id, dst_graph):
+        """ Same as SnapManager.copy_node"""
+        if not self.is_node(node_id):
+            return False
+
+        if dst_graph.is_node(node_id):
+            return False
+
+        dst_graph.add_node(node_id)
+        for attr_name, attr_value in self.get_node_attrs(node_id).iteritems():
+            dst_graph.add_node_attr(node_id, attr_name, attr_value)
+        return True
+
+    def get_neighboring_nodes(self, node_id):
+        neighbor_NIds = self._neighbors(self.NId_from_id[node_id])
+        return np.unique(self.node_ids.ids(neighbor_NIds)).tolist()
+
+    def get_edge_between(self, node1, node2):
+        NId1 = self.NId_from_id[node1]
+        NId2 = self.NId_from_id[node2]
+        start, end = self.offsets[NId1], self.offsets[NId1 + 1]
+        index = start + self.neighbors[start:end].searchsorted(NId2)
+        if index < end and self.neighbors[index] == NId2:
+            return int(self.edges[index])
+        return None
+
+    def get_edge_spells(self, EId):
+        return self.edge_spells.get(EId)
+
+    def get_edge_attrs(self, EId):
+        """ Same as SnapManager.get_edge_attrs, spells only."""
+        attrs = defaultdict(_get_defaults_dict)
+        years, admissions, demissions = self.edge_spells.get(EId)
+        for year, admission, demission in zip(years, admissions, demissions):
+            if admission == admission:  # not NaN
+                attrs[str(year) + ADMISSION_SUFFIX] = float(admission)
+            if demission == demission:
+                attrs[str(year) + DEMISSION_SUFFIX] = float(demission)
+        return attrs
+
+    def get_shortest_path_size(self, node_id):
+        """ Same as SnapManager.get_shortest_path_size: how far
+        the furthest node reachable from node_id is."""
+        return self._bfs_depth(self.NId_from_id[node_id])
+
+    def get_eccentricity(self, node_id):
+        return self._bfs_depth(self.NId_from_id[node_id])
+
+    def get_degree_centrality(self, node_id):
+        """ degree/(N-1), as in SNAP. """
+        if self.node_count <= 1:
+            return 0.0
+        NId = self.NId_from_id[node_id]
+        degree = self.offsets[NId + 1] - self.offsets[NId]
+        return float(degree) / (self.node_count - 1)
+
+    def _neighbors(self, NId):
+        return self.neighbors[self.offsets[NId]:self.offsets[NId + 1]]
+
+    def _bfs_depth(self, NId):
+        """ Breadth first search, a whole level at a time."""
+        visited = np.zeros(len(self.node_types), dtype=bool)
+        visited[NId] = True
+        frontier = np.array([NId], dtype=np.int64)
+        depth = -1
+        while len(frontier) > 0:
+            depth += 1
+            starts = self.offsets[frontier]
+            ends = self.offsets[frontier + 1]
+            next_frontier = np.unique(np.concatenate(
+                [self.neighbors[start:end]
+                 for start, end in zip(starts, ends)]))
+            frontier = next_frontier[~visited[next_frontier]]
+            visited[frontier] = True
+        return depth
+
+
+class Checkpoint(object):
+    """
+    Saves a graph, along with a progress cursor, every so often, so that
+    long jobs can resume from where they crashed instead of starting over.
+    A checkpoint is a folder with the saved graph and a cursor.json file.
+    New checkpoints are written next to the old one and then renamed over
+    it, so there always is a complete checkpoint to go back to.
+    """
+
+    def __init__(self, path, every=None):
+        """
+        :param path: the checkpoint folder
+        :param every: save a checkpoint every this many calls to tick.
+            None means tick never saves, which is handy for resuming only.
+        """
+        self.path = path
+        self.every = every
+        self.ticks = 0
+
+    def exists(self):
+        return os.path.isdir(self.path) or os.path.isdir(self.path + ".old")
+
+    def load(self, graph_manager_class=SnapManager):
+        """
+        :return: (graph, cursor) of the last checkpoint, (None, None)
+            if there is none.
+        """
+        path = self.path
+        if not os.path.isdir(path):
+            # we crashed right between the two renames of save
+            path = self.path + ".old"
+            if not os.path.isdir(path):
+                return None, None
+
+        graph = graph_manager_class()
+        graph.load_graph(os.path.join(path, "checkpoint.graph"))
+        with open(os.path.join(path, "cursor.json")) as cursor_file:
+            cursor = json.load(cursor_file)
+        logging.warn("Resuming from checkpoint " + path)
+        return graph, cursor
+
+    def tick(self, graph, cursor):
+        """
+        Call this after each unit of work.
+        :param cursor: something json can take, which tells us what is done.
+        """
+        self.ticks += 1
+        if self.every is not None and self.ticks % self.every == 0:
+            self.save(graph, cursor)
+
+    def save(self, graph, cursor):
+        temp_path = self.path + ".tmp"
+        old_path = self.path + ".old"
+        shutil.rmtree(temp_path, ignore_errors=True)
+        os.mkdir(temp_path)
+        graph.save_graph(os.path.join(temp_path, "checkpoint.graph"))
+        with open(os.path.join(temp_path, "cursor.json"), 'w') as cursor_file:
+            json.dump(cursor, cursor_file)
+
+        if os.path.isdir(self.path):
+            shutil.rmtree(old_path, ignore_errors=True)
+            os.rename(self.path, old_path)
+        os.rename(temp_path, self.path)
+        shutil.rmtree(old_path, ignore_errors=True)
+        logging.warn("Saved checkpoint " + self.path)
+
+    def clear(self):
+        """ Deletes the checkpoint, once the job is done."""
+        for path in [self.path, self.path + ".old", self.path + ".tmp"]:
+            shutil.rmtree(path, ignore_errors=True)
+
+
 # so we can pickle default dict
 def _get_defaults_dict():
     return None
+
+
+def _iter_nodes_of_type(node_types, node_ids, node_type):
+    NIds = np.flatnonzero(node_types == NODE_TYPE_CODES[node_type])
+    for node_id in node_ids.ids(NIds).tolist():
+        yield node_id
+
+
+def _count_by_type(node_types):
+    counts = np.bincount(node_types[node_types >= 0],
+                         minlength=len(NODE_TYPES))
+    return dict(zip(NODE_TYPES, counts.tolist()))
+
+
+def _snapshot_path(file_path):
+    return file_path.replace(".graph", ".snapshot")
+
+
+def _parse_spell_name(name):
+    """
+    :return: (year, True) for "<year>_admission_date",
+        (year, False) for "<year>_demission_date", None otherwise.
+    """
+    if name.endswith(ADMISSION_SUFFIX):
+        year = name[:-len(ADMISSION_SUFFIX)]
+        is_admission = True
+    elif name.endswith(DEMISSION_SUFFIX):
+        year = name[:-len(DEMISSION_SUFFIX)]
+        is_admission = False
+    else:
+        return None
+
+    if not year.isdigit():
+        return None
+    return int(year), is_admission
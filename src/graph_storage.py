@@ -0,0 +1,830 @@
+import os
+import json
+import heapq
+import shutil
+import tempfile
+import zlib
+import struct
+from itertools import izip
+import numpy as np
+
+# Array backed structures for our graph managers.
+# Python dictionaries take around 100 bytes per entry, which is way too much
+# when we have tens of millions of workers. Arrays use ~16 bytes per entry,
+# so that is what goes in snapshots, and what read only views keep.
+# Maps that are being built or changed are still dictionaries (see
+# Int64Map), the compact form only exists once they are saved and loaded.
+
+
+class Int64Map(object):
+    """
+    A dictionary from int64 keys to int64 values, which can also be read as
+    a pair of sorted arrays, for snapshots.
+    One key at a time, a plain dictionary is by far the fastest, so that is
+    what we use once anything is added or looked up one key at a time.
+    That costs around 100 bytes per entry: only maps built from arrays
+    (such as snapshot sections) take ~16 bytes per entry, and only until
+    they build their dictionary, on the first change or single key lookup.
+    Read only ones may never build it at all (see dict_lookups).
+    The arrays of a dictionary are built when asked for, and not kept, so
+    that saving a map doesn't leave two copies of it around.
+    """
+
+    def __init__(self, keys=None, values=None, dict_lookups=True):
+        """
+        :param dict_lookups: if False, looking up single keys of a map
+            built from arrays is a binary search, instead of building a
+            dictionary first. For big maps that are looked up only a few
+            times, or that should stay memory mapped.
+        """
+        self.dict_lookups = dict_lookups
+        if keys is None:
+            self._dict = {}
+            self._keys = self._values = None
+        else:
+            self._dict = None
+            self._keys = keys
+            self._values = values
+
+    def __len__(self):
+        if self._dict is not None:
+            return len(self._dict)
+        return len(self._keys)
+
+    def __contains__(self, key):
+        if self._dict is not None:
+            return key in self._dict
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        if self._dict is not None:
+            return self._dict[key]
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._as_dict()[key] = value
+
+    def __iter__(self):
+        if self._dict is not None:
+            return iter(self._dict)
+        return (int(key) for key in self._keys)
+
+    def get(self, key, default=None):
+        if self._dict is not None:
+            return self._dict.get(key, default)
+        if not self.dict_lookups:
+            keys = self._keys
+            index = keys.searchsorted(key)
+            if index < len(keys) and keys[index] == key:
+                return int(self._values[index])
+            return default
+        return self._as_dict().get(key, default)
+
+    def items(self):
+        return zip(self, [self[key] for key in self])
+
+    @property
+    def keys(self):
+        """ :return: the keys, as a sorted array """
+        return self.arrays()[0]
+
+    @property
+    def values(self):
+        """ :return: the values, in the same order as keys """
+        return self.arrays()[1]
+
+    def arrays(self):
+        """ :return: (sorted keys, values) arrays """
+        if self._keys is not None:
+            return self._keys, self._values
+        keys = np.fromiter(self._dict.iterkeys(), dtype=np.int64,
+                           count=len(self._dict))
+        values = np.fromiter(self._dict.itervalues(), dtype=np.int64,
+                             count=len(self._dict))
+        order = np.argsort(keys, kind='mergesort')
+        return keys[order], values[order]
+
+    def lookup(self, keys, default=-1):
+        """
+        Bulk version of get.
+        :param keys: an array of keys
+        :return: an int64 array of values, default where key is missing.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if self._dict is not None:
+            get = self._dict.get
+            return np.fromiter((get(key, default) for key in keys.tolist()),
+                               dtype=np.int64, count=len(keys))
+
+        found_values = np.full(len(keys), default, dtype=np.int64)
+        if len(self._keys) == 0:
+            return found_values
+        indexes = np.searchsorted(self._keys, keys)
+        indexes[indexes == len(self._keys)] = 0
+        found = self._keys[indexes] == keys
+        found_values[found] = self._values[indexes[found]]
+        return found_values
+
+    def update(self, keys, values):
+        """
+        Bulk insertion. If a key shows up more than once, the last one wins.
+        :param keys: an array of keys
+        :param values: an array of values, same size as keys
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        values = np.asarray(values, dtype=np.int64)
+        # maps loaded from arrays switch to a dictionary too: merging into
+        # sorted arrays would cost as much as the whole map every time
+        self._as_dict().update(izip(keys.tolist(), values.tolist()))
+
+    def copy_to_memory(self):
+        """ Stops using memory mapped arrays, see release_mapped."""
+        if self._keys is not None:
+            self._keys = release_mapped(self._keys)
+            self._values = release_mapped(self._values)
+
+    def _as_dict(self):
+        if self._dict is None:
+            self._dict = dict(izip(self._keys.tolist(), self._values.tolist()))
+            self._keys = self._values = None
+        return self._dict
+
+    def __getstate__(self):
+        # the arrays are a lot smaller than the dictionary
+        keys, values = self.arrays()
+        return {'keys': keys, 'values': values,
+                'dict_lookups': self.dict_lookups}
+
+    def __setstate__(self, state):
+        self.__init__(state['keys'], state['values'], state['dict_lookups'])
+
+
+class DenseInt64Array(object):
+    """
+    A dictionary from small non-negative integers (such as SNAP NIds) to
+    int64 values, stored as a growable array.
+    """
+
+    def __init__(self, values=None, used=None):
+        if values is None:
+            values = np.zeros(1024, dtype=np.int64)
+            used = np.zeros(1024, dtype=bool)
+        self.values = values
+        self.used = used
+
+    def __len__(self):
+        return int(np.count_nonzero(self.used))
+
+    def __contains__(self, index):
+        return 0 <= index < len(self.used) and bool(self.used[index])
+
+    def __getitem__(self, index):
+        if index not in self:
+            raise KeyError(index)
+        return int(self.values[index])
+
+    def __setitem__(self, index, value):
+        if index < 0:
+            raise KeyError(index)
+        if index >= len(self.used):
+            self._grow(index + 1)
+        self.values[index] = value
+        self.used[index] = True
+
+    def __iter__(self):
+        for index in np.flatnonzero(self.used):
+            yield int(index)
+
+    def get(self, index, default=None):
+        if index not in self:
+            return default
+        return int(self.values[index])
+
+    def items(self):
+        return [(index, self[index]) for index in self]
+
+    def lookup(self, indexes):
+        """
+        Bulk version of __getitem__
+        :param indexes: an array of indexes, all of which must be in use.
+        :return: an int64 array
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if len(indexes) > 0 and not np.all(self.used[indexes]):
+            raise KeyError("Some indexes are not in use")
+        return self.values[indexes]
+
+    def update(self, indexes, values):
+        """ Bulk version of __setitem__"""
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if len(indexes) == 0:
+            return
+        if indexes.max() >= len(self.used):
+            self._grow(indexes.max() + 1)
+        self.values[indexes] = values
+        self.used[indexes] = True
+
+    def copy_to_memory(self):
+        """ Stops using memory mapped arrays, see release_mapped."""
+        self.values = release_mapped(self.values)
+        self.used = release_mapped(self.used)
+
+    def _grow(self, min_size):
+        size = max(min_size, 2 * len(self.used))
+        values = np.zeros(size, dtype=np.int64)
+        used = np.zeros(size, dtype=bool)
+        values[:len(self.values)] = self.values
+        used[:len(self.used)] = self.used
+        self.values = values
+        self.used = used
+
+
+class NodeIdMap(object):
+    """
+    Maps our ids (PIS, CNPJ, ...), which do not fit in SNAP integers,
+    to SNAP NIds, and back.
+    """
+
+    def __init__(self):
+        self.NId_from_id = Int64Map()
+        self.id_from_NId = DenseInt64Array()
+
+    @classmethod
+    def from_dicts(cls, NId_from_id, id_from_NId):
+        """ Builds a map from plain dictionaries, such as old pickles."""
+        id_map = cls()
+        id_map.NId_from_id.update(NId_from_id.keys(), NId_from_id.values())
+        id_map.id_from_NId.update(id_from_NId.keys(), id_from_NId.values())
+        return id_map
+
+    def __len__(self):
+        return len(self.NId_from_id)
+
+    def __contains__(self, node_id):
+        return node_id in self.NId_from_id
+
+    def add(self, node_id, NId):
+        self.NId_from_id[node_id] = NId
+        self.id_from_NId[NId] = node_id
+
+    def add_many(self, node_ids, NIds):
+        """ Bulk version of add."""
+        self.NId_from_id.update(node_ids, NIds)
+        self.id_from_NId.update(NIds, node_ids)
+
+    def NIds(self, node_ids):
+        """
+        :param node_ids: an array of ids
+        :return: an array of NIds, -1 for ids we don't know
+        """
+        return self.NId_from_id.lookup(node_ids, -1)
+
+    def ids(self, NIds):
+        """
+        :param NIds: an array of NIds
+        :return: an array of ids
+        """
+        return self.id_from_NId.lookup(NIds)
+
+    def copy_to_memory(self):
+        self.NId_from_id.copy_to_memory()
+        self.id_from_NId.copy_to_memory()
+
+    def to_sections(self):
+        """ :return: a dictionary of arrays, to be written in a snapshot"""
+        keys, values = self.NId_from_id.arrays()
+        return {'node_ids.keys': keys,
+                'node_ids.values': values,
+                'node_ids.ids': self.id_from_NId.values,
+                'node_ids.used': self.id_from_NId.used}
+
+    @classmethod
+    def from_sections(cls, sections, dict_lookups=True):
+        """ :param dict_lookups: see Int64Map """
+        id_map = cls()
+        id_map.NId_from_id = Int64Map(sections['node_ids.keys'],
+                                      sections['node_ids.values'],
+                                      dict_lookups)
+        id_map.id_from_NId = DenseInt64Array(sections['node_ids.ids'],
+                                             sections['node_ids.used'])
+        return id_map
+
+
+class EdgeIndex(object):
+    """
+    EIds of undirected edges, by the NIds of their ends. Each pair is packed
+    into a single int64 key, smallest NId first, so (a, b) and (b, a) are
+    the same edge. Unlike a defaultdict, looking up a missing edge never
+    adds anything.
+    """
+
+    def __init__(self, edge_map=None):
+        """ :param edge_map: an Int64Map of packed pair - EId """
+        self.edge_map = edge_map if edge_map is not None else Int64Map()
+
+    @staticmethod
+    def pack(NId1, NId2):
+        if NId2 < NId1:
+            NId1, NId2 = NId2, NId1
+        return (NId1 << 32) | NId2
+
+    @staticmethod
+    def pack_many(src_NIds, dst_NIds):
+        """ Bulk version of pack, for arrays of the same size."""
+        src_NIds = np.asarray(src_NIds, dtype=np.int64)
+        dst_NIds = np.asarray(dst_NIds, dtype=np.int64)
+        return (np.minimum(src_NIds, dst_NIds) << 32) | \
+            np.maximum(src_NIds, dst_NIds)
+
+    @staticmethod
+    def unpack_many(keys):
+        """ :return: (smallest NIds, largest NIds) arrays """
+        return keys >> 32, keys & 0xFFFFFFFF
+
+    @classmethod
+    def from_dict(cls, edge_from_tuple):
+        """ Builds an index from a dictionary of (NId1, NId2) - EId."""
+        edges = [(NIds[0], NIds[1], EId)
+                 for NIds, EId in edge_from_tuple.iteritems()
+                 if EId is not None]
+        edges = np.array(edges, dtype=np.int64).reshape(-1, 3)
+        index = cls()
+        index.add_many(edges[:, 0], edges[:, 1], edges[:, 2])
+        return index
+
+    def __len__(self):
+        return len(self.edge_map)
+
+    def __contains__(self, NIds):
+        return self.get(*NIds) is not None
+
+    def get(self, NId1, NId2, default=None):
+        """ :return: EId of the edge between NId1 and NId2, or default """
+        return self.edge_map.get(self.pack(NId1, NId2), default)
+
+    def add(self, NId1, NId2, EId):
+        self.edge_map[self.pack(NId1, NId2)] = EId
+
+    def add_many(self, src_NIds, dst_NIds, EIds):
+        """ Bulk version of add. If a pair repeats, the last EId wins."""
+        self.edge_map.update(self.pack_many(src_NIds, dst_NIds), EIds)
+
+    def lookup(self, src_NIds, dst_NIds, default=-1):
+        """
+        Bulk version of get.
+        :return: an int64 array of EIds, default where there is no edge.
+        """
+        return self.edge_map.lookup(self.pack_many(src_NIds, dst_NIds),
+                                    default)
+
+    def contains(self, src_NIds, dst_NIds):
+        """ :return: a boolean array, true where there is an edge """
+        # EIds are never negative
+        return self.lookup(src_NIds, dst_NIds) != -1
+
+    def edges(self):
+        """ :return: (smallest NIds, largest NIds, EIds) arrays """
+        keys, EIds = self.edge_map.arrays()
+        low, high = self.unpack_many(keys)
+        return low, high, EIds
+
+    def to_sections(self):
+        """ :return: a dictionary of arrays, to be written in a snapshot"""
+        keys, EIds = self.edge_map.arrays()
+        return {'edge_index.keys': keys,
+                'edge_index.eids': EIds}
+
+    def copy_to_memory(self):
+        self.edge_map.copy_to_memory()
+
+    @classmethod
+    def from_sections(cls, sections):
+        if 'edge_index.keys' in sections:
+            return cls(Int64Map(sections['edge_index.keys'],
+                                sections['edge_index.eids']))
+
+        # older snapshots have the pairs in separate arrays
+        index = cls()
+        index.add_many(sections['edges.src'], sections['edges.dst'],
+                       sections['edges.eid'])
+        return index
+
+
+class EdgeSpellStore(object):
+    """
+    Employment spells of each edge: (year, admission, demission) triples,
+    admission and demission being timestamps.
+    Spells are kept in CSR layout: spells of edge EId are found at
+    [offsets[EId], offsets[EId + 1]) in the years, admissions and
+    demissions arrays, sorted by year.
+    New spells are logged and only compacted into CSR when we read them,
+    so adding spells one at a time (or a batch at a time) is cheap.
+    """
+
+    def __init__(self):
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.years = np.empty(0, dtype=np.int32)
+        self.admissions = np.empty(0, dtype=np.float64)
+        self.demissions = np.empty(0, dtype=np.float64)
+        self._log = ([], [], [], [])
+        # logged batches of spells, as arrays, oldest first
+        self._batches = []
+
+    def __len__(self):
+        self.compact()
+        return len(self.years)
+
+    def add(self, EId, year, admission=np.nan, demission=np.nan):
+        """
+        Sets admission and/or demission of edge EId for year.
+        NaN values leave whatever we already had in place.
+        """
+        eids, years, admissions, demissions = self._log
+        eids.append(EId)
+        years.append(year)
+        admissions.append(admission)
+        demissions.append(demission)
+
+    def add_many(self, EIds, years, admissions, demissions):
+        """ Bulk version of add, for arrays of the same size."""
+        self._log_to_batch()
+        self._batches.append((np.array(EIds, dtype=np.int64),
+                              np.array(years, dtype=np.int32),
+                              np.array(admissions, dtype=np.float64),
+                              np.array(demissions, dtype=np.float64)))
+
+    def get(self, EId):
+        """
+        :return: (years, admissions, demissions) arrays of edge EId,
+            sorted by year. Empty arrays if the edge has no spells.
+        """
+        self.compact()
+        if not 0 <= EId < len(self.offsets) - 1:
+            return self.years[:0], self.admissions[:0], self.demissions[:0]
+        start = self.offsets[EId]
+        end = self.offsets[EId + 1]
+        return self.years[start:end], self.admissions[start:end], \
+            self.demissions[start:end]
+
+    def compact(self):
+        """ Moves logged spells into the CSR arrays."""
+        self._log_to_batch()
+        if len(self._batches) == 0:
+            return
+        batches = self._batches
+        self._batches = []
+        self._compact(*[np.concatenate(columns) for columns in zip(*batches)])
+
+    def _log_to_batch(self):
+        """ Turns spells added one at a time into a batch, keeping order."""
+        if len(self._log[0]) == 0:
+            return
+        eids, years, admissions, demissions = self._log
+        self._log = ([], [], [], [])
+        self._batches.append((np.array(eids, dtype=np.int64),
+                              np.array(years, dtype=np.int32),
+                              np.array(admissions, dtype=np.float64),
+                              np.array(demissions, dtype=np.float64)))
+
+    def _compact(self, eids, years, admissions, demissions):
+        # what we already have goes first, so that new values win.
+        old_eids = np.repeat(np.arange(len(self.offsets) - 1, dtype=np.int64),
+                             np.diff(self.offsets))
+        eids = np.concatenate([old_eids, eids])
+        years = np.concatenate([self.years, years])
+        admissions = np.concatenate([self.admissions, admissions])
+        demissions = np.concatenate([self.demissions, demissions])
+
+        # sort by edge, then year. lexsort is stable, so order is kept
+        # among entries of the same (edge, year)
+        order = np.lexsort((years, eids))
+        eids = eids[order]
+        years = years[order]
+
+        # one group per (edge, year)
+        new_group = np.ones(len(eids), dtype=bool)
+        new_group[1:] = (eids[1:] != eids[:-1]) | (years[1:] != years[:-1])
+        group = np.cumsum(new_group) - 1
+        starts = np.flatnonzero(new_group)
+
+        self.admissions = _last_valid_per_group(admissions[order], group,
+                                                len(starts))
+        self.demissions = _last_valid_per_group(demissions[order], group,
+                                                len(starts))
+        self.years = years[starts]
+
+        group_eids = eids[starts]
+        counts = np.bincount(group_eids) if len(group_eids) > 0 else \
+            np.zeros(0, dtype=np.int64)
+        self.offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=self.offsets[1:])
+
+    def to_sections(self):
+        """ :return: a dictionary of arrays, to be written in a snapshot"""
+        self.compact()
+        return {'spells.offsets': self.offsets,
+                'spells.years': self.years,
+                'spells.admissions': self.admissions,
+                'spells.demissions': self.demissions}
+
+    def copy_to_memory(self):
+        """ Stops using memory mapped arrays, see release_mapped."""
+        self.offsets = release_mapped(self.offsets)
+        self.years = release_mapped(self.years)
+        self.admissions = release_mapped(self.admissions)
+        self.demissions = release_mapped(self.demissions)
+
+    @classmethod
+    def from_sections(cls, sections):
+        store = cls()
+        store.offsets = sections['spells.offsets']
+        store.years = sections['spells.years']
+        store.admissions = sections['spells.admissions']
+        store.demissions = sections['spells.demissions']
+        return store
+
+    def __getstate__(self):
+        self.compact()
+        return self.__dict__
+
+
+def _last_valid_per_group(values, group, num_groups):
+    """
+    :param values: float array, NaN for missing values
+    :param group: sorted group number of each value
+    :return: the last non-NaN value of each group (NaN if there is none)
+    """
+    result = np.full(num_groups, np.nan)
+    valid = np.flatnonzero(~np.isnan(values))
+    if len(valid) == 0:
+        return result
+    valid_group = group[valid]
+    is_last = np.ones(len(valid), dtype=bool)
+    is_last[:-1] = valid_group[1:] != valid_group[:-1]
+    result[valid_group[is_last]] = values[valid[is_last]]
+    return result
+
+
+def build_adjacency(num_nodes, src, dst, EIds):
+    """
+    CSR adjacency lists of an undirected graph: the neighbors of node n
+    are neighbors[offsets[n]:offsets[n + 1]], sorted, and edges has the
+    EId of each of those (node, neighbor) pairs.
+    :param num_nodes: nodes are numbered from 0 to num_nodes - 1
+    :param src, dst, EIds: arrays with one entry per edge
+    :return: (offsets, neighbors, edges) int64 arrays
+    """
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    EIds = np.asarray(EIds, dtype=np.int64)
+
+    # each edge shows up in the lists of both its ends
+    rows = np.concatenate([src, dst])
+    neighbors = np.concatenate([dst, src])
+    edges = np.concatenate([EIds, EIds])
+    order = np.lexsort((neighbors, rows))
+
+    offsets = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=offsets[1:])
+    return offsets, neighbors[order], edges[order]
+
+
+# Snapshots are a single file with named numpy arrays ("sections"):
+#   magic string, header length (8 bytes), JSON header, then sections,
+#   each one aligned to SNAPSHOT_ALIGNMENT bytes.
+# The header has the version, the position of each section and a crc32
+# of all section bytes. Sections are memory mapped when read, so loading
+# is about as fast as the disk, and processes can share pages.
+SNAPSHOT_MAGIC = "CSE293SNAPSHOT\n"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_ALIGNMENT = 64
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def write_snapshot(file_path, sections):
+    """
+    Writes arrays to a snapshot file. We write to a temporary file
+    first, so a crash never leaves a half written snapshot behind.
+    :param sections: dictionary of name - 1 dimensional numpy array
+    """
+    names = sorted(sections.keys())
+    header_sections = {}
+    checksum = 0
+    offset = 0
+    end = 0
+    for name in names:
+        array = np.ascontiguousarray(sections[name])
+        sections[name] = array
+        header_sections[name] = {'offset': offset,
+                                 'dtype': array.dtype.str,
+                                 'length': len(array)}
+        checksum = _crc32(array, checksum)
+        end = offset + array.nbytes
+        offset = _align(end)
+
+    header = json.dumps({'version': SNAPSHOT_VERSION,
+                         'sections': header_sections,
+                         'checksum': checksum})
+    data_start = _align(len(SNAPSHOT_MAGIC) + 8 + len(header))
+
+    temp_path = file_path + ".tmp"
+    with open(temp_path, 'wb') as out:
+        out.write(SNAPSHOT_MAGIC)
+        out.write(struct.pack('<Q', len(header)))
+        out.write(header)
+        for name in names:
+            out.seek(data_start + header_sections[name]['offset'])
+            sections[name].tofile(out)
+        # make sure the file covers the last (possibly empty) section
+        out.truncate(data_start + end)
+    replace_file(temp_path, file_path)
+
+
+def replace_file(source_path, target_path):
+    """
+    Moves source_path to target_path, replacing it. os.rename does that
+    atomically, except on Windows, where it fails if target_path exists.
+    There we move the old file aside first, like Checkpoint does, and
+    only delete it once the new one is in place.
+    """
+    if os.name != 'nt' or not os.path.exists(target_path):
+        os.rename(source_path, target_path)
+        return
+    old_path = target_path + ".old"
+    if os.path.exists(old_path):
+        os.remove(old_path)
+    os.rename(target_path, old_path)
+    os.rename(source_path, target_path)
+    os.remove(old_path)
+
+
+def release_mapped(array):
+    """
+    :return: an in memory copy of array if it is memory mapped (from a
+        snapshot), array itself otherwise. Windows can't replace or delete
+        a file while any array still maps it, so we copy the sections in
+        before overwriting the snapshot they came from.
+    """
+    base = array
+    while base is not None:
+        if isinstance(base, np.memmap):
+            return np.array(array)
+        base = getattr(base, 'base', None)
+    return array
+
+
+def read_snapshot(file_path, mode='r', verify=True):
+    """
+    :param mode: 'r' for read only arrays, 'c' for copy on write ones.
+    :param verify: check the crc32 of the sections. This reads the whole file.
+    :return: (header dictionary, dictionary of name - memory mapped array)
+    """
+    with open(file_path, 'rb') as src:
+        if src.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+            raise SnapshotError(file_path + " is not a snapshot")
+        header_length, = struct.unpack('<Q', src.read(8))
+        header = json.loads(src.read(header_length))
+
+    if header['version'] != SNAPSHOT_VERSION:
+        raise SnapshotError("Unsupported snapshot version " +
+                            str(header['version']) + " in " + file_path)
+
+    data_start = _align(len(SNAPSHOT_MAGIC) + 8 + header_length)
+    sections = {}
+    checksum = 0
+    for name in sorted(header['sections'].keys()):
+        section = header['sections'][name]
+        dtype = np.dtype(str(section['dtype']))
+        if section['length'] == 0:
+            # can't memory map 0 bytes
+            array = np.empty(0, dtype=dtype)
+        else:
+            array = np.memmap(file_path, dtype=dtype, mode=mode,
+                              offset=data_start + section['offset'],
+                              shape=(section['length'],))
+        if verify:
+            checksum = _crc32(array, checksum)
+        sections[str(name)] = array
+
+    if verify and checksum != header['checksum']:
+        raise SnapshotError("Checksum mismatch in " + file_path)
+
+    return header, sections
+
+
+def _align(offset):
+    return (offset + SNAPSHOT_ALIGNMENT - 1) // SNAPSHOT_ALIGNMENT * \
+        SNAPSHOT_ALIGNMENT
+
+
+def _crc32(array, checksum, chunk_size=1 << 26):
+    """ crc32 of the array bytes, a chunk at a time."""
+    raw = array.view(np.uint8) if array.nbytes > 0 else array
+    for start in xrange(0, array.nbytes, chunk_size):
+        checksum = zlib.crc32(np.ascontiguousarray(raw[start:start + chunk_size]),
+                              checksum)
+    return checksum
+
+
+class ExternalSorter(object):
+    """
+    Sorts and deduplicates more int64 values than fit in memory,
+    such as packed pairs of NIds.
+    Values are kept in memory until they reach the memory budget, then
+    they are sorted, deduplicated and written to a run file on disk.
+    merged() does a k-way merge of all runs.
+    """
+
+    def __init__(self, memory_budget=2 ** 28, run_folder=None):
+        """
+        :param memory_budget: bytes we may use for buffering values.
+        :param run_folder: where to create a folder for run files,
+            defaults to the system temporary folder.
+        """
+        # sorting the buffer takes a copy of it, so we need twice its size
+        self.buffer_limit = max(memory_budget // 16, 1)
+        self.run_folder = tempfile.mkdtemp(prefix="runs_", dir=run_folder)
+        self.runs = []
+        self.buffer = []
+        self.buffered = 0
+
+    def add(self, values):
+        """ :param values: an array of int64 values"""
+        values = np.asarray(values, dtype=np.int64)
+        self.buffer.append(values)
+        self.buffered += len(values)
+        if self.buffered >= self.buffer_limit:
+            self.spill()
+
+    def spill(self):
+        """ Writes buffered values to a new run file."""
+        if self.buffered == 0:
+            return
+
+        run = np.unique(np.concatenate(self.buffer))
+        self.buffer = []
+        self.buffered = 0
+
+        run_path = os.path.join(self.run_folder,
+                                "run_" + str(len(self.runs)) + ".bin")
+        run.tofile(run_path)
+        self.runs.append(run_path)
+
+    def merged(self):
+        """
+        :return: a generator of sorted arrays, which together have every
+            value we were given exactly once, in order.
+        """
+        self.spill()
+
+        # each run gets a slice of the budget for reading. Values become
+        # python integers while merging, which take ~4 times the space.
+        chunk_size = max(self.buffer_limit // 4 // (len(self.runs) + 1), 1)
+        if len(self.runs) == 1:
+            for chunk in _read_chunks(self.runs[0], chunk_size):
+                yield chunk
+            return
+
+        run_values = [_chunk_values(_read_chunks(run_path, chunk_size))
+                      for run_path in self.runs]
+        output = []
+        last_value = None
+        for value in heapq.merge(*run_values):
+            if value == last_value:
+                continue
+            last_value = value
+            output.append(value)
+            if len(output) >= chunk_size:
+                yield np.array(output, dtype=np.int64)
+                output = []
+
+        if output:
+            yield np.array(output, dtype=np.int64)
+
+    def close(self):
+        """ Deletes all run files."""
+        self.runs = []
+        self.buffer = []
+        self.buffered = 0
+        shutil.rmtree(self.run_folder, ignore_errors=True)
+
+
+def _read_chunks(run_path, chunk_size):
+    with open(run_path, 'rb') as run:
+        while True:
+            chunk = np.fromfile(run, dtype=np.int64, count=chunk_size)
+            if len(chunk) == 0:
+                return
+            yield chunk
+
+
+def _chunk_values(chunks):
+    for chunk in chunks:
+        for value in chunk.tolist():
+            yield value
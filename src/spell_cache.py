@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+import logging
+from graph_storage import write_snapshot, read_snapshot, SnapshotError
+
+ENTRY_EXTENSION = ".spells"
+
+
+class SpellCache(object):
+    """
+    Interpreted columns of source files, kept on disk as snapshots, so that
+    files don't have to be parsed again as long as they don't change.
+    Entries are keyed by the path, size and modification time of the
+    source file, and by the version of what interpreted it: a change in
+    any of those is a miss.
+    When the cache gets bigger than max_bytes, the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, folder, max_bytes=None):
+        """
+        :param max_bytes: how big the cache may get, None for no limit.
+        """
+        self.folder = folder
+        self.max_bytes = max_bytes
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+
+    def get(self, file_path, version):
+        """
+        :return: dictionary of column name - array, or None if the cache
+            does not have this version of the file.
+        """
+        path = self._entry_path(file_path, version)
+        if not os.path.isfile(path):
+            return None
+        try:
+            _, columns = read_snapshot(path)
+        except SnapshotError:
+            logging.warn("Ignoring corrupted cache entry " + path)
+            os.remove(path)
+            return None
+
+        # most recently used, as far as eviction goes
+        os.utime(path, None)
+        return columns
+
+    def put(self, file_path, version, columns):
+        """
+        :param columns: dictionary of column name - 1 dimensional array
+        """
+        # entries of older versions of the file are of no use anymore
+        self.invalidate(file_path)
+        write_snapshot(self._entry_path(file_path, version), dict(columns))
+        self.evict()
+
+    def invalidate(self, file_path=None):
+        """ Removes the entries of a file, or all entries if none is given. """
+        prefix = "" if file_path is None else self._path_key(file_path)
+        for path in self._entry_paths():
+            if os.path.basename(path).startswith(prefix):
+                os.remove(path)
+
+    def evict(self):
+        """ Removes least recently used entries until we fit in max_bytes. """
+        if self.max_bytes is None:
+            return
+        entries = sorted((os.path.getmtime(path), os.path.getsize(path), path)
+                         for path in self._entry_paths())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def size(self):
+        """ :return: how many bytes the entries take """
+        return sum(os.path.getsize(path) for path in self._entry_paths())
+
+    def _entry_paths(self):
+        return [os.path.join(self.folder, name)
+                for name in os.listdir(self.folder)
+                if name.endswith(ENTRY_EXTENSION)]
+
+    def _entry_path(self, file_path, version):
+        stat = os.stat(file_path)
+        key = json.dumps([stat.st_size, stat.st_mtime, version])
+        return os.path.join(self.folder, self._path_key(file_path) + "_" +
+                            hashlib.sha1(key).hexdigest()[:16] +
+                            ENTRY_EXTENSION)
+
+    def _path_key(self, file_path):
+        return hashlib.sha1(os.path.abspath(file_path)).hexdigest()[:16]
@@ -1,6 +1,6 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from graph_manager import SnapManager
+from graph_manager import GraphView
 
 
 class StatisticsGatherer(object):
@@ -109,7 +109,7 @@ class StatisticsGatherer(object):
 
 def run_script(load_path):
     gatherer = StatisticsGatherer
-    graph = SnapManager().load_graph(load_path)
+    graph = GraphView().load_graph(load_path)
     sample = gatherer.get_node_sample(graph, 100)
 
     gatherer.calculate_node_specific_stats(sample, graph)
@@ -1,7 +1,10 @@
 import unittest
 import sys, os
+import csv
+import shutil
 import mock
 import logging
+import numpy as np
 sys.path.insert(0, '../src/')
 from build_affiliation_graph import *
 import data_parser
@@ -41,6 +44,8 @@ class TestBuildAffiliationGraph(unittest.TestCase):
 
         # cleanup
         os.remove(save_path)
+        os.remove(save_path.replace(".graph", ".snapshot"))
+        os.remove(save_path.replace(".graph", "_manifest.json"))
 
     def test_process_file(self):
 
@@ -55,6 +60,278 @@ class TestBuildAffiliationGraph(unittest.TestCase):
         # we should also see 3 employer nodes.
         self.assertEquals(8, graph.get_node_count())
 
+    def test_process_file_in_batches(self):
+        file_path = './test_data/raw_graph.csv'
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+
+        graph = graph_manager.SnapManager()
+        process_file(file_path, parser, interpreter_class, graph)
+
+        # batches should give us the very same graph
+        batch_graph = graph_manager.SnapManager()
+        process_file(file_path, parser, interpreter_class, batch_graph, 7)
+        self.assertEquals(8, batch_graph.get_node_count())
+        self.assert_same_graph(graph, batch_graph)
+
+    def test_process_files_in_parallel(self):
+        src_folder = "./test_data/"
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+        manager = graph_manager.SnapManager
+
+        graph = process_files(src_folder, parser, interpreter_class, manager,
+                              batch_size=None)
+        parallel_graph = process_files_in_parallel(src_folder, parser,
+                                                   interpreter_class, manager,
+                                                   n_jobs=2, batch_size=7)
+        self.assertEquals(8, parallel_graph.get_node_count())
+        self.assert_same_graph(graph, parallel_graph)
+
+        # several processes per file
+        parallel_graph = process_files_in_parallel(src_folder, parser,
+                                                   interpreter_class, manager,
+                                                   n_jobs=2, batch_size=7,
+                                                   parts_per_file=3)
+        self.assert_same_graph(graph, parallel_graph)
+
+    def test_extract_edges(self):
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+        edges = extract_edges('./test_data/raw_graph.csv', parser,
+                              interpreter_class, 7)
+
+        # every line in the file passes the filter
+        self.assertEquals(30, len(edges))
+        self.assertItemsEqual([1, 2, 3, 4, 5], set(edges['worker_id']))
+        self.assertItemsEqual([100, 200, 300], set(edges['employer_id']))
+
+        # and merging them gives the usual graph
+        graph = graph_manager.SnapManager()
+        merge_edges(edges, graph)
+        self.assertEquals(8, graph.get_node_count())
+
+    def test_update_graph(self):
+        # split our test data in 2 files, one added after the other
+        folder = "./test_update_folder/"
+        os.mkdir(folder)
+        with open("./test_data/raw_graph.csv") as src:
+            lines = src.readlines()
+        with open(folder + "a.csv", 'w') as first_file:
+            first_file.writelines(lines[:15])
+        save_path = "./test_update.graph"
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+
+        try:
+            _, read_paths, _ = update_graph(folder, parser, interpreter_class,
+                                            graph_manager.SnapManager,
+                                            save_path)
+            self.assertListEqual([folder + "a.csv"], read_paths)
+
+            with open(folder + "b.csv", 'w') as second_file:
+                second_file.writelines(lines[:1] + lines[15:])
+            graph, read_paths, employers = update_graph(
+                folder, parser, interpreter_class, graph_manager.SnapManager,
+                save_path)
+            self.assertListEqual([folder + "b.csv"], read_paths)
+            self.assertListEqual([100, 200, 300], employers.tolist())
+
+            # as if we read both at once
+            expected = graph_manager.SnapManager()
+            process_file(folder + "a.csv", parser, interpreter_class, expected)
+            process_file(folder + "b.csv", parser, interpreter_class, expected)
+            self.assert_same_graph(expected, graph)
+            saved = graph_manager.SnapManager().load_graph(save_path)
+            self.assert_same_graph(expected, saved)
+
+            # nothing new
+            _, read_paths, _ = update_graph(folder, parser, interpreter_class,
+                                            graph_manager.SnapManager,
+                                            save_path)
+            self.assertListEqual([], read_paths)
+
+            # changed files mean we start over
+            with open(folder + "a.csv", 'a') as first_file:
+                first_file.write(lines[20])
+            _, read_paths, _ = update_graph(folder, parser, interpreter_class,
+                                            graph_manager.SnapManager,
+                                            save_path)
+            self.assertItemsEqual([folder + "a.csv", folder + "b.csv"],
+                                  read_paths)
+            self.assertEquals(file_signature(folder + "a.csv"),
+                              load_manifest(save_path)[
+                                  os.path.abspath(folder + "a.csv")])
+
+            # and so do removed ones, whose lines must go too
+            os.remove(folder + "b.csv")
+            graph, read_paths, employers = update_graph(
+                folder, parser, interpreter_class, graph_manager.SnapManager,
+                save_path)
+            self.assertListEqual([folder + "a.csv"], read_paths)
+            self.assertIsNone(employers)
+            self.assertListEqual([os.path.abspath(folder + "a.csv")],
+                                 load_manifest(save_path).keys())
+            expected = graph_manager.SnapManager()
+            process_file(folder + "a.csv", parser, interpreter_class, expected)
+            self.assert_same_graph(expected, graph)
+        finally:
+            # cleanup
+            for path in [folder + "a.csv", folder + "b.csv", save_path,
+                         "./test_update.snapshot",
+                         "./test_update_manifest.json"]:
+                if os.path.isfile(path):
+                    os.remove(path)
+            os.rmdir(folder)
+
+    def test_process_files_with_checkpoints(self):
+        folder = "./test_checkpoint_folder/"
+        os.mkdir(folder)
+        with open("./test_data/raw_graph.csv") as src:
+            lines = src.readlines()
+        for index, name in enumerate(["a.csv", "b.csv", "c.csv"]):
+            with open(folder + name, 'w') as part:
+                part.writelines(lines[:1] + lines[1 + 10 * index:11 + 10 * index])
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+        save_path = "./test_checkpoint.graph"
+        checkpoint = graph_manager.Checkpoint("./test_checkpoint", every=1)
+
+        read_paths = []
+        def crash_on_third_file(file_path, *args):
+            if len(read_paths) == 2:
+                raise MemoryError()
+            read_paths.append(file_path)
+            return process_file(file_path, *args)
+
+        try:
+            expected = process_files(folder, parser, interpreter_class,
+                                     graph_manager.SnapManager)
+
+            with mock.patch('build_affiliation_graph.process_file',
+                            side_effect=crash_on_third_file):
+                with self.assertRaises(MemoryError):
+                    process_files(folder, parser, interpreter_class,
+                                  graph_manager.SnapManager, save_path,
+                                  checkpoint=checkpoint)
+            self.assertTrue(checkpoint.exists())
+            self.assertFalse(os.path.isfile(save_path))
+
+            with mock.patch('build_affiliation_graph.process_file',
+                            side_effect=process_file) as process_file_mock:
+                graph = process_files(folder, parser, interpreter_class,
+                                      graph_manager.SnapManager, save_path,
+                                      checkpoint=checkpoint, resume=True)
+                # only the file we crashed on is read again
+                self.assertEquals(1, process_file_mock.call_count)
+
+            self.assert_same_graph(expected, graph)
+            self.assertFalse(checkpoint.exists())
+        finally:
+            # cleanup
+            checkpoint.clear()
+            for path in [folder + "a.csv", folder + "b.csv", folder + "c.csv",
+                         save_path, "./test_checkpoint.snapshot",
+                         "./test_checkpoint_manifest.json"]:
+                if os.path.isfile(path):
+                    os.remove(path)
+            os.rmdir(folder)
+
+    def test_process_files_by_state(self):
+        folder = "./test_states_folder/"
+        os.mkdir(folder)
+        with open("./test_data/raw_graph.csv") as src:
+            lines = src.readlines()
+        for index, name in enumerate(["a.csv", "b.csv"]):
+            with open(folder + name, 'w') as part:
+                part.write(lines[0])
+                for i, line in enumerate(lines[1:]):
+                    if (i + index) % 3 == 0:
+                        line = line.replace(",438985,", ",355030,")
+                    elif (i + index) % 3 == 1:
+                        line = line.replace(",438985,", ",330455,")
+                    part.write(line)
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+        save_path = "./test_{}.graph"
+
+        try:
+            # tiny batches and buffers, so that partitions get spilled
+            saved_paths = process_files_by_state(folder, parser,
+                                                 interpreter_class,
+                                                 graph_manager.SnapManager,
+                                                 save_path, ['43', '35'],
+                                                 batch_size=4, max_buffered=5)
+            self.assertDictEqual(dict((state_code, save_path.format(state_code))
+                                      for state_code in ['43', '35']),
+                                 saved_paths)
+            for state_code in ['43', '35']:
+                expected = process_files(folder, parser, interpreter_class,
+                                         graph_manager.SnapManager,
+                                         batch_size=4, state_code=state_code)
+                self.assertLess(0, expected.get_node_count())
+
+                saved = graph_manager.SnapManager()
+                saved.load_graph(saved_paths[state_code])
+                self.assert_same_graph(expected, saved)
+        finally:
+            # cleanup
+            for path in [folder + "a.csv", folder + "b.csv"]:
+                os.remove(path)
+            os.rmdir(folder)
+            for state_code in ['43', '35']:
+                for path in [".graph", ".snapshot", "_manifest.json"]:
+                    path = save_path.format(state_code).replace(".graph", path)
+                    if os.path.isfile(path):
+                        os.remove(path)
+
+    def test_state_partitions(self):
+        partitions = StatePartitions(['43', '35'], max_buffered=4)
+        try:
+            edges = np.zeros(3, dtype=EDGE_DTYPE)
+            edges['worker_id'] = [1, 2, 3]
+            partitions.add({'43': edges[:2], '35': edges[2:]})
+            self.assertEquals(0, sum(partitions.spilled.values()))
+
+            # 35 got nothing this time, so it goes to disk first
+            partitions.add({'43': edges[:2], '35': edges[:0]})
+            self.assertEquals(1, partitions.spilled['35'])
+            self.assertEquals(0, partitions.spilled['43'])
+
+            # still too much, everything goes to disk
+            partitions.add({'43': edges, '35': edges})
+            self.assertEquals(0, sum(partitions.buffered.values()))
+
+            partitions.add({'43': edges[2:], '35': edges[:0]})
+            worker_ids = [list(edges['worker_id'])
+                          for edges in partitions.edges('43')]
+            self.assertListEqual([1, 2, 1, 2, 1, 2, 3, 3], sum(worker_ids, []))
+            worker_ids = [list(edges['worker_id'])
+                          for edges in partitions.edges('35')]
+            self.assertListEqual([3, 1, 2, 3], sum(worker_ids, []))
+
+            partitions.discard('35')
+            self.assertListEqual([], list(partitions.edges('35')))
+            self.assertEquals(8, sum(len(edges)
+                                     for edges in partitions.edges('43')))
+        finally:
+            partitions.close()
+        self.assertFalse(os.path.isdir(partitions.folder))
+
+    def assert_same_graph(self, expected, actual):
+        self.assertListEqual(expected.get_nodes(), actual.get_nodes())
+        self.assertEquals(expected.get_edge_count(), actual.get_edge_count())
+        for node in expected.get_nodes():
+            self.assertEquals(expected.get_node_attrs(node),
+                              actual.get_node_attrs(node))
+            self.assertItemsEqual(expected.get_neighboring_nodes(node),
+                                  actual.get_neighboring_nodes(node))
+            for neighbor in expected.get_neighboring_nodes(node):
+                edge = expected.get_edge_between(node, neighbor)
+                actual_edge = actual.get_edge_between(node, neighbor)
+                self.assertEquals(dict(expected.get_edge_attrs(edge)),
+                                  dict(actual.get_edge_attrs(actual_edge)))
+
     @mock.patch('build_affiliation_graph.create_nodes')
     @mock.patch('build_affiliation_graph.create_edges')
     @mock.patch('build_affiliation_graph.passes_filter', return_value=True)
@@ -201,6 +478,197 @@ class TestBuildAffiliationGraph(unittest.TestCase):
         interpreter.municipality = ''
         self.assertFalse(passes_filter(interpreter))
 
+        interpreter.municipality = '355030'
+        self.assertFalse(passes_filter(interpreter))
+        self.assertTrue(passes_filter(interpreter, '35'))
+        self.assertTrue(passes_filter(interpreter, None))
+
+    def test_process_files_rejections(self):
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+        rejections = data_parser.RejectionLog()
+        rejections.reject("PIS is invalid in", {'PIS': ''})
+        with mock.patch('build_affiliation_graph.logging') as logging_mock:
+            process_files("./test_data/", parser, interpreter_class,
+                          graph_manager.SnapManager, rejections=rejections)
+        logging_mock.warn.assert_called_with(rejections.summary())
+
+    def test_rejections_on_every_path(self):
+        folder = "./test_rejections_folder/"
+        os.mkdir(folder)
+        changes = {0: {'DT_ADMISSAO': '31022010'},
+                   1: {'DIADESL': '30', 'MES_DESLIG': '2'},
+                   2: {'DIADESL': '31', 'MES_DESLIG': '4'},
+                   3: {'MES_ADM': ''},
+                   4: {'PIS': 'x'}}
+        with open("./test_data/raw_graph.csv", "rb") as src:
+            with open(folder + "bad.csv", "wb") as dst:
+                reader = csv.reader(src)
+                writer = csv.writer(dst)
+                header = reader.next()
+                writer.writerow(header)
+                for i, line in enumerate(reader):
+                    for name, value in changes.get(i, {}).iteritems():
+                        line[header.index(name)] = value
+                    writer.writerow(line)
+
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+        manager = graph_manager.SnapManager
+        save_path = "./test_rejections.graph"
+        quarantine_path = "./test_rejections.tsv"
+        try:
+            expected = data_parser.RejectionLog()
+            process_files(folder, parser, interpreter_class, manager,
+                          batch_size=None, rejections=expected)
+            self.assertEquals(5, len(expected.counts))
+
+            found = data_parser.RejectionLog()
+            process_files(folder, parser, interpreter_class, manager,
+                          batch_size=4, rejections=found)
+            self.assertEquals(dict(expected.counts), dict(found.counts))
+
+            found = data_parser.RejectionLog(quarantine_path=quarantine_path)
+            process_files_in_parallel(folder, parser, interpreter_class,
+                                      manager, n_jobs=2, batch_size=4,
+                                      parts_per_file=2, rejections=found)
+            self.assertEquals(dict(expected.counts), dict(found.counts))
+            with open(quarantine_path) as quarantine:
+                self.assertEquals(expected.total(), len(quarantine.readlines()))
+            self.assertListEqual([], [name for name in os.listdir(".")
+                                      if name.startswith("test_rejections.tsv.")])
+
+            found = data_parser.RejectionLog()
+            update_graph(folder, parser, interpreter_class, manager,
+                         save_path, 4, rejections=found)
+            self.assertEquals(dict(expected.counts), dict(found.counts))
+        finally:
+            shutil.rmtree(folder)
+            for path in [save_path, save_path.replace(".graph", ".snapshot"),
+                         manifest_path(save_path), quarantine_path]:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+    def test_rejections_with_several_bad_fields(self):
+        # the batch path only rejects what the row path gets to look at
+        folder = "./test_dirty_folder/"
+        os.mkdir(folder)
+        bad_values = {'PIS': 'x', 'IDENTIFICAD': 'y', 'ANO': 'z',
+                      'DT_ADMISSAO': '31022010', 'DIADESL': '30',
+                      'MES_DESLIG': 'w', 'MUNICIPIO': '355030'}
+        random = np.random.RandomState(7)
+        with open("./test_data/raw_graph.csv", "rb") as src:
+            with open(folder + "dirty.csv", "wb") as dst:
+                reader = csv.reader(src)
+                writer = csv.writer(dst)
+                header = reader.next()
+                writer.writerow(header)
+                lines = list(reader)
+                for _ in xrange(20):
+                    for line in lines:
+                        line = list(line)
+                        for name, value in sorted(bad_values.iteritems()):
+                            if random.uniform() < 0.3:
+                                line[header.index(name)] = value
+                        writer.writerow(line)
+
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+        manager = graph_manager.SnapManager
+        try:
+            expected = data_parser.RejectionLog()
+            process_files(folder, parser, interpreter_class, manager,
+                          batch_size=None, rejections=expected)
+            self.assertItemsEqual(["PIS is invalid in",
+                                   "IDENTIFICAD is invalid in",
+                                   "ANO is invalid in",
+                                   "Could not parse DT_ADMISSAO for",
+                                   "MES_DESLIG or DIADESL is invalid in"],
+                                  expected.counts.keys())
+
+            for batch_size in [7, 100000]:
+                found = data_parser.RejectionLog()
+                process_files(folder, parser, interpreter_class, manager,
+                              batch_size=batch_size, rejections=found)
+                self.assertEquals(dict(expected.counts), dict(found.counts))
+
+            found = data_parser.RejectionLog()
+            process_files_in_parallel(folder, parser, interpreter_class,
+                                      manager, n_jobs=2, batch_size=7,
+                                      parts_per_file=2, rejections=found)
+            self.assertEquals(dict(expected.counts), dict(found.counts))
+        finally:
+            shutil.rmtree(folder)
+
+    def test_process_files_with_cache(self):
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+        cache_folder = "./test_cache/"
+        expected = process_files("./test_data/", parser, interpreter_class,
+                                 graph_manager.SnapManager, batch_size=None)
+        try:
+            cache = SpellCache(cache_folder)
+            with mock.patch('build_affiliation_graph.read_spells',
+                            side_effect=read_spells) as read_mock:
+                for _ in xrange(2):
+                    graph = process_files("./test_data/", parser,
+                                          interpreter_class,
+                                          graph_manager.SnapManager,
+                                          cache=cache)
+                    self.assert_same_graph(expected, graph)
+                # the second time, the file comes from the cache
+                self.assertEquals(1, read_mock.call_count)
+
+                # filters still apply to cached lines
+                graph = process_files("./test_data/", parser,
+                                      interpreter_class,
+                                      graph_manager.SnapManager,
+                                      state_code='35', cache=cache)
+                self.assertEquals(0, graph.get_node_count())
+                self.assertEquals(1, read_mock.call_count)
+        finally:
+            shutil.rmtree(cache_folder, ignore_errors=True)
+
+    def test_process_file_of_other_state(self):
+        # every line of this file is from Rio Grande do Sul
+        file_path = './test_data/raw_graph.csv'
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+
+        for batch_size in [None, 7]:
+            graph = graph_manager.SnapManager()
+            process_file(file_path, parser, interpreter_class, graph,
+                         batch_size, state_code='35')
+            self.assertEquals(0, graph.get_node_count())
+
+            graph = graph_manager.SnapManager()
+            process_file(file_path, parser, interpreter_class, graph,
+                         batch_size, state_code=None)
+            self.assertEquals(8, graph.get_node_count())
+
+        edges = extract_edges(file_path, parser, interpreter_class, 7,
+                              state_code='35')
+        self.assertEquals(0, len(edges))
+
+    def test_process_file_with_reordered_columns(self):
+        file_path = './test_data/raw_graph_reversed.csv'
+        with open('./test_data/raw_graph.csv', 'rb') as src:
+            with open(file_path, 'wb') as dst:
+                writer = csv.writer(dst)
+                for line in csv.reader(src):
+                    writer.writerow(line[::-1])
+
+        try:
+            parser = data_parser.Pis12DataParser()
+            interpreter_class = data_parser.Pis12DataInterpreter
+            for batch_size in [None, 7]:
+                graph = graph_manager.SnapManager()
+                process_file(file_path, parser, interpreter_class, graph,
+                             batch_size, state_code='43')
+                self.assertEquals(8, graph.get_node_count())
+        finally:
+            os.remove(file_path)
+
 
 # todo, make interpreter an ABC
 class FakeInterpreter():
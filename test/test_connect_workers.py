@@ -1,11 +1,17 @@
 import unittest
 import sys
+import os
 import logging
+import itertools
 from datetime import datetime
 from time import mktime
 sys.path.insert(0, '../src/')
+import mock
+import numpy as np
 import graph_manager
 import connect_workers
+import build_affiliation_graph
+import data_parser
 
 class WorkerConnector(unittest.TestCase):
     def setUp(self):
@@ -179,6 +185,37 @@ class WorkerConnector(unittest.TestCase):
                                                           59)
         self.assertEquals(79, time_together)
 
+    def test_get_spell_time_together(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+        connector = connect_workers.WorkerConnector()
+
+        # same results as get_time_together, with or without min_days
+        edges = [100, 200, 300, 400, 500, 600, 700, 800, 900, 1000, 1100]
+        for edge in edges:
+            for other_edge in edges:
+                for min_days in [None, 0, 20, 200]:
+                    expected = connector.get_time_together(
+                        manager.get_edge_attrs(edge),
+                        manager.get_edge_attrs(other_edge), min_days)
+                    actual = connector.get_spell_time_together(
+                        manager.get_edge_spells(edge),
+                        manager.get_edge_spells(other_edge), min_days)
+                    self.assertEquals(expected, actual)
+
+                    # without early exit, we get the whole time
+                    whole_time = connector.get_time_together(
+                        manager.get_edge_attrs(edge),
+                        manager.get_edge_attrs(other_edge))
+                    self.assertEquals(whole_time, connector.get_time_together(
+                        manager.get_edge_attrs(edge),
+                        manager.get_edge_attrs(other_edge), min_days, False))
+                    self.assertEquals(whole_time,
+                                      connector.get_spell_time_together(
+                                          manager.get_edge_spells(edge),
+                                          manager.get_edge_spells(other_edge),
+                                          min_days, False))
+
     def test_connect_workers_with_min_days(self):
         manager = graph_manager.SnapManager()
         self.create_affiliation_graph(manager)
@@ -215,6 +252,421 @@ class WorkerConnector(unittest.TestCase):
         self.assertFalse(new_graph.is_edge_between(1,9))
         self.assertFalse(new_graph.is_edge_between(9,1))
 
+    def test_connect_workers_from_graph_view(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+        manager.save_graph("./test_view.graph")
+        view = graph_manager.GraphView().load_graph("./test_view.graph")
+
+        for min_days in [-1, 1, 200]:
+            connector = connect_workers.WorkerConnector()
+            connector.min_days_together = min_days
+            expected = connector.connect_workers(manager,
+                                                 graph_manager.SnapManager())
+            actual = connector.connect_workers(view,
+                                               graph_manager.SnapManager())
+
+            self.assert_same_edges(expected, actual)
+            for worker in expected.get_nodes():
+                self.assertEqual(expected.get_node_attrs(worker),
+                                 actual.get_node_attrs(worker))
+
+        # cleanup
+        del view
+        os.remove("./test_view.graph")
+        os.remove("./test_view.snapshot")
+
+    def test_connect_workers_by_employer(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+
+        for min_days in [-1, 0, 1, 20, 200, 400]:
+            connector = connect_workers.WorkerConnector()
+            connector.min_days_together = min_days
+            expected = connector.connect_workers(manager,
+                                                 graph_manager.SnapManager())
+            actual = connector.connect_workers_by_employer(
+                manager, graph_manager.SnapManager())
+            self.assert_same_edges(expected, actual)
+
+    def test_connect_workers_by_employer_from_file(self):
+        manager = graph_manager.SnapManager()
+        build_affiliation_graph.process_file("./test_data/raw_graph.csv",
+                                             data_parser.Pis12DataParser(),
+                                             data_parser.Pis12DataInterpreter,
+                                             manager)
+
+        for min_days in [-1, 1, 30, 182, 365]:
+            connector = connect_workers.WorkerConnector()
+            connector.min_days_together = min_days
+            expected = connector.connect_workers(manager,
+                                                 graph_manager.SnapManager())
+            actual = connector.connect_workers_by_employer(
+                manager, graph_manager.SnapManager())
+            self.assert_same_edges(expected, actual)
+
+    def test_connect_workers_in_parallel(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+        build_affiliation_graph.process_file("./test_data/raw_graph.csv",
+                                             data_parser.Pis12DataParser(),
+                                             data_parser.Pis12DataInterpreter,
+                                             manager)
+        manager.save_graph("./test_parallel.graph")
+
+        for min_days in [-1, 1, 200]:
+            connector = connect_workers.WorkerConnector()
+            connector.min_days_together = min_days
+            expected = connector.connect_workers(manager,
+                                                 graph_manager.SnapManager())
+            for partitioning in ["size", "round_robin"]:
+                actual = connector.connect_workers_in_parallel(
+                    "./test_parallel.graph", graph_manager.SnapManager(),
+                    2, partitioning)
+                self.assert_same_edges(expected, actual)
+
+        # cleanup
+        os.remove("./test_parallel.graph")
+        os.remove("./test_parallel.snapshot")
+
+    def test_connect_workers_out_of_core(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+        build_affiliation_graph.process_file("./test_data/raw_graph.csv",
+                                             data_parser.Pis12DataParser(),
+                                             data_parser.Pis12DataInterpreter,
+                                             manager)
+
+        for min_days in [-1, 1, 200]:
+            connector = connect_workers.WorkerConnector()
+            connector.min_days_together = min_days
+            expected = connector.connect_workers(manager,
+                                                 graph_manager.SnapManager())
+            # room for 2 pairs at a time, so we get lots of runs
+            actual = connector.connect_workers_out_of_core(
+                manager, graph_manager.SnapManager(), 32, ".")
+            self.assert_same_edges(expected, actual)
+
+    def test_edge_list_writer(self):
+        workers = [1, 2, 3, 10 ** 11]
+        coworkers = [5, 6, 7, 8]
+        for binary in [False, True]:
+            for compress in [False, True]:
+                writer = connect_workers.EdgeListWriter("./test_edges",
+                                                        binary, compress, 3)
+                writer.add_edges(workers[:1], coworkers[:1])
+                writer.add_edges([], [])
+                writer.add_edges(workers[1:], coworkers[1:])
+                self.assertEqual(4, writer.close().edge_count)
+
+                written = connect_workers.read_edge_list("./test_edges",
+                                                         binary, compress)
+                self.assertListEqual(workers, written[0].tolist())
+                self.assertListEqual(coworkers, written[1].tolist())
+
+                if not binary and not compress:
+                    with open("./test_edges") as edges:
+                        self.assertEqual("1\t5\n", edges.readline())
+
+                writer = connect_workers.EdgeListWriter("./test_edges", binary,
+                                                        compress, append=True)
+                writer.add_edges([9], [10])
+                writer.close()
+                written = connect_workers.read_edge_list("./test_edges",
+                                                         binary, compress)
+                self.assertListEqual(workers + [9], written[0].tolist())
+                self.assertListEqual(coworkers + [10], written[1].tolist())
+
+        # cleanup
+        os.remove("./test_edges")
+
+    def test_connect_workers_into_edge_list(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+        manager.save_graph("./test_sink.graph")
+
+        for min_days in [-1, 1, 200]:
+            expected = self.edge_set_of(manager, min_days)
+
+            connect_workers.run_script("./test_sink.graph", "./test_edges.gz",
+                                       min_days, output="tsv")
+            workers, coworkers = connect_workers.read_edge_list(
+                "./test_edges.gz", compress=True)
+            self.assertSetEqual(expected, set(zip(workers, coworkers)))
+            self.assertEqual(len(expected), len(workers))
+
+            connect_workers.run_script("./test_sink.graph", "./test_edges",
+                                       min_days, n_jobs=2, output="binary")
+            workers, coworkers = connect_workers.read_edge_list(
+                "./test_edges", binary=True)
+            self.assertSetEqual(expected, set(zip(workers, coworkers)))
+            self.assertEqual(len(expected), len(workers))
+
+        # cleanup
+        for path in ["./test_sink.graph", "./test_sink.snapshot",
+                     "./test_edges.gz", "./test_edges"]:
+            os.remove(path)
+
+    def edge_set_of(self, manager, min_days):
+        """ :return: set of (worker, coworker) edges, worker < coworker"""
+        connector = connect_workers.WorkerConnector()
+        connector.min_days_together = min_days
+        graph = connector.connect_workers(manager, graph_manager.SnapManager())
+        edges = set()
+        for worker in graph.get_nodes():
+            for coworker in graph.get_neighboring_nodes(worker):
+                edges.add((min(worker, coworker), max(worker, coworker)))
+        return edges
+
+    def test_weighted_edges(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+        build_affiliation_graph.process_file("./test_data/raw_graph.csv",
+                                             data_parser.Pis12DataParser(),
+                                             data_parser.Pis12DataInterpreter,
+                                             manager)
+
+        connector = connect_workers.WorkerConnector()
+        # tiny buffers and chunks
+        weighted_edges = connector.get_weighted_edges(manager, 3, 2)
+        weighted_edges.save("./test_weights.snapshot")
+        loaded = connect_workers.WeightedEdges.load("./test_weights.snapshot")
+        self.assertEqual(len(weighted_edges), len(loaded))
+        self.assertEqual(np.int32, loaded.weights.dtype)
+
+        # weights are the whole time together, 1 and 2 only met at 10
+        small_manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(small_manager)
+        small_edges = connector.get_weighted_edges(small_manager)
+        pair = np.flatnonzero((small_edges.workers == 1) &
+                              (small_edges.coworkers == 2))
+        self.assertEqual(connector.get_spell_time_together(
+            small_manager.get_edge_spells(100),
+            small_manager.get_edge_spells(200)), small_edges.weights[pair[0]])
+
+        for min_days in [-1, 0, 1, 20, 182, 200, 365, 400]:
+            connector.min_days_together = min_days
+            expected = connector.connect_workers(manager,
+                                                 graph_manager.SnapManager())
+            actual = loaded.connect(min_days, graph_manager.SnapManager(),
+                                    manager)
+            self.assert_same_edges(expected, actual)
+
+        # cleanup
+        del loaded
+        os.remove("./test_weights.snapshot")
+
+    def test_run_thresholds_script(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+        manager.save_graph("./test_thresholds.graph")
+
+        # second time around, weights are read from disk
+        for _ in xrange(2):
+            connect_workers.run_thresholds_script(
+                "./test_thresholds.graph", "./test_connected{}.graph",
+                [1, 200], "./test_weights.snapshot")
+            for min_days in [1, 200]:
+                connected = graph_manager.SnapManager().load_graph(
+                    "./test_connected" + str(min_days) + ".graph")
+                connected_edges = set()
+                for worker in connected.get_nodes():
+                    for coworker in connected.get_neighboring_nodes(worker):
+                        connected_edges.add((min(worker, coworker),
+                                             max(worker, coworker)))
+                self.assertSetEqual(self.edge_set_of(manager, min_days),
+                                    connected_edges)
+
+        # cleanup
+        for path in ["./test_thresholds.graph", "./test_thresholds.snapshot",
+                     "./test_weights.snapshot", "./test_connected1.graph",
+                     "./test_connected1.snapshot", "./test_connected200.graph",
+                     "./test_connected200.snapshot"]:
+            os.remove(path)
+
+    def test_max_per_pair(self):
+        pairs, weights = connect_workers.max_per_pair(
+            np.array([5, 3, 5, 5, 3, 9]), np.array([1, 7, 4, 2, 0, 3]))
+        self.assertListEqual([3, 5, 9], pairs.tolist())
+        self.assertListEqual([7, 4, 3], weights.tolist())
+
+    def test_connect_workers_incrementally(self):
+        # employer 300 gets new data in a second file
+        folder = "./test_incremental_folder/"
+        os.mkdir(folder)
+        with open("./test_data/raw_graph.csv") as src:
+            lines = src.readlines()
+        new_lines = [line for line in lines[15:]
+                     if line.split(",")[25] == "300"]
+        with open(folder + "a.csv", 'w') as first_file:
+            first_file.writelines([line for line in lines
+                                   if line not in new_lines])
+        save_path = "./test_incremental.graph"
+        edges_path = "./test_incremental_edges"
+        parser = data_parser.Pis12DataParser()
+        interpreter_class = data_parser.Pis12DataInterpreter
+
+        try:
+            for min_days in [-1, 1, 30, 365, 400]:
+                connector = connect_workers.WorkerConnector()
+                connector.min_days_together = min_days
+
+                old_graph, _, _ = build_affiliation_graph.update_graph(
+                    folder, parser, interpreter_class,
+                    graph_manager.SnapManager, save_path)
+                connected = connector.connect_workers_by_employer(
+                    old_graph, graph_manager.SnapManager())
+                connector.connect_workers_by_employer(
+                    old_graph, connect_workers.EdgeListWriter(edges_path))
+
+                with open(folder + "b.csv", 'w') as second_file:
+                    second_file.writelines(lines[:1] + new_lines)
+                new_graph, _, employers = build_affiliation_graph.update_graph(
+                    folder, parser, interpreter_class,
+                    graph_manager.SnapManager, save_path)
+                self.assertListEqual([300], employers.tolist())
+
+                connector.connect_workers_incrementally(new_graph, connected,
+                                                        employers)
+                expected = connector.connect_workers(
+                    new_graph, graph_manager.SnapManager())
+                self.assert_same_edges(expected, connected)
+
+                # edge lists are added to, never truncated
+                with self.assertRaises(ValueError):
+                    connector.connect_workers_incrementally(
+                        new_graph, connect_workers.EdgeListWriter(
+                            "./test_edges_truncated"), employers)
+                connector.connect_workers_incrementally(
+                    new_graph, connect_workers.EdgeListWriter(
+                        edges_path, append=True), employers)
+                workers, coworkers = connect_workers.read_edge_list(edges_path)
+                self.assertSetEqual(self.edge_set_of(new_graph, min_days),
+                                    set(zip(np.minimum(workers, coworkers),
+                                            np.maximum(workers, coworkers))))
+
+                # start over
+                for path in [folder + "b.csv", save_path,
+                             "./test_incremental.snapshot",
+                             "./test_incremental_manifest.json"]:
+                    os.remove(path)
+        finally:
+            # cleanup
+            for path in [folder + "a.csv", folder + "b.csv", save_path,
+                         "./test_incremental.snapshot",
+                         "./test_incremental_manifest.json", edges_path,
+                         "./test_edges_truncated"]:
+                if os.path.isfile(path):
+                    os.remove(path)
+            os.rmdir(folder)
+
+    def test_connect_workers_with_checkpoints(self):
+        manager = graph_manager.SnapManager()
+        self.create_affiliation_graph(manager)
+        checkpoint = graph_manager.Checkpoint("./test_checkpoint", every=1)
+        connector = connect_workers.WorkerConnector()
+        connector.min_days_together = 1
+        expected = connector.connect_workers(manager,
+                                             graph_manager.SnapManager())
+
+        swept = []
+        get_coworker_pairs = connector.get_coworker_pairs
+        def crash_on_third_employer(workers, spells):
+            if len(swept) == 2:
+                raise MemoryError()
+            swept.append(workers)
+            return get_coworker_pairs(workers, spells)
+
+        try:
+            with mock.patch.object(connector, 'get_coworker_pairs',
+                                   side_effect=crash_on_third_employer):
+                with self.assertRaises(MemoryError):
+                    connector.connect_workers_by_employer(
+                        manager, graph_manager.SnapManager(), checkpoint)
+            self.assertEquals(2, checkpoint.load()[1]["employers"])
+
+            with mock.patch.object(connector, 'get_coworker_pairs',
+                                   side_effect=get_coworker_pairs) as mocked:
+                actual = connector.connect_workers_by_employer(
+                    manager, graph_manager.SnapManager(), checkpoint, True)
+                self.assertEquals(1, mocked.call_count)
+            self.assert_same_edges(expected, actual)
+
+            # edge sinks other than graphs have no checkpoints
+            with self.assertRaises(ValueError):
+                connector.connect_workers_by_employer(
+                    manager, connect_workers.EdgeSink(), checkpoint)
+        finally:
+            checkpoint.clear()
+
+    def test_partition_employers(self):
+        sizes = [1, 10, 2, 9, 3, 1]
+        parts = connect_workers.partition_employers(sizes, 2)
+        # the biggest employer is about as costly as all the others
+        self.assertListEqual([1], parts[0].tolist())
+        self.assertListEqual([0, 2, 3, 4, 5], parts[1].tolist())
+
+        parts = connect_workers.partition_employers(sizes, 4, "round_robin")
+        self.assertListEqual([[0, 4], [1, 5], [2], [3]],
+                             [part.tolist() for part in parts])
+
+        with self.assertRaises(ValueError):
+            connect_workers.partition_employers(sizes, 2, "random")
+
+    def test_sweep_overlaps(self):
+        connector = connect_workers.WorkerConnector()
+        random = np.random.RandomState(42)
+        day = 24 * 60 * 60.0
+        workers = range(100, 130)
+        spells = []
+        for _ in workers:
+            years = np.unique(random.randint(1979, 1985, 4)).astype(np.int32)
+            starts = np.floor(random.uniform(0, 60, len(years))) * day + \
+                random.choice([0, 0.5 * day, -0.5 * day], len(years))
+            ends = starts + np.floor(random.uniform(-3, 60, len(years))) * day
+            starts[random.uniform(size=len(years)) < 0.1] = np.nan
+            spells.append((years, starts, ends))
+
+        pair_days = connect_workers.sweep_overlaps(workers, spells)
+        for i, worker in enumerate(workers):
+            for j in xrange(i + 1, len(workers)):
+                expected = connector.get_spell_time_together(spells[i],
+                                                             spells[j])
+                self.assertEqual(expected,
+                                 pair_days.get((worker, workers[j]), 0))
+
+        self.assertDictEqual({}, connect_workers.sweep_overlaps([1], spells[:1]))
+
+        # big employers go a block at a time, with the same days together
+        shuffled = list(reversed(workers))
+        for chunk_size in [1, 50, 10000]:
+            found = {}
+            for pairs, days in connect_workers.iter_overlaps(
+                    shuffled, spells[::-1], chunk_size):
+                self.assertLessEqual(len(pairs), max(chunk_size, 29))
+                NIds, other_NIds = connect_workers.unpack_pairs(pairs)
+                found.update(zip(zip(NIds.tolist(), other_NIds.tolist()),
+                                 days.tolist()))
+            self.assertDictEqual(dict(pair_days), found)
+
+    def test_iter_packed_pairs(self):
+        NIds = [7, 3, 12, 0, 5, 9]
+        expected = connect_workers.pack_pairs(
+            itertools.combinations(sorted(NIds), 2)).tolist()
+        for chunk_size in [1, 4, 15, 100]:
+            chunks = list(connect_workers.iter_packed_pairs(NIds, chunk_size))
+            self.assertListEqual(expected, sum([chunk.tolist()
+                                                for chunk in chunks], []))
+            self.assertLessEqual(len(chunks[0]), max(chunk_size, 5))
+        self.assertListEqual([], list(connect_workers.iter_packed_pairs([3])))
+
+    def assert_same_edges(self, expected, actual):
+        self.assertListEqual(sorted(expected.get_nodes()),
+                             sorted(actual.get_nodes()))
+        for node in expected.get_nodes():
+            self.assertListEqual(expected.get_neighboring_nodes(node),
+                                 actual.get_neighboring_nodes(node))
+
     def test_connect_workers_no_min_days(self):
         manager = graph_manager.SnapManager()
         self.create_affiliation_graph(manager)
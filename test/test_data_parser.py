@@ -1,11 +1,19 @@
 import unittest
 import logging
+import os
+import csv
+import pickle
 from datetime import datetime
 from time import mktime
 import sys
 sys.path.insert(0, '../src/')
 from data_parser import Pis12DataParser
 from data_parser import Pis12DataInterpreter
+from data_parser import Pis12BatchInterpreter
+from data_parser import StateFilter
+from data_parser import RejectionLog
+from data_parser import LruMemo
+import numpy as np
 
 class TestPis12DataParser(unittest.TestCase):
 
@@ -102,6 +110,136 @@ class TestPis12DataParser(unittest.TestCase):
             lines_read += 1
         self.assertEquals(30, lines_read)
 
+    def test_split_file(self):
+        parser = Pis12DataParser()
+        file_path = "./test_data/raw_graph.csv"
+        serial_lines = list(parser.lines_reader(file_path))
+
+        for num_parts in [1, 2, 4, 7, 100]:
+            byte_ranges = parser.split_file(file_path, num_parts)
+            self.assertLessEqual(len(byte_ranges), num_parts)
+            self.assertEquals(0, byte_ranges[0][0])
+            self.assertEquals(os.path.getsize(file_path), byte_ranges[-1][1])
+            self.assertTrue(parser.validate_split(file_path, byte_ranges))
+
+            # same lines, in the same order
+            lines = []
+            for byte_range in byte_ranges:
+                lines.extend(parser.lines_reader(file_path, 0, byte_range))
+            self.assertListEqual(serial_lines, lines)
+
+        # fetch_num applies to each range
+        byte_ranges = parser.split_file(file_path, 2)
+        for byte_range in byte_ranges:
+            lines = list(parser.lines_reader(file_path, 3, byte_range))
+            self.assertEquals(3, len(lines))
+
+        # ranges that don't add up should not validate
+        self.assertFalse(parser.validate_split(file_path, byte_ranges[:1]))
+
+        # batches work the same way
+        pis = []
+        for byte_range in parser.split_file(file_path, 3):
+            for batch in parser.batch_reader(file_path, 0, 4, byte_range):
+                pis.extend(batch['PIS'])
+        self.assertListEqual([line[45] for line in serial_lines], pis)
+
+    def test_batch_reader(self):
+        parser = Pis12DataParser()
+
+        # read entire file, in batches of 7 lines
+        batch_sizes = []
+        for batch in parser.batch_reader("./test_data/raw_graph.csv", 0, 7):
+            self.assertIn('PIS', batch)
+            self.assertIn('MUNICIPIO', batch)
+            self.assertNotIn('SEXO', batch)
+            batch_sizes.append(len(batch['PIS']))
+        self.assertListEqual([7, 7, 7, 7, 2], batch_sizes)
+
+        # read just a bit
+        batch_sizes = []
+        for batch in parser.batch_reader("./test_data/raw_graph.csv", 22, 10):
+            batch_sizes.append(len(batch['ANO']))
+        self.assertListEqual([10, 10, 2], batch_sizes)
+
+        # columns hold the same values as parse_line would give us
+        batch = parser.batch_reader("./test_data/raw_graph.csv").next()
+        lines = parser.lines_reader("./test_data/raw_graph.csv")
+        for i, line in enumerate(lines):
+            parsed_line = parser.parse_line(line)
+            for name in batch:
+                self.assertEquals(parsed_line[name], batch[name][i])
+
+    def test_state_filter(self):
+        line = ",".join(str(i) for i in xrange(67)) + "\n"
+        state_filter = StateFilter("38")
+        self.assertTrue(state_filter(line))
+        self.assertFalse(StateFilter("43")(line))
+
+        # a quoted comma before MUNICIPIO does not split the field,
+        # so naively splitting the line would find field 37 instead
+        quoted = line.replace(",1,", ',"1,5",', 1).replace(",37,", ",43,")
+        self.assertTrue(state_filter(quoted))
+        self.assertFalse(StateFilter("43")(quoted))
+
+        # quotes after MUNICIPIO don't matter
+        self.assertTrue(state_filter(line.replace(",50,", ',"50,1",', 1)))
+
+        # short lines are left for the parser to complain about
+        self.assertTrue(state_filter("1,2,3\n"))
+
+        # MUNICIPIO may be somewhere else in other files
+        columns = ["c" + str(i) for i in xrange(67)]
+        columns[5] = 'MUNICIPIO'
+        self.assertTrue(state_filter.with_columns(columns)(
+            line.replace(",5,", ",3855,")))
+        self.assertFalse(state_filter.with_columns(columns)(line))
+
+        # even the last one
+        last = StateFilter("43", 3)
+        self.assertTrue(last("0,1,2,4314902\n"))
+        self.assertFalse(last("0,1,2,3550308\n"))
+        self.assertTrue(last('0,"1,5",2,4314902\n'))
+        self.assertFalse(last('0,"1,5",2,3550308\n'))
+        self.assertTrue(last('0,1,2,"4314902"\n'))
+
+    def test_lines_reader_with_filter(self):
+        parser = Pis12DataParser()
+        file_path = "./test_data/raw_graph_states.csv"
+        with open("./test_data/raw_graph.csv") as src:
+            lines = src.readlines()
+        with open(file_path, "w") as dst:
+            dst.write(lines[0])
+            for i, line in enumerate(lines[1:]):
+                if i % 3 == 0:
+                    line = line.replace(",438985,", ",355030,")
+                dst.write(line)
+
+        try:
+            expected = [line for line in parser.lines_reader(file_path)
+                        if line[38].startswith("43")]
+            self.assertEquals(20, len(expected))
+            lines = list(parser.lines_reader(file_path, 0, None,
+                                             StateFilter("43")))
+            self.assertListEqual(expected, lines)
+
+            # fetch_num counts lines that pass the filter
+            lines = list(parser.lines_reader(file_path, 5, None,
+                                             StateFilter("35")))
+            self.assertEquals(5, len(lines))
+
+            # and batches are filtered too, for any byte range
+            pis = []
+            for byte_range in parser.split_file(file_path, 3):
+                for batch in parser.batch_reader(file_path, 0, 4, byte_range,
+                                                 StateFilter("43")):
+                    self.assertTrue(all(municipality.startswith("43") for
+                                        municipality in batch['MUNICIPIO']))
+                    pis.extend(batch['PIS'])
+            self.assertListEqual([line[45] for line in expected], pis)
+        finally:
+            os.remove(file_path)
+
     def test_parse_line(self):
         parser = Pis12DataParser()
 
@@ -129,6 +267,65 @@ class TestPis12DataParser(unittest.TestCase):
         self.assertEquals('1', answer['PIS'])
         self.assertEquals('100', answer['IDENTIFICAD'])
 
+        # reads like the dictionary we used to build
+        expected = {'ANO': '2010', 'ANO_ADM': '', 'ANO_NASCIMENT': '',
+                    'DIADESL': '', 'DT_ADMISSAO': '', 'EMP_EM_31_12': '1',
+                    'IDENTIFICAD': '100', 'MES_ADM': '7', 'MES_DESLIG': '5',
+                    'PIS': '1', 'MUNICIPIO': '4483'}
+        self.assertEquals(expected, answer)
+        self.assertEquals(expected, dict(answer))
+        self.assertEquals(expected, eval(repr(answer)))
+        self.assertIn('MUNICIPIO', answer)
+        self.assertIsNone(answer.get('SEXO'))
+
+        # the same record is reused for the next line
+        other_line = list(valid_line)
+        other_line[0] = '2011'
+        self.assertIs(answer, parser.parse_line(other_line))
+        self.assertEquals('2011', answer['ANO'])
+
+    def test_columns_from_header(self):
+        parser = Pis12DataParser()
+        self.assertEquals(67, len(parser.schema))
+        file_path = "./test_data/raw_graph_reversed.csv"
+        with open("./test_data/raw_graph.csv", "rb") as src:
+            with open(file_path, "wb") as dst:
+                writer = csv.writer(dst)
+                for line in csv.reader(src):
+                    writer.writerow(line[::-1])
+
+        try:
+            names = ['ANO', 'PIS', 'IDENTIFICAD', 'MUNICIPIO', 'DT_ADMISSAO']
+            expected = [dict((name, parser.parse_line(line)[name])
+                             for name in names)
+                        for line in parser.lines_reader("./test_data/raw_graph.csv")]
+            found = [dict((name, parser.parse_line(line)[name])
+                          for name in names)
+                     for line in parser.lines_reader(file_path)]
+            self.assertListEqual(expected, found)
+
+            batch = parser.batch_reader(file_path).next()
+            for name in names:
+                self.assertListEqual([values[name] for values in expected],
+                                     list(batch[name]))
+
+            # state filters find MUNICIPIO from the header too
+            self.assertEquals(len(expected), len(list(
+                parser.lines_reader(file_path, 0, None, StateFilter("43")))))
+            self.assertEquals(0, len(list(
+                parser.lines_reader(file_path, 0, None, StateFilter("35")))))
+            batch = parser.batch_reader(file_path, 0, 100, None,
+                                        StateFilter("43")).next()
+            self.assertEquals(len(expected), len(batch['PIS']))
+
+            # parsers can be sent to other processes
+            copy = pickle.loads(pickle.dumps(parser))
+            self.assertEquals(parser.columns, copy.columns)
+            line = parser.lines_reader(file_path).next()
+            self.assertEquals('1', copy.parse_line(line)['PIS'])
+        finally:
+            os.remove(file_path)
+
 
 class TestPis12DataInterpreter(unittest.TestCase):
 
@@ -377,6 +574,153 @@ class TestPis12DataInterpreter(unittest.TestCase):
         self.assertIn("IDENTIFICAD is invalid in", interpreter.log_message)
         self.assertEquals(-1, answer)
 
+    def test_rejections(self):
+        rejections = RejectionLog()
+        interpreter = Pis12DataInterpreter(rejections)
+        self.assertIsNone(interpreter.log_message)
+
+        interpreter.feed_line({'PIS': '1', 'IDENTIFICAD': 'asd'})
+        self.assertEquals(1, interpreter.worker_id)
+        self.assertEquals(-1, interpreter.employer_id)
+        interpreter.feed_line({'PIS': '', 'IDENTIFICAD': 'asd'})
+        self.assertEquals(-1, interpreter.worker_id)
+        self.assertEquals(-1, interpreter.employer_id)
+        self.assertEquals({"IDENTIFICAD is invalid in": 2,
+                           "PIS is invalid in": 1}, dict(rejections.counts))
+
+        # the message is about the line as it was, even if it is changed
+        line = {'PIS': 'x'}
+        interpreter.feed_line(line)
+        self.assertEquals(-1, interpreter.worker_id)
+        line['PIS'] = 'y'
+        self.assertEquals("PIS is invalid in: {'PIS': 'x'}",
+                          interpreter.log_message)
+        self.assertListEqual([{'PIS': ''}, {'PIS': 'x'}],
+                             [dict((key, sample[key]) for key in ['PIS'])
+                              for sample in rejections.samples["PIS is invalid in"]])
+
+        # batches count the same lines
+        batch_rejections = RejectionLog()
+        batch_interpreter = Pis12BatchInterpreter(Pis12DataInterpreter,
+                                                  batch_rejections)
+        batch_interpreter.feed_batch({'PIS': np.array(['1', '', 'x']),
+                                      'IDENTIFICAD': np.array(['asd', 'asd', '2'])})
+        self.assertListEqual([1, -1, -1], list(batch_interpreter.worker_id))
+        self.assertListEqual([-1, -1, 2], list(batch_interpreter.employer_id))
+        # but like passes_filter, they only look at IDENTIFICAD if PIS is valid
+        self.assertEquals({"IDENTIFICAD is invalid in": 1,
+                           "PIS is invalid in": 2}, dict(batch_rejections.counts))
+
+    def test_date_rejections(self):
+        usual = {'PIS': '1', 'IDENTIFICAD': '2', 'ANO': '2010',
+                 'DT_ADMISSAO': '01012010', 'ANO_ADM': '', 'MES_ADM': '',
+                 'DIADESL': '', 'MES_DESLIG': ''}
+        changes = [{},
+                   {'DT_ADMISSAO': '31022010'},
+                   {'DT_ADMISSAO': ''},
+                   {'DT_ADMISSAO': '5'},
+                   {'DIADESL': '30', 'MES_DESLIG': '2'},
+                   {'DIADESL': '0', 'MES_DESLIG': '5'},
+                   {'DIADESL': '31', 'MES_DESLIG': '4'},
+                   {'DIADESL': 'x', 'MES_DESLIG': '4'},
+                   {'ANO': 'asd'}]
+        lines = []
+        for change in changes:
+            line = dict(usual)
+            line.update(change)
+            lines.append(line)
+
+        rejections = RejectionLog()
+        interpreter = Pis12DataInterpreter(rejections)
+        row_valid = []
+        for line in lines:
+            interpreter.feed_line(line)
+            # dates of lines without a year are never looked at
+            if interpreter.year != -1:
+                row_valid.append((interpreter.admission_date != -1,
+                                  interpreter.demission_date != -1))
+
+        batch_rejections = RejectionLog()
+        batch_interpreter = Pis12BatchInterpreter(Pis12DataInterpreter,
+                                                  batch_rejections)
+        batch_interpreter.feed_batch(dict(
+            (name, np.array([line[name] for line in lines]))
+            for name in usual))
+        with_year = batch_interpreter.year != -1
+        self.assertListEqual(row_valid, zip(
+            batch_interpreter.admission_valid[with_year].tolist(),
+            batch_interpreter.demission_valid[with_year].tolist()))
+        self.assertEquals({"Could not parse DT_ADMISSAO for": 2,
+                           "could not get admission date for": 1,
+                           "Weird february date in": 1,
+                           "Inconsistent MES_DESLIG or DIADESL in": 1,
+                           "MES_DESLIG or DIADESL is invalid in": 2,
+                           "ANO is invalid in": 1}, dict(rejections.counts))
+        self.assertEquals(dict(rejections.counts), dict(batch_rejections.counts))
+
+    def test_memoized_dates(self):
+        parser = Pis12DataParser()
+        lines = [dict(parser.parse_line(line)) for line in
+                 parser.lines_reader("./test_data/raw_graph.csv")]
+        # a few bad ones, which should be rejected every time
+        lines += [{'DT_ADMISSAO': '99999999', 'ANO_ADM': '', 'MES_ADM': '',
+                   'DIADESL': '', 'MES_DESLIG': '', 'ANO': 'asd'}] * 3
+        # and some that are rejected twice: march 1st of year -1 is invalid
+        lines += [{'DT_ADMISSAO': '01012010', 'ANO_ADM': '', 'MES_ADM': '',
+                   'DIADESL': '30', 'MES_DESLIG': '2', 'ANO': 'asd'}] * 3
+
+        def interpret(interpreter):
+            found = []
+            for line in lines:
+                interpreter.feed_line(line)
+                found.append((interpreter.admission_date,
+                              interpreter.admission_timestamp,
+                              interpreter.demission_date,
+                              interpreter.demission_timestamp))
+            return found
+
+        memoized = Pis12DataInterpreter()
+        not_memoized = Pis12DataInterpreter(memo_size=0)
+        self.assertListEqual(interpret(not_memoized), interpret(memoized))
+        self.assertEquals(dict(not_memoized.rejections.counts),
+                          dict(memoized.rejections.counts))
+        self.assertEquals(6, memoized.rejections.counts["ANO is invalid in"])
+        self.assertEquals(3, memoized.rejections.counts[
+            "Could not parse DT_ADMISSAO for"])
+        self.assertEquals(3, memoized.rejections.counts[
+            "Weird february date in"])
+        self.assertEquals(6, memoized.rejections.counts[
+            "MES_DESLIG or DIADESL is invalid in"])
+
+        stats = memoized.memo_stats()
+        self.assertLess(0, stats['admission']['hits'])
+        self.assertEquals(len(lines), stats['demission']['hits'] +
+                          stats['demission']['misses'])
+        self.assertEquals(0, not_memoized.memo_stats()['admission']['size'])
+
+    def test_lru_memo(self):
+        memo = LruMemo(2)
+        memo.put('a', 1)
+        memo.put('b', 2)
+        self.assertEquals(1, memo.get('a'))
+        # b was used least recently
+        memo.put('c', 3)
+        self.assertIsNone(memo.get('b'))
+        self.assertEquals(1, memo.get('a'))
+        self.assertEquals(3, memo.get('c'))
+        self.assertEquals({'hits': 3, 'misses': 1, 'size': 2}, memo.stats())
+
+        # keys that don't repeat are not worth remembering
+        memo = LruMemo(10)
+        for i in xrange(9):
+            self.assertIsNone(memo.get(i))
+            memo.put(i, i + 1)
+        self.assertTrue(memo.enabled)
+        self.assertIsNone(memo.get(9))
+        self.assertFalse(memo.enabled)
+        memo.put(9, 1)
+        self.assertIsNone(memo.get(9))
+
     def test_municipality(self):
         interpreter = Pis12DataInterpreter()
         interpreter.feed_line({'MUNICIPIO':'553333'})
@@ -422,6 +766,173 @@ class TestPis12DataInterpreter(unittest.TestCase):
 
 
 
+class TestRejectionLog(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    def test_reservoir(self):
+        rejections = RejectionLog(sample_size=3, seed=13)
+        for i in xrange(1000):
+            rejections.reject("bad", {'PIS': i})
+        rejections.reject("worse", {'PIS': -1})
+
+        self.assertEquals(1001, rejections.total())
+        self.assertEquals(3, len(rejections.samples["bad"]))
+        self.assertEquals(3, len(set(sample['PIS'] for sample
+                                     in rejections.samples["bad"])))
+        # any line could have been kept, not just the first ones
+        self.assertLess(3, max(sample['PIS'] for sample
+                               in rejections.samples["bad"]))
+
+        summary = rejections.summary().split("\n")
+        self.assertEquals("1001 lines were rejected or adjusted:", summary[0])
+        self.assertTrue(summary[1].startswith("  bad 1000 lines, such as"))
+        self.assertEquals("  worse 1 lines, such as {'PIS': -1}", summary[2])
+        self.assertEquals("No lines were rejected", RejectionLog().summary())
+
+    def test_quarantine(self):
+        quarantine_path = "./test_quarantine.tsv"
+        rejections = RejectionLog(quarantine_path=quarantine_path,
+                                  block_size=4)
+        try:
+            for i in xrange(10):
+                rejections.reject("bad", {'PIS': str(i)})
+            # only whole blocks are written until we close it
+            with open(quarantine_path) as quarantine:
+                self.assertEquals(8, len(quarantine.readlines()))
+
+            rejections.close()
+            with open(quarantine_path) as quarantine:
+                lines = quarantine.readlines()
+            self.assertEquals(10, len(lines))
+            self.assertEquals('bad\t{"PIS": "9"}\n', lines[-1])
+        finally:
+            os.remove(quarantine_path)
+
+    def test_merge(self):
+        quarantine_path = "./test_quarantine.tsv"
+        rejections = RejectionLog(sample_size=3, quarantine_path=quarantine_path)
+        other = RejectionLog(quarantine_path=quarantine_path + ".0")
+        try:
+            rejections.reject("bad", {'PIS': '1'})
+            for i in xrange(4):
+                other.reject("bad", {'PIS': str(i)})
+            other.reject("worse", {'PIS': 'x'})
+
+            rejections.merge(other)
+            self.assertEquals({"bad": 5, "worse": 1}, dict(rejections.counts))
+            self.assertEquals(3, len(rejections.samples["bad"]))
+            self.assertListEqual([{'PIS': 'x'}], rejections.samples["worse"])
+
+            rejections.close()
+            with open(quarantine_path) as quarantine:
+                self.assertEquals(6, len(quarantine.readlines()))
+            # the caller removes it
+            self.assertTrue(os.path.isfile(quarantine_path + ".0"))
+
+            # without a quarantine of our own, we take theirs
+            rejections = RejectionLog()
+            rejections.merge(RejectionLog(quarantine_path=quarantine_path))
+            self.assertEquals(quarantine_path, rejections.quarantine_path)
+            rejections.reject("bad", {'PIS': 'y'})
+            rejections.close()
+            with open(quarantine_path) as quarantine:
+                self.assertEquals(7, len(quarantine.readlines()))
+        finally:
+            for path in [quarantine_path, quarantine_path + ".0"]:
+                if os.path.isfile(path):
+                    os.remove(path)
+
+
+class TestPis12BatchInterpreter(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+
+    # (ANO, DT_ADMISSAO, ANO_ADM, MES_ADM, DIADESL, MES_DESLIG)
+    rows = [('2015', '10082015', '', '', '24', '12'),
+            ('1986', '5041986', '', '', '', ''),
+            ('1986', '541986', '', '', 'NAO DESL ANO', ''),
+            ('1986', '5486', '', '', '0', '0'),
+            ('2007', '28092007', '2001', '01', 'LVA', '0'),
+            ('2002', '', '', '0', '', '0'),
+            ('2002', '', '', '7', '', '3'),
+            ('2001', '', '2001', '1', '29', '2'),
+            ('2001', '', '2000', '3', '0', '12'),
+            ('1999', '', '', '', '10', '-12'),
+            ('1999', '3122005', '', '', '30', '4'),
+            ('', '', '2010', '5', '', ''),
+            ('asd', '31022005', '', '', '', 'x'),
+            ('2004', '', '2003', ' 5', '29', '2'),
+            ('2015', '10081999', '', '', '5', '')]
+
+    def feed(self, interpreter, rows):
+        columns = zip(*rows)
+        names = ['ANO', 'DT_ADMISSAO', 'ANO_ADM', 'MES_ADM',
+                 'DIADESL', 'MES_DESLIG']
+        batch = dict((names[i], np.array(columns[i]))
+                     for i in xrange(len(names)))
+        batch['PIS'] = np.array(['1'] * len(rows))
+        batch['IDENTIFICAD'] = np.array(['2'] * len(rows))
+        batch['MUNICIPIO'] = np.array(['430000'] * len(rows))
+        interpreter.feed_batch(batch)
+        return batch
+
+    def test_same_as_row_interpreter(self):
+        batch_interpreter = Pis12BatchInterpreter()
+        batch = self.feed(batch_interpreter, self.rows)
+
+        interpreter = Pis12DataInterpreter()
+        for i in xrange(len(self.rows)):
+            interpreter.feed_line(dict((name, batch[name][i])
+                                       for name in batch))
+            self.assertEquals(interpreter.year, batch_interpreter.year[i])
+            self.assertEquals(interpreter.admission_timestamp,
+                              batch_interpreter.admission_timestamp[i])
+            self.assertEquals(interpreter.demission_timestamp,
+                              batch_interpreter.demission_timestamp[i])
+            self.assertEquals(interpreter.admission_date != -1,
+                              batch_interpreter.admission_valid[i])
+            self.assertEquals(interpreter.demission_date != -1,
+                              batch_interpreter.demission_valid[i])
+            if interpreter.year != -1:
+                self.assertEquals(interpreter.time_at_employer,
+                                  batch_interpreter.time_at_employer[i])
+
+    def test_dates(self):
+        batch_interpreter = Pis12BatchInterpreter()
+        self.feed(batch_interpreter, self.rows)
+
+        # days since epoch
+        epoch = datetime(1970, 1, 1)
+        self.assertEquals((datetime(2015, 8, 10) - epoch).days,
+                          batch_interpreter.admission_days[0])
+        self.assertEquals((datetime(1900, 1, 1) - epoch).days,
+                          batch_interpreter.admission_days[5])
+        self.assertEquals((datetime(2001, 3, 1) - epoch).days,
+                          batch_interpreter.demission_days[7])
+
+        expected = [True, True, True, False, True, True, True, True,
+                    True, False, True, True, False, True, True]
+        self.assertListEqual(expected,
+                             list(batch_interpreter.admission_valid))
+        expected = [True, True, True, True, True, True, True, True,
+                    False, False, True, False, False, True, False]
+        self.assertListEqual(expected,
+                             list(batch_interpreter.demission_valid))
+        self.assertEquals(-1, batch_interpreter.admission_timestamp[3])
+
+    def test_ids(self):
+        batch_interpreter = Pis12BatchInterpreter()
+        batch = self.feed(batch_interpreter, self.rows[:3])
+        batch['PIS'] = np.array(['131313', '', ' 7'])
+        batch_interpreter.feed_batch(batch)
+        self.assertListEqual([131313, -1, 7],
+                             list(batch_interpreter.worker_id))
+        self.assertListEqual([2, 2, 2],
+                             list(batch_interpreter.employer_id))
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,339 @@
+import unittest
+import sys
+import os
+import cPickle as pickle
+import mock
+import numpy as np
+sys.path.insert(0, '../src/')
+from graph_storage import Int64Map, DenseInt64Array, NodeIdMap, EdgeSpellStore
+from graph_storage import EdgeIndex
+from graph_storage import write_snapshot, read_snapshot, SnapshotError
+from graph_storage import replace_file, release_mapped
+from graph_storage import ExternalSorter
+
+
+class TestInt64Map(unittest.TestCase):
+
+    def test_get_and_set(self):
+        int_map = Int64Map()
+        self.assertEquals(0, len(int_map))
+        self.assertFalse(10 in int_map)
+        self.assertIsNone(int_map.get(10))
+        with self.assertRaises(KeyError):
+            _ = int_map[10]
+
+        keys = [99999999999, -55, 0, 33, 10, 12345678901234]
+        for i, key in enumerate(keys):
+            int_map[key] = i
+        self.assertEquals(len(keys), len(int_map))
+        for i, key in enumerate(keys):
+            self.assertTrue(key in int_map)
+            self.assertEquals(i, int_map[key])
+        self.assertItemsEqual(keys, list(int_map))
+
+        # overwrite values, wherever they are
+        for key in keys:
+            int_map[key] = 7
+        self.assertEquals(len(keys), len(int_map))
+        for key in keys:
+            self.assertEquals(7, int_map.get(key))
+
+        self.assertListEqual(sorted(keys), int_map.keys.tolist())
+        self.assertListEqual([7] * len(keys), int_map.values.tolist())
+        # arrays of a dictionary are a copy, which is not kept around
+        self.assertIsNot(int_map.keys, int_map.keys)
+
+    def test_from_arrays(self):
+        keys = np.array([-55, 0, 10, 33])
+        values = np.array([1, 2, 3, 4])
+        for dict_lookups in [True, False]:
+            int_map = Int64Map(keys, values, dict_lookups)
+            self.assertEquals(4, len(int_map))
+            self.assertEquals(3, int_map[10])
+            self.assertIsNone(int_map.get(11))
+            self.assertFalse(34 in int_map)
+            self.assertListEqual([4, -1], int_map.lookup([33, 1]).tolist())
+            self.assertItemsEqual(keys.tolist(), list(int_map))
+
+            # bulk additions work on arrays too
+            int_map = Int64Map(keys, values, dict_lookups)
+            int_map.update([1, 0], [5, 6])
+            self.assertListEqual([-55, 0, 1, 10, 33], int_map.keys.tolist())
+            self.assertListEqual([1, 6, 5, 3, 4], int_map.values.tolist())
+
+            # and single ones work too
+            int_map[-60] = 7
+            self.assertEquals(7, int_map[-60])
+            self.assertEquals(6, int_map[0])
+            self.assertEquals(-60, int_map.keys[0])
+
+    def test_bulk(self):
+        int_map = Int64Map()
+        int_map[5] = 50
+        int_map.update(np.array([1, 2, 3, 2]), np.array([10, 20, 30, 22]))
+        self.assertEquals(4, len(int_map))
+
+        # last one wins
+        self.assertEquals(22, int_map[2])
+        self.assertEquals(50, int_map[5])
+
+        found = int_map.lookup(np.array([3, 4, 5, 1, 99]))
+        self.assertListEqual([30, -1, 50, 10, -1], found.tolist())
+        found = Int64Map().lookup(np.array([3, 4]), default=-7)
+        self.assertListEqual([-7, -7], found.tolist())
+
+    def test_pickle(self):
+        int_map = Int64Map()
+        int_map[3] = 4
+        int_map[1] = 2
+        loaded = pickle.loads(pickle.dumps(int_map, pickle.HIGHEST_PROTOCOL))
+        self.assertEquals(4, loaded[3])
+        self.assertEquals(2, loaded[1])
+        self.assertEquals(2, len(loaded))
+
+
+class TestDenseInt64Array(unittest.TestCase):
+
+    def test_get_and_set(self):
+        dense = DenseInt64Array()
+        self.assertFalse(0 in dense)
+        self.assertFalse(-1 in dense)
+        dense[0] = 99999999999
+        dense[5000] = -3
+        self.assertEquals(2, len(dense))
+        self.assertEquals(99999999999, dense[0])
+        self.assertEquals(-3, dense[5000])
+        self.assertIsNone(dense.get(3))
+        self.assertListEqual([0, 5000], list(dense))
+        with self.assertRaises(KeyError):
+            _ = dense[3]
+
+    def test_bulk(self):
+        dense = DenseInt64Array()
+        dense.update(np.array([2, 0, 3000]), np.array([20, 0, 30]))
+        self.assertListEqual([30, 20],
+                             dense.lookup(np.array([3000, 2])).tolist())
+        with self.assertRaises(KeyError):
+            dense.lookup(np.array([1]))
+
+
+class TestNodeIdMap(unittest.TestCase):
+
+    def test_map(self):
+        id_map = NodeIdMap()
+        id_map.add(43000000001, 0)
+        id_map.add_many(np.array([43000000002, 7]), np.array([1, 2]))
+        self.assertEquals(3, len(id_map))
+        self.assertTrue(7 in id_map)
+        self.assertFalse(8 in id_map)
+        self.assertListEqual([1, -1, 0],
+                             id_map.NIds([43000000002, 8, 43000000001]).tolist())
+        self.assertListEqual([7, 43000000001], id_map.ids([2, 0]).tolist())
+
+    def test_from_dicts(self):
+        id_map = NodeIdMap.from_dicts({10: 0, 20: 1}, {0: 10, 1: 20})
+        self.assertEquals(1, id_map.NId_from_id[20])
+        self.assertEquals(10, id_map.id_from_NId[0])
+
+
+class TestEdgeIndex(unittest.TestCase):
+
+    def test_get_and_add(self):
+        index = EdgeIndex()
+        index.add(5, 2, 0)
+        self.assertEquals(0, index.get(2, 5))
+        self.assertEquals(0, index.get(5, 2))
+        self.assertTrue((2, 5) in index)
+
+        # misses don't add anything
+        self.assertIsNone(index.get(2, 6))
+        self.assertFalse((6, 2) in index)
+        self.assertEquals(-1, index.get(7, 8, -1))
+        self.assertEquals(1, len(index))
+
+    def test_bulk(self):
+        index = EdgeIndex()
+        index.add(1, 0, 7)
+        index.add_many([3, 1, 2 ** 31], [1, 2, 4], [8, 9, 10])
+
+        self.assertListEqual([7, 8, 10, -1],
+                             index.lookup([0, 1, 4, 3], [1, 3, 2 ** 31, 4]).tolist())
+        self.assertListEqual([True, False, True],
+                             index.contains([2, 2, 2 ** 31], [1, 3, 4]).tolist())
+        self.assertEquals(4, len(index))
+
+        low, high, EIds = index.edges()
+        self.assertListEqual([(0, 1, 7), (1, 2, 9), (1, 3, 8), (4, 2 ** 31, 10)],
+                             zip(low.tolist(), high.tolist(), EIds.tolist()))
+
+        self.assertListEqual([False], EdgeIndex().contains([0], [1]).tolist())
+
+    def test_sections(self):
+        index = EdgeIndex.from_dict({(0, 1): 0, (1, 2): None, (2, 3): 1})
+        self.assertEquals(2, len(index))
+        self.assertIsNone(index.get(1, 2))
+
+        found = EdgeIndex.from_sections(index.to_sections())
+        self.assertEquals(0, found.get(1, 0))
+        self.assertEquals(1, found.get(2, 3))
+
+        # snapshots written before we had an EdgeIndex
+        found = EdgeIndex.from_sections({'edges.src': np.array([0, 2]),
+                                         'edges.dst': np.array([1, 3]),
+                                         'edges.eid': np.array([0, 1])})
+        self.assertEquals(1, found.get(3, 2))
+        self.assertEquals(2, len(found))
+
+
+class TestEdgeSpellStore(unittest.TestCase):
+
+    def test_add_and_get(self):
+        store = EdgeSpellStore()
+        years, admissions, demissions = store.get(3)
+        self.assertEquals(0, len(years))
+
+        store.add(3, 2010, 100.0, 200.0)
+        store.add(3, 2008, 10.0, 20.0)
+        store.add(0, 2010, 1.0, 2.0)
+        years, admissions, demissions = store.get(3)
+        self.assertListEqual([2008, 2010], years.tolist())
+        self.assertListEqual([10.0, 100.0], admissions.tolist())
+        self.assertListEqual([20.0, 200.0], demissions.tolist())
+        self.assertEquals(3, len(store))
+
+        # edges in between have no spells
+        self.assertEquals(0, len(store.get(1)[0]))
+        self.assertEquals(0, len(store.get(99)[0]))
+
+        # setting admission and demission separately
+        store.add(3, 2010, admission=150.0)
+        store.add(5, 2011, demission=-1)
+        store.add(5, 2011, admission=7.0)
+        years, admissions, demissions = store.get(3)
+        self.assertListEqual([10.0, 150.0], admissions.tolist())
+        self.assertListEqual([20.0, 200.0], demissions.tolist())
+        self.assertListEqual([7.0], store.get(5)[1].tolist())
+        self.assertListEqual([-1.0], store.get(5)[2].tolist())
+        self.assertEquals(4, len(store))
+
+    def test_add_many(self):
+        store = EdgeSpellStore()
+        store.add(1, 2000, 1.0, 2.0)
+        store.add_many(np.array([2, 1, 1]), np.array([2000, 2000, 2001]),
+                       np.array([5.0, 3.0, 4.0]), np.array([6.0, np.nan, 8.0]))
+        self.assertListEqual([2000, 2001], store.get(1)[0].tolist())
+        self.assertListEqual([3.0, 4.0], store.get(1)[1].tolist())
+        self.assertListEqual([2.0, 8.0], store.get(1)[2].tolist())
+        self.assertListEqual([5.0], store.get(2)[1].tolist())
+
+    def test_pickle(self):
+        store = EdgeSpellStore()
+        store.add(1, 2000, 1.0, 2.0)
+        loaded = pickle.loads(pickle.dumps(store, pickle.HIGHEST_PROTOCOL))
+        self.assertListEqual([2000], loaded.get(1)[0].tolist())
+
+
+class TestSnapshot(unittest.TestCase):
+
+    path = "./test_storage.snapshot"
+
+    def tearDown(self):
+        for path in [self.path, self.path + ".tmp", self.path + ".old"]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def test_round_trip(self):
+        id_map = NodeIdMap()
+        id_map.add_many(np.array([10 ** 12, 5, 7]), np.array([0, 1, 2]))
+        spells = EdgeSpellStore()
+        spells.add(0, 2001, 10.0, 20.0)
+        spells.add(1, 2000, 30.0)
+        sections = {'empty': np.array([], dtype=np.float32)}
+        sections.update(id_map.to_sections())
+        sections.update(spells.to_sections())
+        write_snapshot(self.path, sections)
+        self.assertFalse(os.path.isfile(self.path + ".tmp"))
+
+        header, loaded = read_snapshot(self.path)
+        self.assertEquals(1, header['version'])
+        self.assertEquals(0, len(loaded['empty']))
+        self.assertEquals(np.float32, loaded['empty'].dtype)
+        # sections are aligned
+        for name in loaded:
+            self.assertEquals(0, header['sections'][name]['offset'] % 64)
+
+        id_map = NodeIdMap.from_sections(loaded)
+        self.assertListEqual([0, -1, 2], id_map.NIds([10 ** 12, 6, 7]).tolist())
+        self.assertListEqual([5, 10 ** 12], id_map.ids([1, 0]).tolist())
+        spells = EdgeSpellStore.from_sections(loaded)
+        self.assertListEqual([2001], spells.get(0)[0].tolist())
+        self.assertListEqual([30.0], spells.get(1)[1].tolist())
+
+        # read only sections
+        with self.assertRaises(ValueError):
+            loaded['node_ids.keys'][0] = 1
+
+    def test_corrupted(self):
+        write_snapshot(self.path, {'a': np.arange(100)})
+        with open(self.path, 'r+b') as snapshot:
+            snapshot.seek(-8, os.SEEK_END)
+            snapshot.write('garbage!')
+        with self.assertRaises(SnapshotError):
+            read_snapshot(self.path)
+        # we can skip the check
+        self.assertEquals(100, len(read_snapshot(self.path, verify=False)[1]['a']))
+
+        with open(self.path, 'wb') as snapshot:
+            snapshot.write('not a snapshot')
+        with self.assertRaises(SnapshotError):
+            read_snapshot(self.path)
+
+    def test_overwrite(self):
+        write_snapshot(self.path, {'a': np.arange(10)})
+        _, loaded = read_snapshot(self.path, mode='c')
+        a = release_mapped(loaded['a'])
+        self.assertIsNot(a, loaded['a'])
+        self.assertIs(a, release_mapped(a))
+        del loaded
+        # rename can't replace files on windows
+        with mock.patch('graph_storage.os.name', 'nt'):
+            write_snapshot(self.path, {'a': a + 1})
+        self.assertListEqual(range(1, 11), read_snapshot(self.path)[1]['a'].tolist())
+        self.assertFalse(os.path.isfile(self.path + ".old"))
+
+        with open(self.path + ".tmp", 'wb') as temp:
+            temp.write('new')
+        with mock.patch('graph_storage.os.name', 'nt'):
+            replace_file(self.path + ".tmp", self.path)
+        self.assertEquals('new', open(self.path, 'rb').read())
+
+
+class TestExternalSorter(unittest.TestCase):
+
+    def test_merged(self):
+        values = np.random.RandomState(0).randint(0, 50, 200)
+
+        # room for 8 values at a time
+        sorter = ExternalSorter(128, ".")
+        for start in xrange(0, len(values), 3):
+            sorter.add(values[start:start + 3])
+        self.assertEquals(22, len(sorter.runs))
+        self.assertTrue(os.path.isdir(sorter.run_folder))
+
+        merged = np.concatenate(list(sorter.merged()))
+        self.assertListEqual(np.unique(values).tolist(), merged.tolist())
+
+        sorter.close()
+        self.assertFalse(os.path.isdir(sorter.run_folder))
+
+    def test_few_runs(self):
+        sorter = ExternalSorter(run_folder=".")
+        self.assertListEqual([], list(sorter.merged()))
+        sorter.add([5, 1, 5, 2 ** 40])
+        self.assertListEqual([1, 5, 2 ** 40],
+                             np.concatenate(list(sorter.merged())).tolist())
+        sorter.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
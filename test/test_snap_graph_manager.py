@@ -4,6 +4,8 @@ import snap
 import os
 from time import mktime
 import unittest
+import mock
+import numpy as np
 sys.path.append('../src')
 import graph_manager
 
@@ -270,8 +272,19 @@ class TestSnapManager(unittest.TestCase):
         manager.load_graph(file_path)
         self.assertEquals(3, manager.get_node_count())
 
+        # saving over the snapshot we loaded doesn't keep it mapped
+        manager.add_edge(10, 20)
+        manager.save_graph(file_path)
+        self.assertNotIsInstance(manager.edge_spells.years.base, np.memmap)
+        self.assertNotIsInstance(manager.node_ids.NId_from_id.arrays()[0].base,
+                                 np.memmap)
+        manager = graph_manager.SnapManager().load_graph(file_path)
+        self.assertEquals(3, manager.get_node_count())
+        self.assertTrue(manager.is_edge_between(20, 10))
+
         # cleanup
         os.remove(file_path)
+        os.remove("./test.snapshot")
 
         # except if not found
         with self.assertRaises(RuntimeError) as bad_call:
@@ -297,16 +310,12 @@ class TestSnapManager(unittest.TestCase):
         manager.add_edge(10,20, 567)
 
         graph_path = "./test.graph"
-        nid_from_id_path = "./test_nid_from_id.p"
-        id_from_nid_path = "./test_id_from_nid.p"
-        edge_from_tuple_path = "./test_edge_from_tuple.p"
+        snapshot_path = "./test.snapshot"
         manager.save_graph(graph_path)
 
         # files are saved
         self.assertTrue(os.path.isfile(graph_path))
-        self.assertTrue(os.path.isfile(nid_from_id_path))
-        self.assertTrue(os.path.isfile(id_from_nid_path))
-        self.assertTrue(os.path.isfile(edge_from_tuple_path))
+        self.assertTrue(os.path.isfile(snapshot_path))
 
         # file gets loaded
         manager2 = graph_manager.SnapManager()
@@ -325,12 +334,304 @@ class TestSnapManager(unittest.TestCase):
         self.assertEquals(20, manager2.id_from_NId[1])
         self.assertEquals(30, manager2.id_from_NId[2])
 
+        # loaded graphs can still grow
+        manager2.add_node(50)
+        manager2.add_edge(50, 10)
+        self.assertListEqual([20, 30, 50], manager2.get_neighboring_nodes(10))
+        self.assertFalse(manager.is_node(50))
 
         # cleanup
         os.remove(graph_path)
-        os.remove(nid_from_id_path)
-        os.remove(id_from_nid_path)
-        os.remove(edge_from_tuple_path)
+        os.remove(snapshot_path)
+
+    def test_graph_view(self):
+        manager = self.manager
+        for node_id in [10, 20, 30, 40, 50, 60]:
+            manager.add_node(node_id)
+        manager.add_node_attr(10, "type", "worker")
+        manager.add_node_attr(20, "type", "worker")
+        manager.add_node_attr(30, "type", "employer")
+        manager.add_node_attr(40, "type", "employer")
+        manager.add_edge(10, 30)
+        manager.add_edge(20, 30)
+        edge = manager.add_edge(40, 10)
+        manager.add_edge(50, 60)
+        manager.add_edge(60, 60)
+        manager.add_edge_spell(edge, 2010, 100.0, 200.0)
+        manager.add_node(70)
+        manager.add_edge(70, 10)
+        manager.delete_node(70)
+        manager.save_graph("./test.graph")
+
+        view = graph_manager.GraphView().load_graph("./test.graph")
+        self.assertEquals(manager.get_node_count(), view.get_node_count())
+        self.assertEquals(manager.get_edge_count(), view.get_edge_count())
+        self.assertListEqual(manager.get_nodes(), view.get_nodes())
+        self.assertFalse(view.is_node(70))
+        self.assertFalse(view.is_node(80))
+        self.assertIn(view.get_random_node(), manager.get_nodes())
+
+        for node_id in manager.get_nodes():
+            self.assertEquals(manager.get_node_attrs(node_id),
+                              view.get_node_attrs(node_id))
+            self.assertListEqual(manager.get_neighboring_nodes(node_id),
+                                 view.get_neighboring_nodes(node_id))
+            self.assertEquals(manager.get_shortest_path_size(node_id),
+                              view.get_shortest_path_size(node_id))
+            self.assertEquals(manager.get_eccentricity(node_id),
+                              view.get_eccentricity(node_id))
+            for other_id in manager.get_nodes():
+                self.assertEquals(manager.get_edge_between(node_id, other_id),
+                                  view.get_edge_between(node_id, other_id))
+
+        # 10 is connected to 30 and 40, out of 5 other nodes
+        self.assertAlmostEquals(0.4, view.get_degree_centrality(10))
+        self.assertEquals("worker", view.get_node_attr(10, "type"))
+        with self.assertRaises(RuntimeError):
+            view.get_node_attr(50, "type")
+        # deleted nodes have no type
+        self.assertDictEqual({}, view.get_node_attrs(70))
+        self.assertListEqual([10, 20], list(view.iter_workers()))
+        self.assertEquals(manager.count_by_type(), view.count_by_type())
+        self.assertEquals(manager.get_edge_attrs(edge), view.get_edge_attrs(edge))
+        self.assertListEqual([2010], view.get_edge_spells(edge)[0].tolist())
+
+        # cleanup
+        del view
+        os.remove("./test.graph")
+        os.remove("./test.snapshot")
+
+    def test_node_types(self):
+        manager = self.manager
+        for node_id in [10, 20, 30, 40]:
+            manager.add_node(node_id)
+        manager.add_node_attr(10, "type", "worker")
+        manager.add_node_attr(20, "type", "employer")
+        manager.add_node_attr(30, "type", "worker")
+        manager.add_nodes([50, 60, 20], [2, 1, 1])
+        manager.add_node(70)
+        manager.add_node_attr(70, "type", "employer")
+        manager.delete_node(70)
+
+        self.assertListEqual([10, 20, 30, 60], list(manager.iter_workers()))
+        self.assertListEqual([50], list(manager.iter_employers()))
+        self.assertEquals({"": 1, "worker": 4, "employer": 1},
+                          manager.count_by_type())
+
+        # types survive saving, with and without a snapshot
+        manager.save_graph("./test.graph")
+        loaded = graph_manager.SnapManager().load_graph("./test.graph")
+        self.assertListEqual([10, 20, 30, 60], list(loaded.iter_workers()))
+        save_legacy_graph(manager, "./test.graph")
+        os.remove("./test.snapshot")
+        loaded = graph_manager.SnapManager().load_graph("./test.graph")
+        self.assertListEqual([50], list(loaded.iter_employers()))
+        self.assertEquals(manager.count_by_type(), loaded.count_by_type())
+
+        # cleanup
+        for path in ["./test.graph", "./test_nid_from_id.p",
+                     "./test_id_from_nid.p", "./test_edge_from_tuple.p"]:
+            os.remove(path)
+
+    def test_checkpoint(self):
+        checkpoint = graph_manager.Checkpoint("./test_checkpoint", every=2)
+        self.assertFalse(checkpoint.exists())
+        self.assertEquals((None, None), checkpoint.load())
+
+        manager = self.manager
+        manager.add_node(10)
+        checkpoint.tick(manager, {"done": 1})
+        self.assertFalse(checkpoint.exists())
+        checkpoint.tick(manager, {"done": 2})
+        self.assertTrue(checkpoint.exists())
+
+        manager.add_node(20)
+        checkpoint.save(manager, {"done": 3})
+        self.assertFalse(os.path.isdir("./test_checkpoint.old"))
+        self.assertFalse(os.path.isdir("./test_checkpoint.tmp"))
+        graph, cursor = checkpoint.load()
+        self.assertEquals({"done": 3}, cursor)
+        self.assertListEqual([10, 20], graph.get_nodes())
+
+        # crashed between renames: only the old one is there
+        os.rename("./test_checkpoint", "./test_checkpoint.old")
+        self.assertEquals({"done": 3}, checkpoint.load()[1])
+
+        checkpoint.clear()
+        self.assertFalse(checkpoint.exists())
+
+    def test_load_graph_with_old_dictionaries(self):
+        manager = self.manager
+        manager.add_node(10)
+        manager.add_node(20)
+        manager.add_edge(10, 20)
+        graph_path = "./test.graph"
+        save_legacy_graph(manager, graph_path)
+
+        # graphs saved before NodeIdMap have plain dictionaries
+        import cPickle as pickle
+        pickle.dump({10: 0, 20: 1}, open("./test_nid_from_id.p", 'wb'))
+        pickle.dump({0: 10, 1: 20}, open("./test_id_from_nid.p", 'wb'))
+
+        manager2 = graph_manager.SnapManager()
+        manager2.load_graph(graph_path)
+        self.assertTrue(manager2.is_node(10))
+        self.assertEquals(20, manager2.id_from_NId[1])
+        self.assertListEqual([20], manager2.get_neighboring_nodes(10))
+
+        # cleanup
+        for path in ["./test.graph", "./test_nid_from_id.p",
+                     "./test_id_from_nid.p", "./test_edge_from_tuple.p"]:
+            os.remove(path)
+
+    def test_edge_spells(self):
+        manager = self.manager
+        manager.add_node(1)
+        manager.add_node(2)
+        edge = manager.add_edge(1, 2)
+
+        manager.add_edge_spell(edge, 2010, 100.0, 200.0)
+        manager.add_edge_attr(edge, "2011_admission_date", 300.0)
+        manager.add_edge_attr(edge, "2011_demission_date", -1)
+        manager.add_edge_attr(edge, "other", 5)
+
+        years, admissions, demissions = manager.get_edge_spells(edge)
+        self.assertListEqual([2010, 2011], years.tolist())
+        self.assertListEqual([100.0, 300.0], admissions.tolist())
+        self.assertListEqual([200.0, -1.0], demissions.tolist())
+
+        # spells also show up as attributes
+        attrs = manager.get_edge_attrs(edge)
+        self.assertEquals(100.0, attrs["2010_admission_date"])
+        self.assertEquals(-1, attrs["2011_demission_date"])
+        self.assertEquals(5, attrs["other"])
+        self.assertIsNone(attrs["2012_admission_date"])
+        self.assertEquals(300.0, manager.get_edge_attr(edge, "2011_admission_date"))
+        with self.assertRaises(RuntimeError):
+            manager.get_edge_attr(edge, "2012_admission_date")
+
+    def test_add_nodes(self):
+        manager = self.manager
+        manager.add_node(7)
+
+        new_ids = manager.add_nodes([5, 7, 3, 5, 9, 3], [1, 2, 1, 2, 1, 1])
+        self.assertListEqual([5, 3, 9], new_ids.tolist())
+        self.assertEquals(4, manager.get_node_count())
+
+        # same NIds as adding them one by one
+        expected = graph_manager.SnapManager()
+        for node_id in [7, 5, 3, 9]:
+            expected.add_node(node_id)
+        for node_id in [7, 5, 3, 9]:
+            self.assertEquals(expected.NId_from_id[node_id],
+                              manager.NId_from_id[node_id])
+
+        # the last type of each node wins
+        self.assertEquals("employer", manager.get_node_attr(5, "type"))
+        self.assertEquals("employer", manager.get_node_attr(7, "type"))
+        self.assertEquals("worker", manager.get_node_attr(3, "type"))
+
+        # a single code for every node, or none at all
+        manager.add_nodes(np.array([9, 11]), 2)
+        self.assertEquals("employer", manager.get_node_attr(11, "type"))
+        self.assertEquals(0, len(manager.add_nodes([11])))
+
+        # SNAP only gets the types that changed
+        network = manager.network
+        manager.network = mock.Mock(wraps=network)
+        manager.add_nodes([3, 5, 9, 13], [1, 2, 1, 1])
+        # 9 is now a worker and 13 is new
+        self.assertListEqual(
+            [((manager.NId_from_id[9], "worker", "type"),),
+             ((manager.NId_from_id[13], "worker", "type"),)],
+            sorted(manager.network.AddStrAttrDatN.call_args_list))
+        manager.network = network
+        self.assertEquals("worker", manager.get_node_attr(9, "type"))
+        self.assertEquals("worker", manager.get_node_attr(13, "type"))
+
+    def test_add_edges(self):
+        manager = self.manager
+        for node_id in [1, 2, 3]:
+            manager.add_node(node_id)
+        existing = manager.add_edge(3, 1)
+
+        EIds = manager.add_edges([1, 2, 1, 3, 1, 4], [2, 1, 3, 2, 3, 1])
+        self.assertEquals(existing, EIds[2])
+        self.assertEquals(EIds[0], EIds[1])
+        self.assertEquals(EIds[2], EIds[4])
+        # an edge to a node that doesn't exist
+        self.assertEquals(-1, EIds[5])
+        self.assertEquals(3, manager.get_edge_count())
+        self.assertEquals(EIds[3], manager.get_edge_between(2, 3))
+        self.assertEquals(EIds[0], manager.get_edge_between(2, 1))
+
+        # adding them again changes nothing
+        self.assertListEqual(EIds.tolist(), manager.add_edges(
+            [1, 2, 1, 3, 1, 4], [2, 1, 3, 2, 3, 1]).tolist())
+        self.assertEquals(3, manager.get_edge_count())
+
+    def test_edge_lookups_dont_grow_index(self):
+        manager = self.manager
+        manager.add_nodes([1, 2, 3])
+        manager.add_edge(1, 2)
+
+        self.assertTrue(manager.is_edge_between(2, 1))
+        self.assertFalse(manager.is_edge_between(1, 3))
+        self.assertIsNone(manager.get_edge_between(3, 2))
+        self.assertListEqual([True, False, False], manager.are_edges_between(
+            [1, 3, 1], [2, 2, 4]).tolist())
+        self.assertEquals(1, len(manager.edge_index))
+
+    def test_add_edge_attr_column(self):
+        manager = self.manager
+        manager.add_nodes([1, 2, 3])
+        EIds = manager.add_edges([1, 1], [2, 3])
+
+        manager.add_edge_attr_column(EIds, "count", np.array([3, 4]))
+        manager.add_edge_attr_column(EIds, "weight", np.array([0.5, 1.5]))
+        manager.add_edge_attr_column(EIds, "name", np.array(["a", "b"]))
+        manager.add_edge_attr_column(EIds[[0, 0]], "2010_admission_date",
+                                     np.array([10.0, 20.0]))
+        manager.add_edge_spells(EIds, [2010, 2011], [-1, 5], [30, 40])
+
+        attrs = manager.get_edge_attrs(EIds[0])
+        self.assertEquals(3, attrs["count"])
+        self.assertEquals(0.5, attrs["weight"])
+        self.assertEquals("a", attrs["name"])
+        self.assertEquals(-1, attrs["2010_admission_date"])
+        self.assertEquals(30, attrs["2010_demission_date"])
+        attrs = manager.get_edge_attrs(EIds[1])
+        self.assertEquals(4, attrs["count"])
+        self.assertEquals(5, attrs["2011_admission_date"])
+
+        # the last value of an edge wins
+        manager.add_edge_attr_column(EIds[[0, 0]], "count", np.array([7, 8]))
+        self.assertEquals(8, manager.get_edge_attr(EIds[0], "count"))
+
+    def test_load_graph_with_spells_as_snap_attributes(self):
+        manager = self.manager
+        manager.add_node(1)
+        manager.add_node(2)
+        edge = manager.add_edge(1, 2)
+
+        # that's how spells used to be kept
+        edge_iterator = manager.network.GetEI(edge)
+        manager.network.AddFltAttrDatE(edge_iterator, 100.0, "2010_admission_date")
+        manager.network.AddFltAttrDatE(edge_iterator, 200.0, "2010_demission_date")
+        graph_path = "./test.graph"
+        save_legacy_graph(manager, graph_path)
+
+        manager2 = graph_manager.SnapManager()
+        manager2.load_graph(graph_path)
+        years, admissions, demissions = manager2.get_edge_spells(edge)
+        self.assertListEqual([2010], years.tolist())
+        self.assertListEqual([100.0], admissions.tolist())
+        self.assertListEqual([200.0], demissions.tolist())
+
+        # cleanup
+        for path in ["./test.graph", "./test_nid_from_id.p",
+                     "./test_id_from_nid.p", "./test_edge_from_tuple.p"]:
+            os.remove(path)
 
     def test_node_generator(self):
 
@@ -810,6 +1111,21 @@ class TestSnapManager(unittest.TestCase):
 
 
 
+def save_legacy_graph(manager, graph_path):
+    """ Saves the graph the way we did before snapshots."""
+    import cPickle as pickle
+    FOut = snap.TFOut(graph_path)
+    manager.network.Save(FOut)
+    FOut.Flush()
+    pickle.dump(manager.NId_from_id,
+                open(graph_path.replace(".graph", "_nid_from_id.p"), 'wb'))
+    pickle.dump(manager.id_from_NId,
+                open(graph_path.replace(".graph", "_id_from_nid.p"), 'wb'))
+    edge_from_tuple = dict(((NId1, NId2), EId) for NId1, NId2, EId
+                           in zip(*manager.edge_index.edges()))
+    pickle.dump(edge_from_tuple,
+                open(graph_path.replace(".graph", "_edge_from_tuple.p"), 'wb'))
+
 
 if __name__ == "__main__":
     unittest.main()
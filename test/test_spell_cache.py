@@ -0,0 +1,103 @@
+import unittest
+import sys
+import os
+import time
+import shutil
+import logging
+import numpy as np
+sys.path.insert(0, '../src/')
+from spell_cache import SpellCache
+
+
+class TestSpellCache(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.folder = "./test_spell_cache/"
+        self.source_path = "./test_spell_source.csv"
+        with open(self.source_path, 'w') as source:
+            source.write("a,b\n1,2\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+        os.remove(self.source_path)
+
+    def test_get_and_put(self):
+        cache = SpellCache(self.folder)
+        self.assertIsNone(cache.get(self.source_path, 1))
+
+        columns = {'worker_id': np.arange(5), 'municipality': np.array(['43', '35'])}
+        cache.put(self.source_path, 1, columns)
+        found = cache.get(self.source_path, 1)
+        self.assertItemsEqual(columns.keys(), found.keys())
+        for name in columns:
+            self.assertListEqual(list(columns[name]), list(found[name]))
+
+        # other versions of the interpreter miss
+        self.assertIsNone(cache.get(self.source_path, 2))
+
+        # and so do changed files
+        with open(self.source_path, 'a') as source:
+            source.write("3,4\n")
+        self.assertIsNone(cache.get(self.source_path, 1))
+
+        # putting the new version replaces the old one
+        cache.put(self.source_path, 1, columns)
+        self.assertEquals(1, len(os.listdir(self.folder)))
+
+    def test_invalidate(self):
+        cache = SpellCache(self.folder)
+        other_path = self.source_path.replace(".csv", "_other.csv")
+        shutil.copy(self.source_path, other_path)
+        try:
+            cache.put(self.source_path, 1, {'a': np.arange(3)})
+            cache.put(other_path, 1, {'a': np.arange(3)})
+
+            cache.invalidate(self.source_path)
+            self.assertIsNone(cache.get(self.source_path, 1))
+            self.assertIsNotNone(cache.get(other_path, 1))
+
+            cache.invalidate()
+            self.assertIsNone(cache.get(other_path, 1))
+            self.assertEquals(0, cache.size())
+        finally:
+            os.remove(other_path)
+
+    def test_evict(self):
+        paths = [self.source_path.replace(".csv", str(i) + ".csv")
+                 for i in xrange(3)]
+        for path in paths:
+            shutil.copy(self.source_path, path)
+        try:
+            cache = SpellCache(self.folder)
+            for path in paths:
+                cache.put(path, 1, {'a': np.arange(1000)})
+                # eviction goes by modification time
+                time.sleep(0.01)
+            entry_size = cache.size() / 3
+
+            # the first entry was used last, so the second one goes
+            cache.get(paths[0], 1)
+            cache.max_bytes = 2 * entry_size
+            cache.evict()
+            self.assertIsNotNone(cache.get(paths[0], 1))
+            self.assertIsNone(cache.get(paths[1], 1))
+            self.assertIsNotNone(cache.get(paths[2], 1))
+        finally:
+            for path in paths:
+                os.remove(path)
+
+    def test_corrupted(self):
+        cache = SpellCache(self.folder)
+        cache.put(self.source_path, 1, {'a': np.arange(100)})
+        entry_path = os.path.join(self.folder, os.listdir(self.folder)[0])
+        with open(entry_path, 'r+b') as entry:
+            entry.seek(-8, os.SEEK_END)
+            entry.write('garbage!')
+
+        self.assertIsNone(cache.get(self.source_path, 1))
+        self.assertFalse(os.path.isfile(entry_path))
+
+
+if __name__ == "__main__":
+    unittest.main()